@@ -1,10 +1,18 @@
 
 
-import boto3
 import json
 import os
-import random
 import logging
+from datetime import datetime, timedelta, timezone
+from patching_clients import get_client
+from patching_concurrency import get_max_workers, run_concurrently
+from patching_metrics import invocation_metrics
+from patching_organizations import get_inventory
+from patching_overrides import stage_override_list
+from patching_tracking import (RUN_FAILED, RUN_RUNNING, RUN_SUCCEEDED, RUN_TIMED_OUT, find_run_executions, get_execution_state,
+                               new_run_id, summarize_account_executions)
+from patching_waves import (ACCOUNTS_UNCHECKED, DECISION_DISPATCH, DECISION_DONE, DECISION_PLAN, DECISION_WAIT, DEFAULT_MAX_FAILURE_RATE,
+                            DEFAULT_MAX_WAVE_CHECKS, DEFAULT_WAVE_WAIT_SECONDS, evaluate_wave, plan_waves)
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -13,19 +21,29 @@ CH.setLevel(logging.INFO)
 FORMATTER = logging.Formatter(
     '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 CH.setFormatter(FORMATTER)
-logger.addHandler(CH)
+if not logger.handlers:
+    logger.addHandler(CH)
+
+# Runs tracked without StartedAfter are looked up this far back.
+DEFAULT_TRACK_HOURS = 24
 
 class EmergencyPatching(object):
 
     def __init__(self, event, context):
         try:
-            global session
-            session = boto3.session.Session()
-            self.organizations_client = session.client('organizations')
+            self.inventory = get_inventory(get_client('organizations'))
+            self.target_ous = event.get('target_ous')
+            self.target_tags = event.get('target_tags')
             self.task_lambda_name = os.environ["TASK_LAMBDA_NAME"] 
             self.asg_task_lambda_name = os.environ["ASG_TASK_LAMBDA_NAME"] 
             self.patching_template_region = os.environ["PATCHING_TEMPLATE_REGION"]
             self.child_account_role = os.environ["CHILD_ACCOUNT_ROLE"]         
+            self.max_workers = get_max_workers("MAX_CONCURRENT_ACCOUNTS")
+            if 'track_run' in event:
+                # Tracking only needs the run ID, not the patching options.
+                self.include_asg = None
+                self.taskLambdaPayload = {"run_id": event['track_run']['RunId']}
+                return
             env = event['env']
             self.include_asg=event['include_asg']
             retain_healthy_percentage=event['retain_healthy_percentage']
@@ -40,50 +58,185 @@ class EmergencyPatching(object):
                             "run_patch_baseline_install_override_list": run_patch_baseline_install_override_list,
                             "include_asg": self.include_asg,
                             "retain_healthy_percentage": retain_healthy_percentage,
-                            "refresh_asg_instances": refresh_asg_instances                            
+                            "refresh_asg_instances": refresh_asg_instances,
+                            "run_id": event.get('RunId') or new_run_id()
                             }
             print(self.taskLambdaPayload)
         except Exception as exception:
             print("unable to init")
             raise Exception(str(exception))
 
+    def stage_override_list(self):
+        """
+        Validates the install override list once for the whole run and sends
+        every account the URL of its staged copy. Raises before anything is
+        dispatched when the list is malformed.
+        """
+        payload = self.taskLambdaPayload
+        payload['run_patch_baseline_install_override_list'] = stage_override_list(payload['run_patch_baseline_install_override_list'])
+        return payload['run_patch_baseline_install_override_list']
+
     def get_accounts(self):
-        paginator = self.organizations_client.get_paginator('list_accounts')
-        page_iterator = paginator.paginate()
-        for page in page_iterator:
-            accounts_list = page['Accounts']
-            for account in accounts_list:
-                try:
-                    account_id = account['Id']
-                    if account['Status'] == "ACTIVE":
-                        self.assume_role(account_id)
-                        lambda_client_child = self.assumeRoleSession.client('lambda', region_name=self.patching_template_region)
-                        response = lambda_client_child.invoke(FunctionName=self.task_lambda_name,
-                                                        Payload=json.dumps(self.taskLambdaPayload), InvocationType='Event')
-                        if self.include_asg=='Yes':
-                            response = lambda_client_child.invoke(FunctionName=self.asg_task_lambda_name,
-                                                            Payload=json.dumps(self.taskLambdaPayload), InvocationType='Event')
-                except Exception as exception:
-                    print(exception)
-
-    def assume_role(self, child_account_id):
-        account_number = child_account_id
-        secondary_rolearn = "arn:aws:iam::{}:role/{}".format(account_number,self.child_account_role)
-        secondary_session_name = "SecondarySession-" + str(random.randint(1, 100000))
-        sts_client = session.client('sts')
-        # Logging to child account.
-        secondaryRoleCreds = sts_client.assume_role(RoleArn=secondary_rolearn,
-                                                            RoleSessionName=secondary_session_name)
-        credentials = secondaryRoleCreds.get('Credentials')
-        accessKeyID = credentials.get('AccessKeyId')
-        secretAccessKey = credentials.get('SecretAccessKey')
-        sessionToken = credentials.get('SessionToken')
-        self.assumeRoleSession = boto3.session.Session(accessKeyID, secretAccessKey, sessionToken)
-        logger.info('Assumed in role in child account {}'.format(account_number))    
+        """
+        Returns the active accounts, limited to the OUs in target_ous and the
+        account tags in target_tags when the event sets them.
+        """
+        return self.inventory.get_account_ids(ous=self.target_ous, tags=self.target_tags)
+
+    def patch_accounts(self, account_ids):
+        dispatch_results = {}
+        started_at = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        results = run_concurrently(self.invoke_task_lambdas, account_ids, self.max_workers)
+        for account_id, invoked_functions, exception in results:
+            if exception is not None:
+                print(exception)
+                dispatch_results[account_id] = {'Status': 'FAILED', 'Error': str(exception)}
+            else:
+                dispatch_results[account_id] = {'Status': 'DISPATCHED', 'Functions': invoked_functions}
+        failed = [account_id for account_id in dispatch_results if dispatch_results[account_id]['Status'] == 'FAILED']
+        logger.info('Dispatched emergency patching to {} accounts, {} failed'.format(len(dispatch_results) - len(failed), len(failed)))
+        return {
+            'RunId': self.taskLambdaPayload['run_id'],
+            'StartedAt': started_at,
+            'DispatchedCount': len(dispatch_results) - len(failed),
+            'FailedCount': len(failed),
+            'Accounts': dispatch_results
+        }
+
+    def invoke_task_lambdas(self, account_id):
+        # Credentials and clients for the child account role are cached, so
+        # repeated emergency runs on a warm Lambda do not assume the role again.
+        child_role_arn = "arn:aws:iam::{}:role/{}".format(account_id,self.child_account_role)
+        lambda_client_child = get_client('lambda', self.patching_template_region, role_arn=child_role_arn)
+        invoked_functions = []
+        lambda_client_child.invoke(FunctionName=self.task_lambda_name,
+                                   Payload=json.dumps(self.taskLambdaPayload), InvocationType='Event')
+        invoked_functions.append(self.task_lambda_name)
+        if self.include_asg=='Yes':
+            lambda_client_child.invoke(FunctionName=self.asg_task_lambda_name,
+                                       Payload=json.dumps(self.taskLambdaPayload), InvocationType='Event')
+            invoked_functions.append(self.asg_task_lambda_name)
+        return invoked_functions
+
+    def plan_rollout(self, event):
+        """
+        Splits the active accounts into the waves configured in event['waves']
+        and returns the rollout state the state machine passes back in.
+        """
+        override_list = self.stage_override_list()
+        waves = plan_waves(self.get_accounts(), event['waves'], self.inventory.get_ous, self.inventory.get_tags)
+        logger.info('Planned {} waves of {} accounts'.format(len(waves), [len(wave) for wave in waves]))
+        return dict(event,
+                    RunId=self.taskLambdaPayload['run_id'],
+                    run_patch_baseline_install_override_list=override_list,
+                    Waves=waves,
+                    WaveIndex=0,
+                    WaveResults=[],
+                    WaveWaitSeconds=int(event.get('wave_wait_seconds', DEFAULT_WAVE_WAIT_SECONDS)),
+                    Decision=DECISION_DISPATCH if waves else DECISION_DONE)
+
+    def dispatch_wave(self, event):
+        wave_index = event['WaveIndex']
+        started_at = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        result = self.patch_accounts(event['Waves'][wave_index])
+        wave_result = {
+            'Wave': wave_index,
+            'StartedAt': started_at,
+            'DispatchedCount': result['DispatchedCount'],
+            'FailedAccounts': [account_id for account_id, account in result['Accounts'].items() if account['Status'] == 'FAILED'],
+            'Checks': 0
+        }
+        last_wave = wave_index + 1 == len(event['Waves'])
+        return dict(event,
+                    WaveResults=event['WaveResults'] + [wave_result],
+                    Decision=DECISION_DONE if last_wave else DECISION_WAIT)
+
+    def check_wave(self, event):
+        """
+        Counts the automation executions the current wave started and decides
+        whether to halt, wait longer or dispatch the next wave.
+        """
+        wave_index = event['WaveIndex']
+        wave_result = dict(event['WaveResults'][wave_index])
+        account_ids = [account_id for account_id in event['Waves'][wave_index] if account_id not in wave_result['FailedAccounts']]
+        wave_result['Counts'] = self.count_wave_executions(account_ids, wave_result['StartedAt'])
+        wave_result['Counts'][ACCOUNTS_UNCHECKED] += len(wave_result['FailedAccounts'])
+        wave_result['Checks'] += 1
+        decision = evaluate_wave(wave_result['Counts'], wave_result['Checks'],
+                                 float(event.get('max_failure_rate', DEFAULT_MAX_FAILURE_RATE)),
+                                 int(event.get('max_wave_checks', DEFAULT_MAX_WAVE_CHECKS)))
+        logger.info('Wave {} check {}: {} -> {}'.format(wave_index, wave_result['Checks'], wave_result['Counts'], decision))
+        wave_results = list(event['WaveResults'])
+        wave_results[wave_index] = wave_result
+        if decision == DECISION_DISPATCH:
+            wave_index += 1
+        return dict(event, WaveIndex=wave_index, WaveResults=wave_results, Decision=decision)
+
+    def find_account_executions(self, account_ids, started_after):
+        """
+        Returns the automation executions tagged with the run ID per account,
+        listed with each account's assumed role because the task lambdas
+        start them in the child accounts, and the accounts that could not
+        be checked.
+        """
+        run_id = self.taskLambdaPayload['run_id']
+        def find_executions(account_id):
+            child_role_arn = "arn:aws:iam::{}:role/{}".format(account_id,self.child_account_role)
+            ssm_client_child = get_client('ssm', self.patching_template_region, role_arn=child_role_arn)
+            return find_run_executions(ssm_client_child, run_id, started_after)
+        executions_by_account = {}
+        unchecked_accounts = []
+        for account_id, executions, exception in run_concurrently(find_executions, account_ids, self.max_workers):
+            if exception is not None:
+                print('Unable to check executions in ' + account_id + ' ' + str(exception))
+                unchecked_accounts.append(account_id)
+                continue
+            executions_by_account[account_id] = executions
+        return executions_by_account, unchecked_accounts
+
+    def count_wave_executions(self, account_ids, started_after):
+        executions_by_account, unchecked_accounts = self.find_account_executions(account_ids, started_after)
+        counts = {RUN_RUNNING: 0, RUN_SUCCEEDED: 0, RUN_FAILED: 0, RUN_TIMED_OUT: 0, ACCOUNTS_UNCHECKED: len(unchecked_accounts)}
+        for executions in executions_by_account.values():
+            for execution in executions:
+                counts[get_execution_state(execution['AutomationExecutionStatus'])] += 1
+        return counts
+
+    def track_run(self, event):
+        """
+        Summarizes the executions a run started in every targeted account.
+        The task lambdas are invoked asynchronously and their execution
+        records are discarded, so the executions are found by their
+        PatchingRunId tag instead. Call again while the Status is RUNNING.
+        """
+        track = event['track_run']
+        account_ids = track.get('Accounts') or self.get_accounts()
+        started_after = track.get('StartedAfter') or (datetime.now(timezone.utc) - timedelta(hours=DEFAULT_TRACK_HOURS)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        executions_by_account, unchecked_accounts = self.find_account_executions(account_ids, started_after)
+        summary = summarize_account_executions(self.taskLambdaPayload['run_id'], self.patching_template_region, executions_by_account)
+        summary['RunId'] = self.taskLambdaPayload['run_id']
+        summary['UncheckedAccounts'] = unchecked_accounts
+        logger.info('Run {}: {} executions in {} accounts, {} accounts unchecked -> {}'.format(
+            summary['RunId'], summary['ExecutionCount'], len(executions_by_account), len(unchecked_accounts), summary['Status']))
+        return summary
 
+@invocation_metrics('EmergencyPatching')
 def lambda_handler(event, context):
     """
     This is starting point of Lambda execution
     """
     emergency_patching = EmergencyPatching(event, context)
-    emergency_patching.get_accounts()
\ No newline at end of file
+    if 'track_run' in event:
+        return emergency_patching.track_run(event)
+    # The wave rollout state machine passes the rollout state back in with
+    # the next step to take; without it every account is patched at once.
+    decision = event.get('Decision')
+    if decision == DECISION_PLAN:
+        return emergency_patching.plan_rollout(event)
+    if decision == DECISION_DISPATCH:
+        return emergency_patching.dispatch_wave(event)
+    if decision == DECISION_WAIT:
+        return emergency_patching.check_wave(event)
+    emergency_patching.stage_override_list()
+    account_ids = emergency_patching.get_accounts()
+    return emergency_patching.patch_accounts(account_ids)
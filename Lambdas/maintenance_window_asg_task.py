@@ -1,12 +1,21 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-import boto3
 import logging
 import os
-import string
-import uuid
-from boto3.session import Session
+import time
+from datetime import datetime, timezone
+from patching_autoscaling import AutoScalingGroupIndex
+from patching_cache import Memoizer
+from patching_automation import AutomationScheduler, EXECUTION_STARTED
+from patching_clients import get_account_id, get_client
+from patching_concurrency import get_max_workers, run_concurrently
+from patching_dryrun import DryRun
+from patching_metrics import invocation_metrics
+from patching_model import PatchTarget
+from patching_overrides import stage_override_list
+from patching_tagging import chunk_list
+from patching_tracking import execution_record, execution_tags, get_run_scope, get_snapshot_id, new_run_id, track_executions
 
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
@@ -15,7 +24,13 @@ CH.setLevel(logging.INFO)
 FORMATTER = logging.Formatter(
     '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 CH.setFormatter(FORMATTER)
-LOGGER.addHandler(CH)
+if not LOGGER.handlers:
+    LOGGER.addHandler(CH)
+
+SCHEDULER_DEADLINE_MARGIN_SECONDS = 30
+# ASGs sharing one baked AMI per automation. The update ASG lambda updates
+# them in one invocation and the document waits for each refresh in turn.
+MAX_ASGS_PER_BAKE = 50
 
 
 class PatchingASG(object):
@@ -24,14 +39,12 @@ class PatchingASG(object):
     # Description: Patch ASG's
     """
 
-    def __init__(self, event, context):
+    def __init__(self, event, context, dry_run=None):
         self.event = event
         self.context = context
+        self.dry_run = dry_run
         self.exception = []
 
-        ssm_client = boto3.client('ssm')        
-        sts_client = boto3.client('sts')
-
         self.execution_role_name = os.environ["EXECUTION_ROLE_NAME"]
         self.administration_role_name = os.environ["ADMINISTRATION_ROLE_NAME"]
         self.document_name = os.environ["DOCUMENT_NAME"]
@@ -42,15 +55,33 @@ class PatchingASG(object):
         self.patching_template_region = os.environ["PATCHING_TEMPLATE_REGION"] 
         regions = os.environ["WORKLOAD_REGIONS"]
         self.regions = regions.split(",")
-        self.accounts_id = sts_client.get_caller_identity()['Account']
+        self.accounts_id = get_account_id()
+        # Every execution targets a single account and region, so per
+        # location concurrency stays at one; executions run in parallel
+        # through the scheduler instead.
         self.target_location_max_concurrency='1'
         self.target_location_max_errors='1'        
+        self.ssm_client = self.client('ssm',self.patching_template_region)
+        # Subnet, security group and AMI lookups are shared by every ASG in
+        # this run, keyed by region, so each VPC and launch configuration or
+        # template is resolved once.
+        self.lookups = Memoizer()
+        # Lead ASG of every started bake, keyed by (region, ASG name), to the
+        # names of all the ASGs it updates.
+        self.bake_groups = {}
+        self.bake_date = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+        self.scheduler = AutomationScheduler(
+            self.ssm_client,
+            max_running=get_max_workers("MAX_CONCURRENT_AUTOMATIONS", 20),
+            deadline=self.get_deadline())
         try:
             self.env = self.event['env']
             self.retain_healthy_percentage = self.event['retain_healthy_percentage']
             self.refresh_asg_instances = self.event['refresh_asg_instances']
             self.patching_operation = self.event['patching_operation']
             self.run_patch_baseline_install_override_list = self.event['run_patch_baseline_install_override_list']            
+            self.run_id = self.event.get('run_id') or new_run_id()
+            self.snapshot_id = get_snapshot_id(get_run_scope(self.event, self.run_id), self.env)
             print("event", self.event)
         except Exception as exception:
             self.reason_data = "Missing required property %s" % exception
@@ -58,168 +89,305 @@ class PatchingASG(object):
             print("Failed in except block of __init__")
             
 
-    def describe_asg(self,env): 
+    def client(self, service, region):
+        """
+        Returns the region's client, recording calls instead of allowing
+        writes when this is a dry run.
+        """
+        client = get_client(service, region)
+        if self.dry_run is not None:
+            return self.dry_run.wrap(client, service)
+        return client
+
+    def describe_asg(self,ec2_client,as_client,env): 
+        """
+        Returns a PatchTarget for every ASG in the environment's maintenance
+        window. Discovery is paginated and filtered on the maintenance_window
+        tag by the Auto Scaling service.
+        """
+        targets = []
+        mw_name = env+'_maintenance_window'
+        asg_index = AutoScalingGroupIndex.build(as_client, 'maintenance_window', [mw_name])
+        print('Found ' + str(len(asg_index.get(mw_name))) + ' ASGs in ' + mw_name)
+        for group in asg_index.get(mw_name):
+            try:
+                targets.append(self.describe_asg_target(ec2_client, as_client, group))
+            except Exception as exp:
+                print('Skipping ASG ' + group.name + ' ' + str(exp))
+        return targets
+
+    def describe_asg_target(self,ec2_client,as_client,group):
+        region = ec2_client.meta.region_name
+        subnet_id = group.subnet_ids[0]
+        image_id = self.get_asg_image_id(ec2_client, as_client, group)
+        vpc_id = self.lookups.get((region, 'subnet', subnet_id),
+            lambda: ec2_client.describe_subnets(SubnetIds=[subnet_id])['Subnets'][0]['VpcId'])
+        sg_id = self.lookups.get((region, 'security-group', vpc_id),
+            lambda: self.get_patching_sg(ec2_client, vpc_id))
+        return PatchTarget(group.name, subnet_id, image_id, sg_id)
+
+    def get_asg_image_id(self,ec2_client,as_client,group):
+        region = ec2_client.meta.region_name
+        if group.launch_configuration_name is not None:
+            try:
+                return self.lookups.get((region, 'launch-configuration', group.launch_configuration_name),
+                    lambda: as_client.describe_launch_configurations(LaunchConfigurationNames=[group.launch_configuration_name])['LaunchConfigurations'][0]['ImageId'])
+            except Exception as exp:
+                print('Launch configuration not found '+str(exp))
+        if group.launch_template_id is None:
+            raise Exception('No launch configuration or launch template')
         try:
-            response = self.as_client.describe_auto_scaling_groups(MaxRecords=100)
-            asg_name=[]
-            subnet_id = []
-            image_id = []
-            sg_id = []
-
-            for group in response['AutoScalingGroups']:
-                failed = False
-                for tags in group['Tags']:
-                    if tags['Key'] == 'maintenance_window' and tags['Value'] == env+'_maintenance_window':
-                        asg_name_tmp = group['AutoScalingGroupName']
-                        subnet_tmp = group['VPCZoneIdentifier']
-                        try:
-                            subnet_tmp = subnet_tmp.split(',')[0]
-                        except Exception as exp:
-                            print(str(exp))
-                            failed = True 
-                        try:
-                            image_id_tmp = self.as_client.describe_launch_configurations(LaunchConfigurationNames=[group['LaunchConfigurationName']])['LaunchConfigurations'][0]['ImageId']
-                        except Exception as exp:
-                            print('Launch configuration not found '+str(exp))
-                            try:
-                                launch_template = group['LaunchTemplate']['LaunchTemplateId']
-                                launch_template_version = group['LaunchTemplate']['Version']
-                                response = self.ec2_client.describe_launch_template_versions(LaunchTemplateId=launch_template,Versions=[launch_template_version])
-                                image_id_tmp = response['LaunchTemplateVersions'][0]['LaunchTemplateData']['ImageId']
-                            except Exception as exp:
-                                print('Launch template not found '+str(exp))
-                                failed = True 
-                        response = self.ec2_client.describe_subnets(SubnetIds=[subnet_tmp])
-                        vpc_id = response['Subnets'][0]['VpcId']
-                        try: 
-                            response = self.ec2_client.describe_security_groups(
-                                Filters=[
-                                    {
-                                        'Name': 'group-name',
-                                        'Values': ['ASGPatchingSG']
-                                    },
-                                    {
-                                        'Name': 'vpc-id',
-                                        'Values': [vpc_id]
-                                    }                            
-                                ]                       
-                            )
-                            sg_id_tmp = response['SecurityGroups'][0]['GroupId']                    
-                            rule_exists = False
-                            for rule in response['SecurityGroups'][0]['IpPermissionsEgress']:
-                                if rule['IpProtocol'] == '-1' and rule['IpRanges'][0]['CidrIp'] == '0.0.0.0/0':
-                                    print('Patching SG found')
-                                    rule_exists = True
-                            if rule_exists != True: 
-                                print('Patching SG found - adding rule')
-                                response = self.ec2_client.authorize_security_group_egress(
-                                GroupId=sg_id_tmp,
-                                IpPermissions=[{
-                                        'FromPort': -1,
-                                        'IpProtocol': '-1',
-                                        'IpRanges': [{
-                                                'CidrIp': '0.0.0.0/0',
-                                                'Description': 'string'
-                                            }],
-                                        'ToPort': -1
-                                    }])
-                            sg_id_tmp_append = sg_id_tmp
-                        except Exception as exp:
-                            print('No Patching SG ' +str(exp))
-                            try:
-                                response = self.ec2_client.create_security_group(
-                                    Description='Security Group for Patching ASGs',
-                                    GroupName='ASGPatchingSG',
-                                    VpcId=vpc_id
-                                )
-                                sg_id_tmp_append = response['GroupId']
-                            except Exception as exp:
-                                print('Failed creating patching SG ' +str(exp))
-                                failed = True 
-                        if failed==False:
-                            asg_name.append(asg_name_tmp)
-                            subnet_id.append(subnet_tmp)
-                            image_id.append(image_id_tmp)
-                            sg_id.append(sg_id_tmp_append)
-
-            return asg_name, subnet_id, image_id, sg_id
-
-        except Exception as exp:  
-            print('No such ASG'+str(exp))
-
-
-    def invoke_ssm_doc(self,asg_name,subnet_id,image_id,sg_id): 
-        for i in range(len(asg_name)):
-            if self.patching_operation == "Scan":
-                parmsASG = {
-                    'AutomationAssumeRole': [f'arn:aws:iam::{self.accounts_id}:role/{self.administration_role_name}'],
-                    'Operation' : [self.patching_operation],
-                    'SnapshotId' : [str(uuid.uuid4())],
-                    'ResourceGroupKey' : ['tag:aws:autoscaling:groupName'],
-                    'ResourceGroupName' : [asg_name[i]]
+            return self.lookups.get((region, 'launch-template', group.launch_template_id, group.launch_template_version),
+                lambda: ec2_client.describe_launch_template_versions(LaunchTemplateId=group.launch_template_id,Versions=[group.launch_template_version])['LaunchTemplateVersions'][0]['LaunchTemplateData']['ImageId'])
+        except Exception as exp:
+            raise Exception('Launch template not found '+str(exp))
+
+    def get_patching_sg(self,ec2_client,vpc_id):
+        try: 
+            response = ec2_client.describe_security_groups(
+                Filters=[
+                    {
+                        'Name': 'group-name',
+                        'Values': ['ASGPatchingSG']
+                    },
+                    {
+                        'Name': 'vpc-id',
+                        'Values': [vpc_id]
+                    }                            
+                ]                       
+            )
+            sg_id_tmp = response['SecurityGroups'][0]['GroupId']                    
+            rule_exists = False
+            for rule in response['SecurityGroups'][0]['IpPermissionsEgress']:
+                if rule['IpProtocol'] == '-1' and rule['IpRanges'][0]['CidrIp'] == '0.0.0.0/0':
+                    print('Patching SG found')
+                    rule_exists = True
+            if rule_exists != True and self.dry_run is not None:
+                self.dry_run.plan_change(Region=ec2_client.meta.region_name, SecurityGroup=sg_id_tmp, Action='AuthorizeEgress')
+                self.dry_run.count_write('ec2.authorize_security_group_egress')
+            elif rule_exists != True: 
+                print('Patching SG found - adding rule')
+                ec2_client.authorize_security_group_egress(
+                GroupId=sg_id_tmp,
+                IpPermissions=[{
+                        'FromPort': -1,
+                        'IpProtocol': '-1',
+                        'IpRanges': [{
+                                'CidrIp': '0.0.0.0/0',
+                                'Description': 'string'
+                            }],
+                        'ToPort': -1
+                    }])
+            return sg_id_tmp
+        except Exception as exp:
+            print('No Patching SG ' +str(exp))
+        if self.dry_run is not None:
+            self.dry_run.plan_change(Region=ec2_client.meta.region_name, Vpc=vpc_id, Action='CreatePatchingSecurityGroup')
+            self.dry_run.count_write('ec2.create_security_group')
+            return None
+        try:
+            response = ec2_client.create_security_group(
+                Description='Security Group for Patching ASGs',
+                GroupName='ASGPatchingSG',
+                VpcId=vpc_id
+            )
+            return response['GroupId']
+        except Exception as exp:
+            raise Exception('Failed creating patching SG ' +str(exp))
+
+
+    def get_bake_key(self, target):
+        """
+        ASGs launched from the same AMI and patched with the same baseline,
+        install override list and day end up with the same patched AMI, so
+        they share one bake.
+        """
+        return (target.image_id, self.env, self.run_patch_baseline_install_override_list, self.bake_date)
+
+    def group_bakes(self, targets):
+        """
+        Returns the targets grouped by bake key, in discovery order, with at
+        most MAX_ASGS_PER_BAKE targets per group.
+        """
+        bakes = {}
+        for target in targets:
+            bakes.setdefault(self.get_bake_key(target), []).append(target)
+        return [group for bake_targets in bakes.values() for group in chunk_list(bake_targets, MAX_ASGS_PER_BAKE)]
+
+    def invoke_ssm_doc(self,region,targets): 
+        if self.patching_operation != "Scan":
+            self.invoke_bakes(region, targets)
+            return
+        for target in targets:
+            parmsASG = {
+                'AutomationAssumeRole': [f'arn:aws:iam::{self.accounts_id}:role/{self.administration_role_name}'],
+                'Operation' : [self.patching_operation],
+                'SnapshotId' : [self.snapshot_id],
+                'ResourceGroupKey' : ['tag:aws:autoscaling:groupName'],
+                'ResourceGroupName' : [target.asg_name]
+            }
+            if len(self.run_patch_baseline_install_override_list) > 0:
+                parmsASG['InstallOverrideList'] = [self.run_patch_baseline_install_override_list]
+
+            self.start_automation(region, target.asg_name,
+                DocumentName=f'{self.document_name}',
+                Parameters=parmsASG,
+                TargetLocations=[
+                    {
+                        'Accounts': [self.accounts_id],
+                        'Regions': [region],
+                        'TargetLocationMaxConcurrency': self.target_location_max_concurrency,
+                        'TargetLocationMaxErrors': self.target_location_max_errors,
+                        'ExecutionRoleName': self.execution_role_name
+                    }
+                ],
+                Tags=execution_tags(self.run_id, self.env, target.asg_name)
+            )
+
+    def invoke_bakes(self, region, targets):
+        """
+        Starts one patch automation per bake group. It bakes the AMI from the
+        lead ASG's image, in the lead ASG's subnet, and updates every ASG in
+        the group with it.
+        """
+        groups = self.group_bakes(targets)
+        print('Baking ' + str(len(groups)) + ' AMIs for ' + str(len(targets)) + ' ASGs in ' + region)
+        for group in groups:
+            lead = group[0]
+            asg_names = [target.asg_name for target in group]
+            self.bake_groups[(region, lead.asg_name)] = asg_names
+            parms = {
+                    'automationAssumeRole': [f'arn:aws:iam::{self.accounts_id}:role/{self.asg_execution_role_name}'],
+                    'sourceAMIid' : [lead.image_id],
+                    'subnetId' : [lead.subnet_id],
+                    'targetASG' : [','.join(asg_names)],
+                    'targetASGs' : asg_names,
+                    'instanceProfileRoleName' : [self.profile_role_name],
+                    'updateASGLambdaName': [self.lambda_name],
+                    'retainHealthyPercentage': [self.retain_healthy_percentage],
+                    'refreshASGInstances': [self.refresh_asg_instances],
+                    'instancesEnvironmentTag': [self.env],
+                    'snapshotId': [self.snapshot_id],
+                    'securitygroupId': [lead.security_group_id]
                 }
-                if len(self.run_patch_baseline_install_override_list) > 0:
-                    parmsASG['InstallOverrideList'] = [self.run_patch_baseline_install_override_list]
-
-                response = self.ssm_client.start_automation_execution(
-                    DocumentName=f'{self.document_name}',
-                    Parameters=parmsASG,
-                    TargetLocations=[
-                        {
-                            'Accounts': [self.accounts_id],
-                            'Regions': [self.region],
-                            'TargetLocationMaxConcurrency': self.target_location_max_concurrency,
-                            'TargetLocationMaxErrors': self.target_location_max_errors,
-                            'ExecutionRoleName': self.execution_role_name
-                        }
-                    ]                    
-                )                     
-            else:
-                parms = {
-                        'automationAssumeRole': [f'arn:aws:iam::{self.accounts_id}:role/{self.asg_execution_role_name}'],
-                        'sourceAMIid' : [image_id[i]],
-                        'subnetId' : [subnet_id[i]],
-                        'targetASG' : [asg_name[i]],
-                        'instanceProfileRoleName' : [self.profile_role_name],
-                        'updateASGLambdaName': [self.lambda_name],
-                        'retainHealthyPercentage': [self.retain_healthy_percentage],
-                        'refreshASGInstances': [self.refresh_asg_instances],
-                        'instancesEnvironmentTag': [self.env],
-                        'securitygroupId': [sg_id[i]]
+            if len(self.run_patch_baseline_install_override_list) > 0:
+                parms['installOverrideList'] = [self.run_patch_baseline_install_override_list]
+
+            self.start_automation(region, lead.asg_name,
+                DocumentName=f'{self.asg_document_name}',
+                Parameters=parms,
+                TargetLocations=[
+                    {
+                        'Accounts': [self.accounts_id],
+                        'Regions': [region],
+                        'TargetLocationMaxConcurrency': self.target_location_max_concurrency,
+                        'TargetLocationMaxErrors': self.target_location_max_errors,
+                        'ExecutionRoleName': self.execution_role_name
                     }
-                if len(self.run_patch_baseline_install_override_list) > 0:
-                    parms['installOverrideList'] = [self.run_patch_baseline_install_override_list]
-
-                response = self.ssm_client.start_automation_execution(
-                    DocumentName=f'{self.asg_document_name}',
-                    Parameters=parms,
-                    TargetLocations=[
-                        {
-                            'Accounts': [self.accounts_id],
-                            'Regions': [self.region],
-                            'TargetLocationMaxConcurrency': self.target_location_max_concurrency,
-                            'TargetLocationMaxErrors': self.target_location_max_errors,
-                            'ExecutionRoleName': self.execution_role_name
-                        }
-                    ]                    
-                )
+                ],
+                Tags=execution_tags(self.run_id, self.env, lead.asg_name)
+            )
+
+    def start_automation(self, region, asg_name, **start_arguments):
+        if self.dry_run is not None:
+            self.dry_run.plan_change(Region=region, AutoScalingGroup=asg_name, DocumentName=start_arguments['DocumentName'],
+                                     Parameters=start_arguments['Parameters'])
+            self.dry_run.count_write('ssm.start_automation_execution')
+            return
+        self.scheduler.submit((region, asg_name), **start_arguments)
+
+    def patch_region(self, region):
+        ec2_client = self.client('ec2',region)
+        as_client = self.client('autoscaling',region)
+        targets = self.describe_asg(ec2_client, as_client, self.env)
+        self.invoke_ssm_doc(region, targets)
+        return [target.asg_name for target in targets]
+
+    def stage_override_list(self):
+        """
+        Replaces the install override list with its validated, staged copy
+        before any ASG is discovered, so a malformed list starts nothing.
+        """
+        self.run_patch_baseline_install_override_list = stage_override_list(
+            self.run_patch_baseline_install_override_list, dry_run=self.dry_run)
+
+    def get_deadline(self):
+        """
+        Leaves SCHEDULER_DEADLINE_MARGIN_SECONDS of the invocation to report
+        the jobs that could not be started.
+        """
+        if self.context is None:
+            return None
+        remaining = self.context.get_remaining_time_in_millis() / 1000.0
+        return time.monotonic() + remaining - SCHEDULER_DEADLINE_MARGIN_SECONDS
 
     def patch_asg(self):
+        """
+        Discovers the ASGs of every region concurrently, then starts their
+        patch automations through one scheduler so the account's automation
+        quota is shared across regions. Returns per region the execution
+        started, or the error, for every ASG.
+        """
         try:
-            for region in self.regions:
-                self.ec2_client = boto3.client('ec2',region_name=region)
-                self.as_client = boto3.client('autoscaling',region_name=region)
-                self.ssm_client = boto3.client('ssm',region_name=self.patching_template_region)
-                self.region = region
-                [asgs, subnets, images, sgs] = self.describe_asg(self.env)
-                self.invoke_ssm_doc(asgs, subnets, images, sgs)
+            self.stage_override_list()
+            region_results = {}
+            max_workers = get_max_workers("MAX_CONCURRENT_REGIONS", len(self.regions))
+            for region, asgs, exception in run_concurrently(self.patch_region, self.regions, max_workers):
+                if exception is not None:
+                    print('Failed patching ASGs in ' + region + ' ' + str(exception))
+                    region_results[region] = {'Status': 'FAILED', 'Error': str(exception)}
+                else:
+                    region_results[region] = {'Status': 'SUCCESS', 'AutoScalingGroups': {}}
+            executions = []
+            for (region, asg_name), result in self.scheduler.run().items():
+                # Every ASG of a bake reports the lead ASG's execution.
+                for group_asg_name in self.bake_groups.get((region, asg_name), [asg_name]):
+                    region_results[region]['AutoScalingGroups'][group_asg_name] = result
+                if result['Status'] != EXECUTION_STARTED:
+                    region_results[region]['Status'] = 'FAILED'
+                else:
+                    executions.append(execution_record(result['AutomationExecutionId'], self.run_id, self.patching_template_region,
+                                                       self.accounts_id, [region], self.env, asg_name))
+            for region, region_result in region_results.items():
+                started = [asg_name for asg_name, result in region_result.get('AutoScalingGroups', {}).items() if result['Status'] == EXECUTION_STARTED]
+                print('Started patching ' + str(len(started)) + ' of ' + str(len(region_result.get('AutoScalingGroups', {}))) + ' ASGs in ' + region)
+            return {'RunId': self.run_id, 'SnapshotId': self.snapshot_id, 'Regions': region_results, 'Executions': executions}
         except Exception as exp:
             print(str(exp))
 
+    def plan_asg(self):
+        """
+        Runs ASG discovery and target resolution in every region without
+        creating anything or starting automations, and returns the
+        automations a real run would start.
+        """
+        self.stage_override_list()
+        region_results = {}
+        max_workers = get_max_workers("MAX_CONCURRENT_REGIONS", len(self.regions))
+        for region, asgs, exception in run_concurrently(self.patch_region, self.regions, max_workers):
+            if exception is not None:
+                region_results[region] = {'Status': 'FAILED', 'Error': str(exception)}
+            else:
+                region_results[region] = {'Status': 'SUCCESS', 'AutoScalingGroups': asgs}
+        plan = self.dry_run.as_dict()
+        plan['Regions'] = region_results
+        plan['Concurrency'] = {
+            'MaxConcurrentAutomations': self.scheduler.max_running,
+            'MaxConcurrentRegions': max_workers,
+            'TargetLocationMaxConcurrency': self.target_location_max_concurrency
+        }
+        return plan
+
+@invocation_metrics('PatchingASG')
 def lambda_handler(event,context):
     try:
+        if 'track_executions' in event:
+            remaining = context.get_remaining_time_in_millis() / 1000.0 - SCHEDULER_DEADLINE_MARGIN_SECONDS
+            return track_executions(event['track_executions'], remaining)
+        if event.get('dry_run'):
+            return PatchingASG(event,context,DryRun()).plan_asg()
         patching_asg = PatchingASG(event,context)
-        patching_asg.patch_asg()
+        return patching_asg.patch_asg()
 
     except Exception as exp:
         print(str(exp))
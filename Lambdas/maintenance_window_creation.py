@@ -2,12 +2,14 @@
 # SPDX-License-Identifier: MIT-0
 
 import json
-import boto3
 from datetime import datetime, timedelta
 import logging
 import os
 import time
 from crhelper import CfnResource
+from patching_cache import MAINTENANCE_WINDOW_GENERATION_PARAMETER, bump_generation
+from patching_clients import get_client
+from patching_metrics import invocation_metrics
 
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
@@ -16,7 +18,8 @@ CH.setLevel(logging.INFO)
 FORMATTER = logging.Formatter(
     '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 CH.setFormatter(FORMATTER)
-LOGGER.addHandler(CH)
+if not LOGGER.handlers:
+    LOGGER.addHandler(CH)
 
 helper = CfnResource()
 
@@ -30,10 +33,11 @@ class CreateMaintenanceWindow(object):
         self.event = event
         self.context = context
         self.exception = []
-        self.ssm_client = boto3.client('ssm')
+        self.ssm_client = get_client('ssm')
         self.lambda_arn = os.environ["MW_TASK_LAMBDA_ARN"] 
         self.asg_lambda_arn = os.environ["MW_ASG_TASK_LAMBDA_ARN"] 
         self.service_role_arn = os.environ["SERVICE_ROLE_ARN"]
+        self.mw_cache_parameter = os.environ.get("MW_CACHE_PARAMETER", MAINTENANCE_WINDOW_GENERATION_PARAMETER)
         try:        
             self.resource_properties = event['ResourceProperties']
             self.env = self.resource_properties['Environment']
@@ -73,13 +77,17 @@ class CreateMaintenanceWindow(object):
                 AllowUnassociatedTargets=True,
             )
             window_id = response['WindowId']
+            self.invalidate_mw_cache()
             payload = {
                             "env": self.env,
                             "include_asg": self.include_asg,
                             "retain_healthy_percentage": self.retain_healthy_percentage,
                             "patching_operation": self.patching_operation,
                             "operation_post_patching": self.operation_post_patching,
-                            "run_patch_baseline_install_override_list": ""                            
+                            "run_patch_baseline_install_override_list": "",
+                            "window_duration": duration,
+                            "window_cutoff": 1,
+                            "window_execution_id": "{{WINDOW_EXECUTION_ID}}"
                             }
             response = self.ssm_client.register_task_with_maintenance_window(
                 WindowId=window_id,
@@ -100,7 +108,8 @@ class CreateMaintenanceWindow(object):
                                 "refresh_asg_instances": self.refresh_asg_instances,
                                 "patching_operation": self.patching_operation,
                                 "operation_post_patching": self.operation_post_patching,
-                                "run_patch_baseline_install_override_list": ""                            
+                                "run_patch_baseline_install_override_list": "",
+                                "window_execution_id": "{{WINDOW_EXECUTION_ID}}"
                                 }
                 response = self.ssm_client.register_task_with_maintenance_window(
                     WindowId=window_id,
@@ -119,16 +128,27 @@ class CreateMaintenanceWindow(object):
             status = "FAILED"
             return status, window_id      
 
+    def invalidate_mw_cache(self):
+        # Tag monitoring caches which environments have a maintenance window;
+        # a new generation makes it look the windows up again.
+        try:
+            bump_generation(self.ssm_client, self.mw_cache_parameter)
+        except Exception as exp:
+            LOGGER.warning('Unable to invalidate maintenance window cache %s', exp)
+
     def delete_maintenance_window_call(self,env): 
         try:
             response = self.ssm_client.describe_maintenance_windows(
                 Filters=[{'Key': 'Name', 'Values': [env+'_maintenance_window']}]
             )
-            for window in response['WindowIdentities']:
+            windows = response['WindowIdentities']
+            for window in windows:
                 window_id = window['WindowId']
                 response = self.ssm_client.delete_maintenance_window(
                     WindowId=window_id
                 )
+            if windows:
+                self.invalidate_mw_cache()
             status = "SUCCESS"
             return status        
         except Exception as exp:  
@@ -161,6 +181,7 @@ def maintenance_main(event,context):
         raise Exception(str(status))
 
 
+@invocation_metrics('CreateMaintenanceWindow')
 def lambda_handler(event,context):
     helper(event,context)
 
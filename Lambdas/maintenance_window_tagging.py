@@ -2,12 +2,19 @@
 # SPDX-License-Identifier: MIT-0
 
 import json
-import boto3
-from datetime import datetime
 import logging
 from crhelper import CfnResource
 import os
-from boto3.session import Session
+from patching_autoscaling import AutoScalingGroupIndex
+from patching_clients import get_client
+from patching_concurrency import get_max_workers, run_concurrently
+from patching_dryrun import DryRun
+from patching_eligibility import get_asg_exemption, get_instance_exemption
+from patching_metrics import invocation_metrics
+from patching_model import Instance
+from patching_tagging import (BulkTagger, CREATE_OR_UPDATE_TAGS_BATCH_SIZE, DEFAULT_CHUNK_SIZE, TAG_SUCCESS,
+                              TAG_UNCHANGED, asg_tag_list, chunk_list, group_tag_changes, summarize_tag_results,
+                              tag_list_from_items)
 
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
@@ -16,7 +23,8 @@ CH.setLevel(logging.INFO)
 FORMATTER = logging.Formatter(
     '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 CH.setFormatter(FORMATTER)
-LOGGER.addHandler(CH)
+if not LOGGER.handlers:
+    LOGGER.addHandler(CH)
 
 helper = CfnResource()
 
@@ -26,22 +34,22 @@ class TagInstances(object):
     # Description: Tagging instances in the child account
     """
 
-    def __init__(self, event, context):
+    def __init__(self, event, context, dry_run=None):
         self.event = event
         self.context = context
+        self.dry_run = dry_run
         self.exception = []
+        self.tag_results = {}
+        self.region_results = {}
         try:
             regions = os.environ["WORKLOAD_REGIONS"]
             self.regions = regions.split(",")            
+            self.max_region_workers = get_max_workers("MAX_CONCURRENT_REGIONS", len(self.regions))
             resource_properties = self.event['ResourceProperties']
             self.env = resource_properties['Environment']
-            self.supported_state_list = ['running'] #,'stopped','terminated']
+            self.supported_states = {'running'} #,'stopped','terminated'
             self.supported_env_list = [self.env] # to add var
             self.include_asg = resource_properties['IncludeASG']
-            self.supported_asg_list = ['null']
-            self.supported_patch_list = ['null']            
-            self.supported_eks_list = ['null']
-            self.supported_ecs_list = ['null']            
             print("resource_properties", resource_properties)
         except Exception as exception:
             self.reason_data = "Missing required property %s" % exception
@@ -49,29 +57,42 @@ class TagInstances(object):
             print("Failed in except block of __init__")
 
 
-    def get_instance_list(self,env):
-        try:
-            response = self.ec2_client.describe_instances(
-                            DryRun=False,
-                            MaxResults=1000,
-                            Filters=[
-                                {
-                                    'Name': 'tag:environment',
-                                    'Values': [env]
-                                }
-                            ])
-            instance_list_tmp = [r['Instances'] for r in response['Reservations']]
-            in_list = [val for sublist in instance_list_tmp for val in sublist]    
-            return in_list
-        except Exception as exception:
-            message = 'no instances in account '+str(exception)
-            print(message)
-            in_list = 'empty'
-            return in_list
+    def client(self, service, region):
+        """
+        Returns the region's client, recording calls instead of allowing
+        writes when this is a dry run.
+        """
+        client = get_client(service, region)
+        if self.dry_run is not None:
+            return self.dry_run.wrap(client, service)
+        return client
+
+    def get_instance_list(self,ec2_client,envs):
+        """
+        Yields Instance records for the instances tagged with any of the given
+        environments one describe_instances page at a time, so callers can filter and tag each
+        page before the next one is fetched. A failure on any page is raised,
+        so the region is reported as failed rather than as having no
+        instances.
+        """
+        paginator = ec2_client.get_paginator('describe_instances')
+        page_iterator = paginator.paginate(
+                        DryRun=False,
+                        Filters=[
+                            {
+                                'Name': 'tag:environment',
+                                'Values': list(envs)
+                            }
+                        ],
+                        PaginationConfig={'PageSize': 1000})
+        for page in page_iterator:
+            in_list = [Instance.from_response(instance) for reservation in page['Reservations'] for instance in reservation['Instances']]
+            if in_list:
+                yield in_list
 
-    def get_image_name(self,image_id):      
+    def get_image_name(self,ec2_client,image_id):      
         try:
-            response = self.ec2_client.describe_images(
+            response = ec2_client.describe_images(
                             DryRun=False,
                             ImageIds=image_id,
                             IncludeDeprecated=True)
@@ -82,204 +103,164 @@ class TagInstances(object):
             self.exception.append(str(exception))
             raise Exception(str(exception))
 
-    def build_instance_list(self, in_list):
-        instance_id = []
-        instance_state = []
-        instance_tags = []  
-        for i in in_list:
-            instance_id.append(i['InstanceId'])
-            instance_state.append(i['State']['Name'])
-            instance_tags.append(i['Tags'])
-        
-        instance_tag_asg = []
-        instance_tag_patch = []
-        instance_tag_eks = []
-        instance_tag_ecs = []
+    def filter_instances(self, instance_list):
+        filtered_instances = []
+        for instance in instance_list:
+            if instance.state not in self.supported_states:
+                continue
+            if get_instance_exemption(instance.tags) is None:
+                filtered_instances.append(instance)
+        return filtered_instances
 
-        for tags in instance_tags:
-            tag_key_tmp = [r['Key'] for r in tags]
-            tag_value_tmp = [r['Value'] for r in tags]
-            try:
-                i = tag_key_tmp.index('aws:autoscaling:groupName')
-                instance_tag_asg.append(tag_value_tmp[i])
-            except:
-                instance_tag_asg.append('null')
-            try:
-                i = tag_key_tmp.index('install_patch')
-                if tag_value_tmp[i]=='no' or tag_value_tmp[i]=='No':
-                    instance_tag_patch.append(tag_value_tmp[i])                    
-                else:
-                    instance_tag_patch.append('null')
-            except:
-                instance_tag_patch.append('null')
-            try:
-                i = tag_key_tmp.index('Alpha.eksctl.io/')
-                instance_tag_eks.append(tag_value_tmp[i])
-            except:
-                instance_tag_eks.append('null')
-            try:
-                i = tag_key_tmp.index('k8s.io/')
-                instance_tag_eks.append(tag_value_tmp[i])
-            except:
-                instance_tag_eks.append('null')
-            try:
-                i = tag_key_tmp.index('eks:')
-                instance_tag_eks.append(tag_value_tmp[i])
-            except:
-                instance_tag_eks.append('null')
-            try:
-                i = tag_key_tmp.index('kubernetes.io/')
-                instance_tag_eks.append(tag_value_tmp[i])
-            except:
-                instance_tag_eks.append('null')
-            try:
-                i = tag_key_tmp.index('AmazonECSManaged')
-                instance_tag_ecs.append('ecs')
-            except:
-                instance_tag_ecs.append('null')
-        return instance_id, instance_state, instance_tag_asg, instance_tag_patch, instance_tag_eks, instance_tag_ecs
+    def add_tags(self, ec2_client, id_list, tag_list):
+        results = BulkTagger(ec2_client).tag(id_list, tag_list)
+        failed = [instance_id for instance_id in results if results[instance_id] != TAG_SUCCESS]
+        if failed:
+            print('Failed to tag instances ' + json.dumps({instance_id: results[instance_id] for instance_id in failed}))
+        return results
 
-    def filter_list(self, tmp_list, filter_list):
-        filtered_list_indices=[]
-        for i in range(0, len(tmp_list)) :
-            if tmp_list[i] in filter_list:
-                filtered_list_indices.append(i)
-        return filtered_list_indices
-
-    def add_tags(self, id_list, tag_list):
-        try:
-            response = self.ec2_client.create_tags(
-                DryRun=False,
-                Resources=id_list,
-                Tags=tag_list
-                )
-            return response
-        except Exception as exception:
-            message = 'no instances to tag' +str(exception)
-            print(message)
-            return message  
+    def run_in_regions(self, region_function):
+        """
+        Runs region_function(region) for every workload region concurrently
+        and returns SUCCESS only when every region succeeded.
+        """
+        status = "SUCCESS"
+        for region, region_result, exception in run_concurrently(region_function, self.regions, self.max_region_workers):
+            if exception is not None:
+                print('Failed in region ' + region + ' ' + str(exception))
+                status = "FAILED"
+            else:
+                self.region_results[region] = region_result
+        return status
 
+    def get_desired_tags(self):
+        """
+        Returns {environment tag value: patching tags} for the resources this
+        request reconciles. Resources of a deleted or renamed environment go
+        back to the Default window.
+        """
+        default_tags = {'Patch Group': 'Default', 'maintenance_window': 'Default_maintenance_window'}
+        if self.event['RequestType'] == 'Delete':
+            return {self.env: default_tags}
+        desired_tags = {self.env: {'Patch Group': self.env, 'maintenance_window': self.env+'_maintenance_window'}}
+        if self.event['RequestType'] == 'Update':
+            old_env = self.event['OldResourceProperties']['Environment']
+            if old_env != self.env:
+                desired_tags[old_env] = default_tags
+        return desired_tags
 
-    def tag_instances_main(self,env,old_env=False):
+    def tag_region_instances(self, region, desired_tags):
+        ec2_client = self.client('ec2',region)
+        region_results = {}
         try:
-            for region in self.regions:
-                self.ec2_client = boto3.client('ec2',region_name=region)
-                self.as_client = boto3.client('autoscaling',region_name=region)                
-                instance_list = self.get_instance_list(env)
-                if instance_list != 'empty':
-                    [instance_id, instance_state, instance_tag_asg, instance_tag_patch, instance_tag_eks, instance_tag_ecs] = self.build_instance_list(instance_list)
-
-                    ind_state = self.filter_list(instance_state, self.supported_state_list)
-                    ind_patch = self.filter_list(instance_tag_patch, self.supported_patch_list)
-                    ind_asg = self.filter_list(instance_tag_asg, self.supported_asg_list)
-                    ind_eks = self.filter_list(instance_tag_eks, self.supported_eks_list)
-                    ind_ecs = self.filter_list(instance_tag_ecs, self.supported_ecs_list)
-
-                    ind_state_patch = list(set(ind_state).intersection(ind_patch))
-                    ind_state_patch_asg = list(set(ind_state_patch).intersection(ind_asg))
-                    ind_state_patch_asg_eks = list(set(ind_state_patch_asg).intersection(ind_eks))
-                    ind_state_patch_asg_eks_ecs = list(set(ind_state_patch_asg_eks).intersection(ind_ecs))
-
-                    combined_ind = ind_state_patch_asg_eks_ecs
-                    
-                    filtered_instance_id = [instance_id[i] for i in combined_ind]
+            for instance_list in self.get_instance_list(ec2_client, desired_tags):
+                tag_groups, unchanged = group_tag_changes(
+                    (instance.instance_id, instance.tags, desired_tags.get(instance.tags.get('environment'), {}))
+                    for instance in self.filter_instances(instance_list))
+                region_results.update(dict.fromkeys(unchanged, TAG_UNCHANGED))
+                for tag_items, instance_ids in tag_groups.items():
+                    if self.dry_run is not None:
+                        self.dry_run.plan_change(Region=region, ResourceType='instance', Tags=dict(tag_items), Resources=instance_ids)
+                        self.dry_run.count_write('ec2.create_tags', len(instance_ids), DEFAULT_CHUNK_SIZE)
+                        continue
+                    region_results.update(self.add_tags(ec2_client, instance_ids, tag_list_from_items(tag_items)))
+        except Exception:
+            # The instances tagged before the failure still count; the region
+            # is reported as failed by run_in_regions.
+            self.region_results[region] = region_results
+            raise
+        return region_results
 
-                    if self.event['RequestType'] == 'Delete' or old_env==True:
-                        tag_list =  [{'Key': 'Patch Group','Value': 'Default'},{'Key': 'maintenance_window','Value': 'Default_maintenance_window'}]                        
-                    else:
-                        tag_list =  [{'Key': 'Patch Group','Value': self.env},{'Key': 'maintenance_window','Value': self.env+'_maintenance_window'}]                        
-                    if filtered_instance_id:
-                        response = self.add_tags(filtered_instance_id, tag_list)
-
-            status = "SUCCESS"                
+    def tag_instances_main(self,desired_tags):
+        try:
+            self.region_results = {}
+            status = self.run_in_regions(lambda region: self.tag_region_instances(region, desired_tags))
+            for region_results in self.region_results.values():
+                self.tag_results.update(region_results)
             return status
         except Exception as exp:
             status = "FAILED"                
             return status
 
 
-    def get_asg_list(self,env):
+    def get_asg_list(self,as_client,envs):
         try:
-            response = self.as_client.describe_auto_scaling_groups()
-            asg_name=[]
-            for group in response['AutoScalingGroups']:
-                is_exempt = False
-                for tags in group['Tags']:
-                    if ('k8s.io/' in tags['Key']) or ('eks:' in tags['Key']) or ('kubernetes.io/' in tags['Key']) or (tags['Key'] == 'install_patch' and tags['Value'].lower() == 'no')  or ('ecs' in tags['Key']) or ('ECS' in tags['Key']) or ('ecs' in tags['Value']) or ('ECS' in tags['Value']):
-                        is_exempt = True
-                if is_exempt==False:
-                    for tags in group['Tags']:
-                        if tags['Key'] == 'environment' and tags['Value'] == env:
-                            asg_name.append(group['AutoScalingGroupName'])
+            asg_index = AutoScalingGroupIndex.build(as_client, 'environment', list(envs))
+            asg_list=[]
+            for env in envs:
+                for group in asg_index.get(env):
+                    if get_asg_exemption(group.tags) is None:
+                        asg_list.append(group)
                                             
-            return asg_name
+            return asg_list
 
         except Exception as exp:  
             print('No such ASG '+str(exp))
+            raise
+
 
+    def tag_region_asgs(self, region, desired_tags):
+        as_client = self.client('autoscaling',region)
+        tag_groups, unchanged = group_tag_changes(
+            (group.name, group.tags, desired_tags[group.tags['environment']])
+            for group in self.get_asg_list(as_client, desired_tags))
+        asg_name = []
+        for tag_items, group_names in tag_groups.items():
+            if self.dry_run is not None:
+                self.dry_run.plan_change(Region=region, ResourceType='auto-scaling-group', Tags=dict(tag_items), Resources=group_names)
+                self.dry_run.count_write('autoscaling.create_or_update_tags', len(group_names), CREATE_OR_UPDATE_TAGS_BATCH_SIZE)
+                continue
+            for chunk in chunk_list(group_names, CREATE_OR_UPDATE_TAGS_BATCH_SIZE):
+                as_client.create_or_update_tags(Tags=asg_tag_list(chunk, tag_items))
+                asg_name.extend(chunk)
+        return asg_name
 
-    def tag_asg_main(self,env,old_env=False):
+    def tag_asg_main(self,desired_tags):
         try:
-            for region in self.regions:
-                self.as_client = boto3.client('autoscaling',region_name=region)
-                self.ec2_client = boto3.client('ec2',region_name=region)                
-                asg_name = self.get_asg_list(env)
-                if self.event['RequestType'] == 'Delete' or old_env == True:
-                    tag_env = 'Default'
-                else:
-                    tag_env = self.env
-                for filtered_asg_name in asg_name:
-                    response = self.as_client.create_or_update_tags(
-                        Tags=[
-                            {
-                                'ResourceId': filtered_asg_name,
-                                'ResourceType': 'auto-scaling-group',
-                                'Key': 'Patch Group',
-                                'Value': tag_env,
-                                'PropagateAtLaunch': False
-                            },        
-                            {
-                                'ResourceId': filtered_asg_name,
-                                'ResourceType': 'auto-scaling-group',
-                                'Key': 'maintenance_window',
-                                'Value': tag_env+'_maintenance_window',
-                                'PropagateAtLaunch': False
-                            }
-                        ]
-                    )
-            status = "SUCCESS"                
-            return status
+            self.region_results = {}
+            return self.run_in_regions(lambda region: self.tag_region_asgs(region, desired_tags))
         except Exception as exp:
             status = "FAILED"                
             return status            
 
 
+def run_tagging(tag_instances, event):
+    # Renamed environments are reconciled in the same pass as the new one.
+    desired_tags = tag_instances.get_desired_tags()
+    status  = tag_instances.tag_instances_main(desired_tags)
+    if status=='SUCCESS' and event['ResourceProperties']['IncludeASG'] == 'Yes':
+        status = tag_instances.tag_asg_main(desired_tags)
+    return status
+
+def plan_tagging(event, context):
+    """
+    Runs the discovery and filtering of a Create, Update or Delete request
+    without tagging anything and returns the tags that would be written.
+    """
+    dry_run = DryRun()
+    tag_instances = TagInstances(event,context,dry_run)
+    status = run_tagging(tag_instances, event)
+    plan = dry_run.as_dict()
+    plan['TaggingStatus'] = status
+    plan['DesiredTags'] = tag_instances.get_desired_tags()
+    plan['UnchangedInstanceCount'] = summarize_tag_results(tag_instances.tag_results)['UnchangedCount']
+    return plan
+
 @helper.create
 @helper.update
 @helper.delete
 def instance_asg_tagging_main(event, context):
     tag_instances = TagInstances(event,context)
-    env = event['ResourceProperties']['Environment']
-    if event['RequestType'] == 'Delete':
-        status  = tag_instances.tag_instances_main(env)
-        if status=='SUCCESS' and event['ResourceProperties']['IncludeASG'] == 'Yes':
-            status = tag_instances.tag_asg_main(env)
-    elif event['RequestType'] == 'Update':
-        old_env = event['OldResourceProperties']['Environment']    
-        env = event['ResourceProperties']['Environment']
-        if old_env!=env:
-            status = tag_instances.tag_instances_main(old_env,True)
-            if status=='SUCCESS' and event['ResourceProperties']['IncludeASG'] == 'Yes':
-                status = tag_instances.tag_asg_main(old_env,True)            
-        status  = tag_instances.tag_instances_main(env)
-        if status=='SUCCESS' and event['ResourceProperties']['IncludeASG'] == 'Yes':
-            status = tag_instances.tag_asg_main(env)
-    elif event['RequestType'] == 'Create':
-        status  = tag_instances.tag_instances_main(env)
-        if status=='SUCCESS' and event['ResourceProperties']['IncludeASG'] == 'Yes':
-            status = tag_instances.tag_asg_main(env)
+    status = run_tagging(tag_instances, event)
     helper.Data['TaggingStatus'] = status
+    tagging_summary = summarize_tag_results(tag_instances.tag_results)
+    helper.Data['TaggedInstanceCount'] = tagging_summary['TaggedCount']
+    helper.Data['UnchangedInstanceCount'] = tagging_summary['UnchangedCount']
+    helper.Data['FailedInstanceCount'] = tagging_summary['FailedCount']
+    helper.Data['FailedInstances'] = tagging_summary['Failed']
 
+@invocation_metrics('TagInstances')
 def lambda_handler(event, context):
+    if event.get('dry_run'):
+        return plan_tagging(event, context)
     helper(event,context)
-
@@ -1,32 +1,73 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-import boto3
 import os
-import string
-import uuid
-from boto3.session import Session
+from patching_clients import get_account_id, get_client
+from patching_concurrency import run_concurrently
+from patching_dryrun import DryRun
+from patching_metrics import invocation_metrics
+from patching_overrides import stage_override_list
+from patching_planner import (DEFAULT_WINDOW_CUTOFF_HOURS, DEFAULT_WINDOW_HOURS, INSTALL_MINUTES_PER_WAVE,
+                              SCAN_MINUTES_PER_WAVE, count_targets, default_plan, plan_concurrency)
+from patching_tracking import execution_record, execution_tags, get_run_scope, get_snapshot_id, new_run_id
 
-ssm = boto3.client('ssm')
-sts = boto3.client('sts')
-ec2 = boto3.client('ec2')
 
+def plan_run(event, env, regions, dry_run=None):
+    """
+    Sizes the run from the number of targeted instances in each region and
+    the length of the maintenance window that invoked the task.
+    """
+    def count_region(region):
+        ec2_client = get_client('ec2', region)
+        if dry_run is not None:
+            ec2_client = dry_run.wrap(ec2_client, 'ec2')
+        return count_targets(ec2_client, env)
+
+    fleet_sizes = {}
+    for region, size, exception in run_concurrently(count_region, regions, len(regions)):
+        if exception is not None:
+            print('Unable to count instances in ' + region + ' ' + str(exception))
+            return default_plan(regions)
+        fleet_sizes[region] = size
+    minutes_per_wave = SCAN_MINUTES_PER_WAVE if event['patching_operation'] == 'Scan' else INSTALL_MINUTES_PER_WAVE
+    plan = plan_concurrency(
+        fleet_sizes,
+        window_hours=int(event.get('window_duration', DEFAULT_WINDOW_HOURS)),
+        cutoff_hours=int(event.get('window_cutoff', DEFAULT_WINDOW_CUTOFF_HOURS)),
+        minutes_per_wave=minutes_per_wave)
+    print('Fleet ' + str(fleet_sizes) + ' plan ' + str(plan))
+    plan['FleetSizes'] = fleet_sizes
+    return plan
+
+
+@invocation_metrics('MaintenanceWindowTask')
 def lambda_handler(event,context):
+    ssm = get_client('ssm')
     env = event['env']
-    TargetAccountsArray = sts.get_caller_identity()['Account']
-    session = Session()
-    #TargetRegionIdsArray = session.get_available_regions('ec2')
+    TargetAccountsArray = get_account_id()
     regions = os.environ["WORKLOAD_REGIONS"]
     TargetRegionIdsArray = regions.split(",")
     RunPatchBaselineOperation=event['patching_operation']
     RunPatchBaselineRebootOption=event['operation_post_patching']
     RunPatchBaselineInstallOverrideList=event['run_patch_baseline_install_override_list']
-    TargetLocationMaxConcurrency='5'
-    TargetLocationMaxErrors='13'
     ExecutionRoleName = os.environ["EXECUTION_ROLE_NAME"]
     AdministrationRoleName = os.environ["ADMINISTRATION_ROLE_NAME"]
     DocumentName = os.environ["DOCUMENT_NAME"]
     ResourceGroupKey = 'tag:maintenance_window'
+    run_id = event.get('run_id') or new_run_id()
+    snapshot_id = get_snapshot_id(get_run_scope(event, run_id), env)
+    # A dry run sizes the run and returns the automation it would start.
+    dry_run = DryRun() if event.get('dry_run') else None
+    plan = plan_run(event, env, TargetRegionIdsArray, dry_run)
+    if not plan['Regions']:
+        print('No instances to patch in ' + env + '_maintenance_window')
+        if dry_run is not None:
+            return dict(dry_run.as_dict(), Plan=plan)
+        return {'RunId': run_id, 'Executions': []}
+    TargetRegionIdsArray = plan['Regions']
+    RunPatchBaselineInstallOverrideList = stage_override_list(RunPatchBaselineInstallOverrideList, dry_run=dry_run)
+    TargetLocationMaxConcurrency = plan['TargetLocationMaxConcurrency']
+    TargetLocationMaxErrors = plan['TargetLocationMaxErrors']
 
     if len(RunPatchBaselineInstallOverrideList) > 0:
         parms = {
@@ -34,7 +75,7 @@ def lambda_handler(event,context):
             'Operation' : [f'{RunPatchBaselineOperation}'],
             'RebootOption' : [f'{RunPatchBaselineRebootOption}'],
             'InstallOverrideList' : [f'{RunPatchBaselineInstallOverrideList}'],
-            'SnapshotId' : [str(uuid.uuid4())],
+            'SnapshotId' : [snapshot_id],
             'ResourceGroupKey' : [ResourceGroupKey],
             'ResourceGroupName' : [f'{env}_maintenance_window']
         }
@@ -43,22 +84,34 @@ def lambda_handler(event,context):
             'AutomationAssumeRole': [f'arn:aws:iam::{TargetAccountsArray}:role/{AdministrationRoleName}'],
             'Operation' : [f'{RunPatchBaselineOperation}'],
             'RebootOption' : [f'{RunPatchBaselineRebootOption}'],
-            'SnapshotId' : [str(uuid.uuid4())],
+            'SnapshotId' : [snapshot_id],
             'ResourceGroupKey' : [ResourceGroupKey],
             'ResourceGroupName' : [f'{env}_maintenance_window']
         }
 
+    parms['MaximumConcurrency'] = [plan['MaximumConcurrency']]
+
+    target_locations = [
+        {
+            'Accounts': [TargetAccountsArray],
+            'Regions': TargetRegionIdsArray,
+            'TargetLocationMaxConcurrency': f'{TargetLocationMaxConcurrency}',
+            'TargetLocationMaxErrors': f'{TargetLocationMaxErrors}',
+            'ExecutionRoleName': f'{ExecutionRoleName}'
+        }
+    ]
+    if dry_run is not None:
+        dry_run.plan_change(DocumentName=DocumentName, Parameters=parms, TargetLocations=target_locations)
+        dry_run.count_write('ssm.start_automation_execution')
+        return dict(dry_run.as_dict(), Plan=plan)
+
     response = ssm.start_automation_execution(
         DocumentName=f'{DocumentName}',
         Parameters=parms,
-        TargetLocations=[
-            {
-                'Accounts': [TargetAccountsArray],
-                'Regions': TargetRegionIdsArray,
-                'TargetLocationMaxConcurrency': f'{TargetLocationMaxConcurrency}',
-                'TargetLocationMaxErrors': f'{TargetLocationMaxErrors}',
-                'ExecutionRoleName': f'{ExecutionRoleName}'
-            }
-        ]
+        TargetLocations=target_locations,
+        Tags=execution_tags(run_id, env)
     )
-    print(response)
\ No newline at end of file
+    print(response)
+    execution = execution_record(response['AutomationExecutionId'], run_id, ssm.meta.region_name,
+                                 TargetAccountsArray, TargetRegionIdsArray, env)
+    return {'RunId': run_id, 'SnapshotId': snapshot_id, 'Executions': [execution]}
\ No newline at end of file
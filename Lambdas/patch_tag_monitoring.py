@@ -2,10 +2,15 @@
 # SPDX-License-Identifier: MIT-0
 
 import json
-import boto3
-from datetime import datetime
 import logging
 import os
+from patching_cache import MAINTENANCE_WINDOW_GENERATION_PARAMETER, TTLCache, get_generation
+from patching_clients import get_client
+from patching_eligibility import get_asg_exemption, get_instance_exemption
+from patching_metrics import invocation_metrics
+from patching_model import AutoScalingGroup, Instance
+from patching_tagging import (BulkTagger, CREATE_OR_UPDATE_TAGS_BATCH_SIZE, NOT_FOUND_ERROR_CODES, TAG_SUCCESS,
+                              asg_tag_list, chunk_list, get_tag_changes, group_tag_changes, tag_list_from_items)
 
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
@@ -14,7 +19,24 @@ CH.setLevel(logging.INFO)
 FORMATTER = logging.Formatter(
     '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 CH.setFormatter(FORMATTER)
-LOGGER.addHandler(CH)
+if not LOGGER.handlers:
+    LOGGER.addHandler(CH)
+
+# Maintenance window existence per environment is cached across warm
+# invocations. The creation Lambda bumps the generation parameter whenever it
+# creates or deletes a window, which drops the cache within
+# MW_CACHE_GENERATION_CHECK_SECONDS.
+MW_CACHE_TTL_SECONDS = int(os.environ.get("MW_CACHE_TTL_SECONDS", "300"))
+MW_NEGATIVE_CACHE_TTL_SECONDS = int(os.environ.get("MW_NEGATIVE_CACHE_TTL_SECONDS", "60"))
+MW_CACHE_GENERATION_CHECK_SECONDS = int(os.environ.get("MW_CACHE_GENERATION_CHECK_SECONDS", "60"))
+MW_CACHE_PARAMETER = os.environ.get("MW_CACHE_PARAMETER", MAINTENANCE_WINDOW_GENERATION_PARAMETER)
+# Batch mode (SQS records) limits: instance-id filter values per
+# describe_instances call and names per describe_auto_scaling_groups call.
+DESCRIBE_INSTANCES_BATCH_SIZE = 200
+DESCRIBE_ASGS_BATCH_SIZE = 50
+MAINTENANCE_WINDOW_CACHE = TTLCache(
+    generation_loader=lambda: get_generation(get_client('ssm', os.environ["PATCHING_TEMPLATE_REGION"]), MW_CACHE_PARAMETER),
+    generation_check_interval=MW_CACHE_GENERATION_CHECK_SECONDS)
 
 class TagInstances(object):
     """
@@ -24,104 +46,61 @@ class TagInstances(object):
     def __init__(self, event, context):
         self.event = event
         self.context = context
-        self.ec2_client = boto3.client('ec2')
-        self.as_client = boto3.client('autoscaling')
+        self.ec2_client = get_client('ec2')
+        self.as_client = get_client('autoscaling')
         patching_template_region = os.environ["PATCHING_TEMPLATE_REGION"]
-        self.ssm_client = boto3.client('ssm', region_name=patching_template_region)
+        self.ssm_client = get_client('ssm', patching_template_region)
         try:
             self.supported_env_list = ['Default','Dev','Test','Prod'] 
-            self.supported_asg_list = ['null']
-            self.supported_patch_list = ['null']            
-            self.supported_eks_list = ['null']
-            self.supported_ecs_list = ['null']
         except Exception as exception:
             self.reason_data = "Missing required property %s" % exception
             LOGGER.error(self.reason_data)
             print("Failed in except block of __init__")
 
     def get_instance_list(self,instance_id):      
-        try:
-            response = self.ec2_client.describe_instances(InstanceIds=[instance_id])
-            try:
-                tags = response['Reservations'][0]['Instances'][0]['Tags']
-            except:
-                tags = 'empty'
-            return tags
-        except Exception as exception:
-            message = 'no instances in account'+str(exception)
-            print(message)
-            return message
-
-    def build_instance_list(self, instance_tags): 
-        instance_tag_env = []
-        instance_tag_asg = []
-        instance_tag_patch = []
-        instance_tag_eks = []
-        instance_tag_ecs = []
-        tag_key_tmp = [r['Key'] for r in instance_tags]
-        tag_value_tmp = [r['Value'] for r in instance_tags]
-        try:
-            i = tag_key_tmp.index('environment')
-            instance_tag_env.append(tag_value_tmp[i])
-            self.env = tag_value_tmp[i]
-        except:
-            instance_tag_env.append('null')
-            self.env = 'null'
-        try:
-            i = tag_key_tmp.index('aws:autoscaling:groupName')
-            instance_tag_asg.append(tag_value_tmp[i])
-        except:
-            instance_tag_asg.append('null')
-        try:
-            i = tag_key_tmp.index('install_patch')
-            if tag_value_tmp[i]=='no' or tag_value_tmp[i]=='No':
-                instance_tag_patch.append(tag_value_tmp[i])
-            else:
-                instance_tag_patch.append('null')
-        except:
-            instance_tag_patch.append('null')
-        try:
-            i = tag_key_tmp.index('Alpha.eksctl.io/')
-            instance_tag_eks.append(tag_value_tmp[i])
-        except:
-            instance_tag_eks.append('null')
-        try:
-            i = tag_key_tmp.index('k8s.io/')
-            instance_tag_eks.append(tag_value_tmp[i])
-        except:
-            instance_tag_eks.append('null')
-        try:
-            i = tag_key_tmp.index('eks:')
-            instance_tag_eks.append(tag_value_tmp[i])
-        except:
-            instance_tag_eks.append('null')
-        try:
-            i = tag_key_tmp.index('kubernetes.io/')
-            instance_tag_eks.append(tag_value_tmp[i])
-        except:
-            instance_tag_eks.append('null')
-        try:
-            i = tag_key_tmp.index('AmazonECSManaged')
-            instance_tag_ecs.append('ecs')
-        except:
-            instance_tag_ecs.append('null')
+        response = self.ec2_client.describe_instances(InstanceIds=[instance_id])
+        return Instance.from_response(response['Reservations'][0]['Instances'][0])
 
-        return instance_tag_env, instance_tag_asg, instance_tag_patch, instance_tag_eks, instance_tag_ecs
+    def describe_instances_batch(self, instance_ids):
+        """
+        Yields an Instance record for every instance in instance_ids that
+        still exists, using one paginated describe_instances call per
+        DESCRIBE_INSTANCES_BATCH_SIZE IDs.
+        """
+        paginator = self.ec2_client.get_paginator('describe_instances')
+        for chunk in chunk_list(instance_ids, DESCRIBE_INSTANCES_BATCH_SIZE):
+            page_iterator = paginator.paginate(Filters=[{'Name': 'instance-id', 'Values': chunk}])
+            for page in page_iterator:
+                for reservation in page['Reservations']:
+                    for instance in reservation['Instances']:
+                        yield Instance.from_response(instance)
 
     def add_tags(self, id_list, tag_list):
-        try:
-            response = self.ec2_client.create_tags(
-                DryRun=False,
-                Resources=id_list,
-                Tags=tag_list
-                )
-            return response
-        except Exception as exception:
-            message = 'no instances to tag' +str(exception)
-            print(message)
-            return message  
+        results = BulkTagger(self.ec2_client).tag(id_list, tag_list)
+        failed = {instance_id for instance_id in results if results[instance_id] != TAG_SUCCESS and results[instance_id] not in NOT_FOUND_ERROR_CODES}
+        if failed:
+            print('Failed to tag instances ' + json.dumps({instance_id: results[instance_id] for instance_id in failed}))
+        return failed
+
+    def add_asg_tags(self, asg_names, tag_items):
+        failed = set()
+        for chunk in chunk_list(asg_names, CREATE_OR_UPDATE_TAGS_BATCH_SIZE):
+            try:
+                self.as_client.create_or_update_tags(Tags=asg_tag_list(chunk, tag_items))
+            except Exception as exp:
+                print('Failed to tag ASGs ' + ','.join(chunk) + ' ' + str(exp))
+                failed.update(chunk)
+        return failed
 
     def check_mw(self,env):
+        exists = MAINTENANCE_WINDOW_CACHE.get(env)
+        if exists is None:
+            exists = self.describe_mw(env)
+            ttl = MW_CACHE_TTL_SECONDS if exists else MW_NEGATIVE_CACHE_TTL_SECONDS
+            MAINTENANCE_WINDOW_CACHE.set(env, exists, ttl)
+        return exists
+
+    def describe_mw(self,env):
         response = self.ssm_client.describe_maintenance_windows(
                 Filters=[{'Key': 'Name', 'Values': [env+'_maintenance_window']}]
             )
@@ -133,119 +112,144 @@ class TagInstances(object):
             print('No maintenace window for environment ' + env)
             return False
 
+    def get_env_tags(self, env):
+        if self.check_mw(env):
+            return {'Patch Group': env, 'maintenance_window': env+'_maintenance_window'}
+        elif (env in self.supported_env_list):
+            return {'Patch Group': 'Default', 'maintenance_window': 'Default_maintenance_window'}
+        else:
+            return {'environment': 'Default', 'Patch Group': 'Default', 'maintenance_window': 'Default_maintenance_window'}
+
+    def get_instance_tags(self, tags):
+        """
+        Returns the patching tags an instance should carry, or None when it is
+        exempt.
+        """
+        if not tags:
+            return {'environment': 'Default', 'Patch Group': 'Default', 'maintenance_window': 'Default_maintenance_window'}
+        if get_instance_exemption(tags) is not None:
+            return None
+        return self.get_env_tags(tags.get('environment', 'null'))
+
+    def get_asg_tags(self, tags):
+        """
+        Returns the patching tags an ASG should carry, or None when it is
+        exempt.
+        """
+        if get_asg_exemption(tags) is not None:
+            return None
+        env = 'null'
+        if tags.get('environment') in self.supported_env_list:
+            env = tags['environment']
+        return self.get_env_tags(env)
+
     def tag_instances_main(self,instance_id):
         try:
-            tags = self.get_instance_list(instance_id)
-            if tags != 'empty':
-                [instance_tag_env, instance_tag_asg, instance_tag_patch, instance_tag_eks, instance_tag_ecs] = self.build_instance_list(tags)
-                if any(s in instance_tag_patch for s in self.supported_patch_list) and any(s in instance_tag_asg for s in self.supported_asg_list) and any(s in instance_tag_eks for s in self.supported_eks_list) and any(s in instance_tag_ecs for s in self.supported_ecs_list):
-                    if self.check_mw(self.env):
-                        tag_list =  [{'Key': 'Patch Group','Value': self.env},{'Key': 'maintenance_window','Value': self.env+'_maintenance_window'}]
-                    elif (self.env in self.supported_env_list):
-                        tag_list =  [{'Key': 'Patch Group','Value': 'Default'},{'Key': 'maintenance_window','Value': 'Default_maintenance_window'}]
-                    else:
-                        tag_list =  [{'Key': 'environment','Value': 'Default'},{'Key': 'Patch Group','Value': 'Default'},{'Key': 'maintenance_window','Value': 'Default_maintenance_window'}]
-                response = self.add_tags([instance_id], tag_list)
-                
-            else:
-                tag_list =  [{'Key': 'environment','Value': 'Default'},{'Key': 'Patch Group','Value': 'Default'},{'Key': 'maintenance_window','Value': 'Default_maintenance_window'}]
-            response = self.add_tags([instance_id], tag_list)
-
+            instance = self.get_instance_list(instance_id)
+            desired_tags = self.get_instance_tags(instance.tags)
+            if desired_tags is not None:
+                changes = get_tag_changes(instance.tags, desired_tags)
+                if changes:
+                    self.add_tags([instance_id], tag_list_from_items(sorted(changes.items())))
+                else:
+                    print('Tags of ' + instance_id + ' are up to date')
         except Exception as exp:
             print(str(exp))
 
-    def get_asg_list(self,target_asg):
-        try:
-            response = self.as_client.describe_auto_scaling_groups(AutoScalingGroupNames=[target_asg])
-            exempt = False
-            for tags in response['AutoScalingGroups'][0]['Tags']:
-                if ('k8s.io/' in tags['Key']) or ('eks:' in tags['Key']) or ('kubernetes.io/' in tags['Key']) or (tags['Key'] == 'install_patch' and tags['Value'].lower() == 'no')  or ('ecs' in tags['Key']) or ('ECS' in tags['Key']) or ('ecs' in tags['Value']) or ('ECS' in tags['Value']):
-                    exempt = True
-            if exempt==False:
-                self.env = 'null'
-                for tags in response['AutoScalingGroups'][0]['Tags']:
-                    if tags['Key'] == 'environment' and tags['Value'] in self.supported_env_list:
-                        self.env = tags['Value']
-                     
-            return exempt
-
-
-        except Exception as exp:  
-            print('No such ASG '+str(exp))
-
     def tag_asg_main(self,asg_name):
         try:
-            exempt = self.get_asg_list(asg_name)
-            if exempt == False:
-                if self.check_mw(self.env):
-                    response = self.as_client.create_or_update_tags(
-                        Tags=[
-                            {
-                                'ResourceId': asg_name,
-                                'ResourceType': 'auto-scaling-group',
-                                'Key': 'Patch Group',
-                                'Value': self.env,
-                                'PropagateAtLaunch': False
-                            },       
-                            {
-                                'ResourceId': asg_name,
-                                'ResourceType': 'auto-scaling-group',
-                                'Key': 'maintenance_window',
-                                'Value': self.env+'_maintenance_window',
-                                'PropagateAtLaunch': False
-                            }
-                        ]
-                    )
-                elif (self.env in self.supported_env_list):
-                    response = self.as_client.create_or_update_tags(
-                        Tags=[
-                            {
-                                'ResourceId': asg_name,
-                                'ResourceType': 'auto-scaling-group',
-                                'Key': 'Patch Group',
-                                'Value': 'Default',
-                                'PropagateAtLaunch': False
-                            },       
-                            {
-                                'ResourceId': asg_name,
-                                'ResourceType': 'auto-scaling-group',
-                                'Key': 'maintenance_window',
-                                'Value': 'Default_maintenance_window',
-                                'PropagateAtLaunch': False
-                            }
-                        ]
-                    )
+            response = self.as_client.describe_auto_scaling_groups(AutoScalingGroupNames=[asg_name])
+            group = AutoScalingGroup.from_response(response['AutoScalingGroups'][0])
+            desired_tags = self.get_asg_tags(group.tags)
+            if desired_tags is not None:
+                changes = get_tag_changes(group.tags, desired_tags)
+                if changes:
+                    self.add_asg_tags([asg_name], sorted(changes.items()))
                 else:
-                    response = self.as_client.create_or_update_tags(
-                        Tags=[
-                            {
-                                'ResourceId': asg_name,
-                                'ResourceType': 'auto-scaling-group',
-                                'Key': 'environment',
-                                'Value': 'Default',
-                                'PropagateAtLaunch': False
-                            },                           
-                            {
-                                'ResourceId': asg_name,
-                                'ResourceType': 'auto-scaling-group',
-                                'Key': 'Patch Group',
-                                'Value': 'Default',
-                                'PropagateAtLaunch': False
-                            },       
-                            {
-                                'ResourceId': asg_name,
-                                'ResourceType': 'auto-scaling-group',
-                                'Key': 'maintenance_window',
-                                'Value': 'Default_maintenance_window',
-                                'PropagateAtLaunch': False
-                            }
-                        ]
-                    )
+                    print('Tags of ' + asg_name + ' are up to date')
         except Exception as exp:
-            print(str(exp))            
+            print(str(exp))
+
+    def tag_instances_batch(self, instance_ids):
+        """
+        Tags the instances of a batch whose patching tags differ from the ones
+        they should carry, grouped by the change so every distinct change
+        costs one chunked create_tags. Returns the IDs that could not be
+        tagged.
+        """
+        tag_groups, unchanged = group_tag_changes(
+            (instance.instance_id, instance.tags, desired_tags)
+            for instance in self.describe_instances_batch(instance_ids)
+            for desired_tags in [self.get_instance_tags(instance.tags)] if desired_tags is not None)
+        failed = set()
+        for tag_items, group_ids in tag_groups.items():
+            failed.update(self.add_tags(group_ids, tag_list_from_items(tag_items)))
+        return failed
+
+    def tag_asgs_batch(self, asg_names):
+        """
+        Tags the ASGs of a batch whose patching tags differ, grouped by the
+        change, and returns the names that could not be tagged.
+        """
+        groups = []
+        failed = set()
+        paginator = self.as_client.get_paginator('describe_auto_scaling_groups')
+        for chunk in chunk_list(asg_names, DESCRIBE_ASGS_BATCH_SIZE):
+            try:
+                for page in paginator.paginate(AutoScalingGroupNames=chunk):
+                    groups.extend(AutoScalingGroup.from_response(group) for group in page['AutoScalingGroups'])
+            except Exception as exp:
+                print('Failed to describe ASGs ' + str(exp))
+                failed.update(chunk)
+        tag_groups, unchanged = group_tag_changes(
+            (group.name, group.tags, desired_tags)
+            for group in groups
+            for desired_tags in [self.get_asg_tags(group.tags)] if desired_tags is not None)
+        for tag_items, group_names in tag_groups.items():
+            failed.update(self.add_asg_tags(group_names, tag_items))
+        return failed
+
+    def process_batch(self, records):
+        """
+        Handles SQS records carrying Config compliance change events. Resource
+        IDs are deduplicated across the batch and only the messages whose
+        resource failed to tag are reported back for retry.
+        """
+        instance_messages = {}
+        asg_messages = {}
+        for record in records:
+            try:
+                detail = json.loads(record['body'])['detail']
+                resourceType = detail['resourceType'].split("::")[1]
+                if resourceType == 'EC2':
+                    instance_messages.setdefault(detail['resourceId'], []).append(record['messageId'])
+                elif resourceType == 'AutoScaling':
+                    asg_messages.setdefault(detail['resourceId'].split("/")[1], []).append(record['messageId'])
+            except (KeyError, IndexError, ValueError) as exp:
+                # A malformed event never succeeds, so it is not retried.
+                print('Skipping malformed message ' + str(record.get('messageId')) + ' ' + str(exp))
+        print('Batch of ' + str(len(records)) + ' events for ' + str(len(instance_messages)) + ' instances and ' + str(len(asg_messages)) + ' ASGs')
+
+        failed_messages = set()
+        if instance_messages:
+            try:
+                failed_instances = self.tag_instances_batch(list(instance_messages))
+            except Exception as exp:
+                print('Failed to describe instances ' + str(exp))
+                failed_instances = set(instance_messages)
+            for instance_id in failed_instances:
+                failed_messages.update(instance_messages[instance_id])
+        if asg_messages:
+            for asg_name in self.tag_asgs_batch(list(asg_messages)):
+                failed_messages.update(asg_messages[asg_name])
+        return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in sorted(failed_messages)]}
 
+@invocation_metrics('PatchTagMonitoring')
 def lambda_handler(event, context):
     tag_instances = TagInstances(event,context)
+    if 'Records' in event:
+        print("Given batch of " + str(len(event['Records'])) + " records")
+        return tag_instances.process_batch(event['Records'])
     resourceType = event['detail']['resourceType'].split("::")[1]
     if resourceType == 'EC2':
         print("Given resourceType is EC2")
@@ -0,0 +1,139 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import logging
+import threading
+import time
+from botocore.exceptions import ClientError
+from patching_concurrency import run_concurrently
+from patching_tagging import THROTTLING_ERROR_CODES, backoff_delay, chunk_list
+from patching_tracking import DESCRIBE_EXECUTIONS_BATCH_SIZE, RUN_RUNNING, get_execution_state
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_MAX_RUNNING = 20
+# start_automation_execution calls made at the same time, whatever the
+# number of free slots.
+MAX_CONCURRENT_STARTS = 5
+DEFAULT_POLL_INTERVAL = 15
+# Returned by StartAutomationExecution once the account's concurrent
+# automation quota is used up; the job can start when executions finish.
+LIMIT_EXCEEDED_ERROR_CODE = 'AutomationExecutionLimitExceededException'
+RETRYABLE_ERROR_CODES = THROTTLING_ERROR_CODES | {LIMIT_EXCEEDED_ERROR_CODE}
+DEADLINE_ERROR = 'DeadlineReached'
+
+EXECUTION_STARTED = 'STARTED'
+EXECUTION_FAILED = 'FAILED'
+EXECUTION_NOT_STARTED = 'NOT_STARTED'
+
+
+class AutomationScheduler(object):
+    """
+    # Class: AutomationScheduler
+    # Description: Starts queued Automation executions while keeping at most
+    # max_running of them in flight, starting the next queued jobs as the
+    # running ones finish. When the account's automation quota or API rate
+    # is exceeded the starts pause with backoff. Jobs still queued at the
+    # deadline are reported as not started.
+    """
+
+    def __init__(self, ssm_client, max_running=DEFAULT_MAX_RUNNING, deadline=None, poll_interval=DEFAULT_POLL_INTERVAL,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.ssm_client = ssm_client
+        self.max_running = max_running
+        self.deadline = deadline
+        self.poll_interval = poll_interval
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.jobs = []
+
+    def submit(self, job_id, **start_arguments):
+        """
+        Queues a start_automation_execution call under job_id.
+        """
+        with self.lock:
+            self.jobs.append((job_id, start_arguments))
+
+    def run(self):
+        """
+        Starts every queued job and returns {job_id: result}, where result
+        has a Status and either the AutomationExecutionId or the Error.
+        """
+        with self.lock:
+            queue, self.jobs = self.jobs, []
+        results = {}
+        running = []
+        attempt = 0
+        last_error = DEADLINE_ERROR
+        while queue:
+            running = self.get_running(running)
+            free = self.max_running - len(running)
+            if free <= 0:
+                if not self.wait(self.poll_interval):
+                    break
+                continue
+            batch, queue = queue[:free], queue[free:]
+            retry = []
+            for job, result, exception in run_concurrently(self.start, batch, min(len(batch), MAX_CONCURRENT_STARTS)):
+                if exception is not None:
+                    result = {'Status': EXECUTION_FAILED, 'Error': str(exception)}
+                if result['Status'] == EXECUTION_NOT_STARTED:
+                    retry.append(job)
+                    last_error = result['Error']
+                    continue
+                results[job[0]] = result
+                if result['Status'] == EXECUTION_STARTED:
+                    running.append(result['AutomationExecutionId'])
+            if not retry:
+                attempt = 0
+                continue
+            queue = retry + queue
+            attempt += 1
+            if not self.wait(backoff_delay(attempt)):
+                break
+        for job_id, start_arguments in queue:
+            results[job_id] = {'Status': EXECUTION_NOT_STARTED, 'Error': last_error}
+        if queue:
+            LOGGER.warning('%s automations not started before the deadline: %s', len(queue), [job[0] for job in queue])
+        return results
+
+    def start(self, job):
+        """
+        Makes one start call. A quota or throttling error leaves the job
+        NOT_STARTED so run() queues it again.
+        """
+        job_id, start_arguments = job
+        try:
+            response = self.ssm_client.start_automation_execution(**start_arguments)
+            LOGGER.info('Started %s as %s', job_id, response['AutomationExecutionId'])
+            return {'Status': EXECUTION_STARTED, 'AutomationExecutionId': response['AutomationExecutionId']}
+        except ClientError as exception:
+            error_code = exception.response['Error']['Code']
+            if error_code in RETRYABLE_ERROR_CODES:
+                return {'Status': EXECUTION_NOT_STARTED, 'Error': error_code}
+            LOGGER.error('Failed starting %s: %s', job_id, exception)
+            return {'Status': EXECUTION_FAILED, 'Error': error_code}
+
+    def get_running(self, execution_ids):
+        """
+        Returns the execution_ids still running. Executions not described
+        yet, as right after their start, count as running.
+        """
+        finished = set()
+        for chunk in chunk_list(execution_ids, DESCRIBE_EXECUTIONS_BATCH_SIZE):
+            response = self.ssm_client.describe_automation_executions(Filters=[{'Key': 'ExecutionId', 'Values': chunk}])
+            for execution in response['AutomationExecutionMetadataList']:
+                if get_execution_state(execution['AutomationExecutionStatus']) != RUN_RUNNING:
+                    finished.add(execution['AutomationExecutionId'])
+        return [execution_id for execution_id in execution_ids if execution_id not in finished]
+
+    def wait(self, delay):
+        """
+        Sleeps for delay. Returns False without sleeping when that would run
+        past the deadline.
+        """
+        if self.deadline is not None and self.clock() + delay >= self.deadline:
+            return False
+        self.sleep(delay)
+        return True
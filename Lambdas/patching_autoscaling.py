@@ -0,0 +1,58 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+from patching_model import AutoScalingGroup
+
+# DescribeAutoScalingGroups returns at most 100 groups per page.
+DESCRIBE_ASGS_PAGE_SIZE = 100
+
+
+def iter_auto_scaling_groups(as_client, tag_filters=None, page_size=DESCRIBE_ASGS_PAGE_SIZE):
+    """
+    Yields every Auto Scaling group in the client's region, one page at a
+    time. tag_filters is a {tag_key: [values]} dict applied by the service,
+    so only matching groups are returned.
+    """
+    paginator = as_client.get_paginator('describe_auto_scaling_groups')
+    arguments = {'PaginationConfig': {'PageSize': page_size}}
+    if tag_filters:
+        arguments['Filters'] = [{'Name': 'tag:' + key, 'Values': list(values)} for key, values in tag_filters.items()]
+    for page in paginator.paginate(**arguments):
+        for group in page['AutoScalingGroups']:
+            yield group
+
+
+class AutoScalingGroupIndex(object):
+    """
+    # Class: AutoScalingGroupIndex
+    # Description: AutoScalingGroup records indexed by the value of one tag,
+    # built in a single pass over the discovered groups
+    """
+
+    def __init__(self, tag_key):
+        self.tag_key = tag_key
+        self.groups = {}
+
+    @classmethod
+    def build(cls, as_client, tag_key, values=None):
+        """
+        Discovers the groups carrying tag_key, restricted to the given values
+        when any are passed, and indexes them by that tag's value.
+        """
+        index = cls(tag_key)
+        tag_filters = {tag_key: values} if values else None
+        for group in iter_auto_scaling_groups(as_client, tag_filters):
+            index.add(group)
+        return index
+
+    def add(self, group):
+        record = AutoScalingGroup.from_response(group)
+        value = record.tags.get(self.tag_key)
+        if value is not None:
+            self.groups.setdefault(value, []).append(record)
+
+    def get(self, value):
+        return self.groups.get(value, [])
+
+    def __len__(self):
+        return sum(len(groups) for groups in self.groups.values())
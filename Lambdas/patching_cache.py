@@ -0,0 +1,127 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+LOGGER = logging.getLogger(__name__)
+
+MAINTENANCE_WINDOW_GENERATION_PARAMETER = '/patching/maintenance-window-generation'
+
+
+class TTLCache(object):
+    """
+    # Class: TTLCache
+    # Description: Thread safe in-memory cache whose entries expire after a
+    # per-entry TTL. An optional generation loader is polled at most once per
+    # generation_check_interval seconds and the whole cache is dropped when
+    # the generation it returns changes.
+    """
+
+    def __init__(self, generation_loader=None, generation_check_interval=60, clock=time.monotonic):
+        self.generation_loader = generation_loader
+        self.generation_check_interval = generation_check_interval
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.generation = None
+        self.generation_checked_at = None
+
+    def get(self, key, default=None):
+        self.check_generation()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at <= self.clock():
+                del self.entries[key]
+                return default
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (value, self.clock() + ttl)
+
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+    def check_generation(self):
+        if self.generation_loader is None:
+            return
+        now = self.clock()
+        with self.lock:
+            if self.generation_checked_at is not None and now - self.generation_checked_at < self.generation_check_interval:
+                return
+            self.generation_checked_at = now
+        try:
+            generation = self.generation_loader()
+        except Exception as exception:
+            # Keep serving cached entries; they still expire on their TTL.
+            LOGGER.warning('Unable to load cache generation: %s', exception)
+            return
+        with self.lock:
+            if generation != self.generation:
+                if self.generation is not None:
+                    LOGGER.info('Cache generation changed, dropping %s entries', len(self.entries))
+                self.entries.clear()
+                self.generation = generation
+
+
+class Memoizer(object):
+    """
+    # Class: Memoizer
+    # Description: Thread safe memo of loader results for the lifetime of the
+    # object. Concurrent callers asking for the same key share one in-flight
+    # load. A failed load is raised to everyone waiting on it but is not
+    # remembered, so a later caller tries again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results = {}
+
+    def get(self, key, loader):
+        with self.lock:
+            future = self.results.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.results[key] = future
+        if owner:
+            try:
+                future.set_result(loader())
+            except Exception as exception:
+                with self.lock:
+                    del self.results[key]
+                future.set_exception(exception)
+        return future.result()
+
+
+def get_generation(ssm_client, parameter_name=MAINTENANCE_WINDOW_GENERATION_PARAMETER):
+    """
+    Reads the generation stored in an SSM parameter, or None when it has not
+    been written yet.
+    """
+    try:
+        return ssm_client.get_parameter(Name=parameter_name)['Parameter']['Value']
+    except ssm_client.exceptions.ParameterNotFound:
+        return None
+
+
+def bump_generation(ssm_client, parameter_name=MAINTENANCE_WINDOW_GENERATION_PARAMETER):
+    """
+    Writes a new generation so every TTLCache loading it from parameter_name
+    drops its entries on the next generation check.
+    """
+    ssm_client.put_parameter(
+        Name=parameter_name,
+        Value=str(time.time()),
+        Type='String',
+        Overwrite=True)
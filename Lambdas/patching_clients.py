@@ -0,0 +1,120 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import logging
+import random
+import threading
+from datetime import datetime, timedelta, timezone
+import boto3
+from botocore.config import Config
+from patching_metrics import instrument_client
+
+LOGGER = logging.getLogger(__name__)
+
+# Assumed role credentials are refreshed this long before they expire so a
+# client is never handed credentials that lapse mid-call.
+CREDENTIALS_REFRESH_MARGIN = timedelta(minutes=5)
+CLIENT_CONFIG = Config(
+    retries={'mode': 'standard'},
+    max_pool_connections=32
+)
+
+_lock = threading.Lock()
+_default_session = None
+_clients = {}
+_assumed_roles = {}
+_account_id = None
+
+
+def get_default_session():
+    global _default_session
+    with _lock:
+        if _default_session is None:
+            session = boto3.session.Session()
+            # Load the credentials and endpoint data up front, so clients can
+            # be created from the shared session concurrently.
+            session.get_credentials()
+            session.get_available_regions('sts')
+            _default_session = session
+        return _default_session
+
+
+def get_client(service_name, region_name=None, role_arn=None):
+    """
+    Returns a client for (role_arn, region_name, service_name), creating it
+    on first use. Clients are kept for the lifetime of the Lambda execution
+    environment, so warm invocations reuse them. When role_arn is given the
+    client uses that role's credentials, which are assumed once and renewed
+    shortly before they expire. Every client reports its API calls to
+    patching_metrics.
+    """
+    credentials = None if role_arn is None else get_assumed_role_credentials(role_arn)
+    key = (role_arn, region_name, service_name)
+    with _lock:
+        client = _clients.get(key)
+    if client is not None and client[0] is credentials:
+        return client[1]
+    # Every client comes from the shared session, which is much cheaper than
+    # a session per role, and is built outside the lock so concurrent callers
+    # for different accounts do not wait on each other.
+    credential_arguments = {}
+    if credentials is not None:
+        credential_arguments = {
+            'aws_access_key_id': credentials['AccessKeyId'],
+            'aws_secret_access_key': credentials['SecretAccessKey'],
+            'aws_session_token': credentials['SessionToken']
+        }
+    new_client = instrument_client(get_default_session().client(
+        service_name, region_name=region_name, config=CLIENT_CONFIG, **credential_arguments))
+    with _lock:
+        client = _clients.get(key)
+        if client is None or client[0] is not credentials:
+            client = (credentials, new_client)
+            _clients[key] = client
+        return client[1]
+
+
+def get_account_id():
+    """
+    Returns the account ID of the Lambda's own credentials, looked up once
+    per execution environment.
+    """
+    global _account_id
+    if _account_id is None:
+        _account_id = get_client('sts').get_caller_identity()['Account']
+    return _account_id
+
+
+def get_assumed_role_credentials(role_arn):
+    """
+    Returns the credentials of role_arn, calling sts:AssumeRole only when
+    there are no cached credentials or they are about to expire.
+    """
+    with _lock:
+        credentials = _assumed_roles.get(role_arn)
+        now = datetime.now(timezone.utc)
+        if credentials is not None and credentials['Expiration'] - CREDENTIALS_REFRESH_MARGIN > now:
+            return credentials
+    # Assuming the role is a network call, so it is made outside the lock and
+    # concurrent callers for different roles do not wait on each other.
+    sts_client = get_client('sts')
+    session_name = "SecondarySession-" + str(random.randint(1, 100000))
+    credentials = dict(sts_client.assume_role(RoleArn=role_arn, RoleSessionName=session_name)['Credentials'])
+    if credentials['Expiration'].tzinfo is None:
+        credentials['Expiration'] = credentials['Expiration'].replace(tzinfo=timezone.utc)
+    with _lock:
+        _assumed_roles[role_arn] = credentials
+    LOGGER.info('Assumed role %s', role_arn)
+    return credentials
+
+
+def clear():
+    """
+    Drops every cached session, client and credential.
+    """
+    global _default_session, _account_id
+    with _lock:
+        _default_session = None
+        _account_id = None
+        _clients.clear()
+        _assumed_roles.clear()
@@ -0,0 +1,47 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_MAX_WORKERS = 10
+
+
+def get_max_workers(variable_name, default=DEFAULT_MAX_WORKERS):
+    """
+    Reads a worker count from the environment, falling back to the default
+    when the variable is missing or not a positive integer.
+    """
+    try:
+        max_workers = int(os.environ.get(variable_name, default))
+    except ValueError:
+        LOGGER.warning('Invalid value for %s, using %s', variable_name, default)
+        return default
+    return max(1, max_workers)
+
+
+def run_concurrently(function, items, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Calls function(item) for every item on a bounded thread pool.
+
+    Returns a list of (item, result, exception) tuples in input order. An item
+    whose call raised has result None and the exception set, so one failure
+    never stops the rest of the fan-out.
+    """
+    items = list(items)
+    if not items:
+        return []
+    max_workers = max(1, min(max_workers, len(items)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(function, item) for item in items]
+    results = []
+    for item, future in zip(items, futures):
+        exception = future.exception()
+        if exception is not None:
+            results.append((item, None, exception))
+        else:
+            results.append((item, future.result(), None))
+    return results
@@ -0,0 +1,103 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import collections
+import math
+import threading
+
+# Operations a dry run may call; anything else changes state.
+READ_OPERATION_PREFIXES = ('describe_', 'get_', 'list_')
+
+
+class DryRunError(Exception):
+    """
+    Raised when a dry run calls an operation that changes state.
+    """
+
+
+class DryRun(object):
+    """
+    # Class: DryRun
+    # Description: Collects what a dry run found: the read calls made while
+    # discovering resources, the write calls a real run would make and the
+    # changes it would apply
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.read_calls = collections.Counter()
+        self.write_calls = collections.Counter()
+        self.changes = []
+
+    def wrap(self, client, service):
+        return RecordingClient(client, service, self)
+
+    def count_read(self, operation):
+        with self.lock:
+            self.read_calls[operation] += 1
+
+    def count_write(self, operation, items=1, batch_size=1):
+        """
+        Counts the calls needed to write items resources at batch_size per
+        call.
+        """
+        with self.lock:
+            self.write_calls[operation] += int(math.ceil(items / float(batch_size)))
+
+    def plan_change(self, **change):
+        with self.lock:
+            self.changes.append(change)
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'DryRun': True,
+                'Changes': list(self.changes),
+                'ApiCalls': {
+                    'Read': dict(self.read_calls),
+                    'Write': dict(self.write_calls),
+                    'Total': sum(self.read_calls.values()) + sum(self.write_calls.values())
+                }
+            }
+
+
+class RecordingClient(object):
+    """
+    # Class: RecordingClient
+    # Description: Wraps a boto3 client for a dry run. Read operations and
+    # paginator pages are counted per operation, any other operation raises
+    # DryRunError
+    """
+
+    def __init__(self, client, service, dry_run):
+        self.client = client
+        self.service = service
+        self.dry_run = dry_run
+        self.meta = client.meta
+
+    def get_paginator(self, operation):
+        return RecordingPaginator(self.client.get_paginator(operation), self.service + '.' + operation, self.dry_run)
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+        if not name.startswith(READ_OPERATION_PREFIXES):
+            raise DryRunError('Dry run cannot call ' + self.service + '.' + name)
+        operation = self.service + '.' + name
+
+        def call(*args, **kwargs):
+            self.dry_run.count_read(operation)
+            return method(*args, **kwargs)
+        return call
+
+
+class RecordingPaginator(object):
+
+    def __init__(self, paginator, operation, dry_run):
+        self.paginator = paginator
+        self.operation = operation
+        self.dry_run = dry_run
+
+    def paginate(self, **kwargs):
+        for page in self.paginator.paginate(**kwargs):
+            self.dry_run.count_read(self.operation)
+            yield page
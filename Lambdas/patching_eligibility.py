@@ -0,0 +1,59 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+ASG_NAME_TAG = 'aws:autoscaling:groupName'
+INSTALL_PATCH_TAG = 'install_patch'
+ECS_MANAGED_TAG = 'AmazonECSManaged'
+# EKS managed nodes carry tags such as k8s.io/cluster-autoscaler/enabled or
+# alpha.eksctl.io/nodegroup-name, so these are matched as key prefixes.
+EKS_TAG_PREFIXES = ('alpha.eksctl.io/', 'k8s.io/', 'eks:', 'kubernetes.io/')
+ASG_EKS_TAG_MARKERS = ('k8s.io/', 'eks:', 'kubernetes.io/')
+
+EXEMPT_AUTOSCALING = 'autoscaling'
+EXEMPT_INSTALL_PATCH = 'install_patch'
+EXEMPT_EKS = 'eks'
+EXEMPT_ECS = 'ecs'
+
+
+def tags_to_dict(tags):
+    """
+    Converts a boto3 Tags list into a {key: value} dict.
+    """
+    if not tags:
+        return {}
+    return {tag['Key']: tag['Value'] for tag in tags}
+
+
+def get_instance_exemption(tag_dict):
+    """
+    Returns why an instance must not receive patching tags, or None when it
+    is eligible. Instances in an ASG are patched through their group, and
+    instances opted out with install_patch=no or managed by EKS/ECS are
+    skipped.
+    """
+    if ASG_NAME_TAG in tag_dict:
+        return EXEMPT_AUTOSCALING
+    if tag_dict.get(INSTALL_PATCH_TAG, '').lower() == 'no':
+        return EXEMPT_INSTALL_PATCH
+    if ECS_MANAGED_TAG in tag_dict:
+        return EXEMPT_ECS
+    for key in tag_dict:
+        if key.lower().startswith(EKS_TAG_PREFIXES):
+            return EXEMPT_EKS
+    return None
+
+
+def get_asg_exemption(tag_dict):
+    """
+    Returns why an Auto Scaling group must not be patched, or None when it is
+    eligible. Groups are exempt when opted out with install_patch=no or when
+    any tag key or value marks them as EKS or ECS capacity.
+    """
+    if tag_dict.get(INSTALL_PATCH_TAG, '').lower() == 'no':
+        return EXEMPT_INSTALL_PATCH
+    for key, value in tag_dict.items():
+        if any(marker in key for marker in ASG_EKS_TAG_MARKERS):
+            return EXEMPT_EKS
+        if 'ecs' in key or 'ECS' in key or 'ecs' in value or 'ECS' in value:
+            return EXEMPT_ECS
+    return None
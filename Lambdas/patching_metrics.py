@@ -0,0 +1,154 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import functools
+import json
+import os
+import threading
+import time
+from patching_tagging import THROTTLING_ERROR_CODES
+
+# CloudWatch namespace of the Embedded Metric Format summaries; an empty
+# value turns the summaries off.
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "Patching")
+START_TIME_KEY = 'patching_metrics_started_at'
+
+
+class ApiMetrics(object):
+    """
+    # Class: ApiMetrics
+    # Description: Counts and times AWS API calls per service and operation
+    # from botocore's event hooks, including retried and throttled attempts,
+    # and emits them once per invocation in CloudWatch Embedded Metric Format
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.operations = {}
+
+    def reset(self):
+        with self.lock:
+            self.operations = {}
+
+    def register(self, client):
+        events = client.meta.events
+        events.register('before-call', self.before_call)
+        events.register('after-call', self.after_call)
+        events.register('after-call-error', self.after_call_error)
+        events.register('needs-retry', self.needs_retry)
+
+    def before_call(self, context=None, **kwargs):
+        if context is not None:
+            context[START_TIME_KEY] = self.clock()
+
+    def after_call(self, event_name, parsed=None, context=None, **kwargs):
+        self.record_call(event_name, context, parsed or {}, error=False)
+
+    def after_call_error(self, event_name, exception=None, context=None, **kwargs):
+        self.record_call(event_name, context, getattr(exception, 'response', None) or {}, error=True)
+
+    def needs_retry(self, event_name, response=None, **kwargs):
+        # Only observes the attempt: returning None leaves the retry decision
+        # to botocore.
+        if response is not None and response[1].get('Error', {}).get('Code') in THROTTLING_ERROR_CODES:
+            with self.lock:
+                self.get_operation(event_name)['Throttles'] += 1
+
+    def record_call(self, event_name, context, response, error):
+        started_at = (context or {}).get(START_TIME_KEY)
+        elapsed_ms = (self.clock() - started_at) * 1000 if started_at is not None else 0
+        retries = response.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        with self.lock:
+            operation = self.get_operation(event_name)
+            operation['Calls'] += 1
+            operation['Errors'] += int(error)
+            operation['Retries'] += retries
+            operation['TimeMs'] += elapsed_ms
+            operation['MaxTimeMs'] = max(operation['MaxTimeMs'], elapsed_ms)
+
+    def get_operation(self, event_name):
+        # Event names are <event>.<service id>.<operation>.
+        key = tuple(event_name.split('.')[1:3])
+        operation = self.operations.get(key)
+        if operation is None:
+            operation = {'Calls': 0, 'Errors': 0, 'Throttles': 0, 'Retries': 0, 'TimeMs': 0.0, 'MaxTimeMs': 0.0}
+            self.operations[key] = operation
+        return operation
+
+    def summary(self):
+        with self.lock:
+            return {key: dict(operation) for key, operation in self.operations.items()}
+
+    def emit(self, function_name, duration_ms, namespace=METRICS_NAMESPACE):
+        """
+        Prints one EMF document with the invocation totals and one per
+        service and operation, and returns them.
+        """
+        if not namespace:
+            return []
+        operations = self.summary()
+        timestamp = int(time.time() * 1000)
+        totals = {
+            'Function': function_name,
+            'DurationMs': round(duration_ms, 1),
+            'ApiCalls': sum(operation['Calls'] for operation in operations.values()),
+            'ApiErrors': sum(operation['Errors'] for operation in operations.values()),
+            'ApiThrottles': sum(operation['Throttles'] for operation in operations.values()),
+            'ApiRetries': sum(operation['Retries'] for operation in operations.values()),
+            'ApiTimeMs': round(sum(operation['TimeMs'] for operation in operations.values()), 1),
+        }
+        documents = [emf_document(namespace, timestamp, ['Function'], totals, {'DurationMs': 'Milliseconds', 'ApiTimeMs': 'Milliseconds'})]
+        for (service, operation_name), operation in sorted(operations.items()):
+            values = dict(operation, Function=function_name, Service=service, Operation=operation_name,
+                          TimeMs=round(operation['TimeMs'], 1), MaxTimeMs=round(operation['MaxTimeMs'], 1))
+            documents.append(emf_document(namespace, timestamp, ['Function', 'Service', 'Operation'], values,
+                                          {'TimeMs': 'Milliseconds', 'MaxTimeMs': 'Milliseconds'}))
+        for document in documents:
+            print(json.dumps(document))
+        return documents
+
+
+def emf_document(namespace, timestamp, dimensions, values, units):
+    metric_names = [name for name in values if name not in dimensions]
+    document = {
+        '_aws': {
+            'Timestamp': timestamp,
+            'CloudWatchMetrics': [{
+                'Namespace': namespace,
+                'Dimensions': [dimensions],
+                'Metrics': [{'Name': name, 'Unit': units.get(name, 'Count')} for name in metric_names]
+            }]
+        }
+    }
+    document.update(values)
+    return document
+
+
+METRICS = ApiMetrics()
+
+
+def instrument_client(client):
+    METRICS.register(client)
+    return client
+
+
+def invocation_metrics(function_name):
+    """
+    Decorates a Lambda handler so the API calls of every invocation are
+    emitted as one EMF summary when it returns or raises.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            METRICS.reset()
+            started_at = time.monotonic()
+            try:
+                return handler(event, context)
+            finally:
+                try:
+                    METRICS.emit(function_name, (time.monotonic() - started_at) * 1000)
+                except Exception as exception:
+                    print('Unable to emit metrics ' + str(exception))
+        return wrapper
+    return decorator
@@ -0,0 +1,68 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+from patching_eligibility import tags_to_dict
+
+# Records keep only the fields the patching Lambdas use, so a page of a
+# describe response can be dropped as soon as its records are built.
+
+
+class Instance(object):
+    __slots__ = ('instance_id', 'state', 'tags')
+
+    def __init__(self, instance_id, state, tags):
+        self.instance_id = instance_id
+        self.state = state
+        self.tags = tags
+
+    @classmethod
+    def from_response(cls, instance):
+        """
+        Builds the record from an element of a describe_instances
+        reservation's Instances list.
+        """
+        return cls(instance['InstanceId'], instance['State']['Name'], tags_to_dict(instance.get('Tags')))
+
+
+class AutoScalingGroup(object):
+    __slots__ = ('name', 'tags', 'subnet_ids', 'launch_configuration_name', 'launch_template_id',
+                 'launch_template_version')
+
+    def __init__(self, name, tags, subnet_ids, launch_configuration_name=None, launch_template_id=None,
+                 launch_template_version=None):
+        self.name = name
+        self.tags = tags
+        self.subnet_ids = subnet_ids
+        self.launch_configuration_name = launch_configuration_name
+        self.launch_template_id = launch_template_id
+        self.launch_template_version = launch_template_version
+
+    @classmethod
+    def from_response(cls, group):
+        """
+        Builds the record from an element of describe_auto_scaling_groups'
+        AutoScalingGroups list.
+        """
+        launch_template = group.get('LaunchTemplate') or {}
+        subnets = group.get('VPCZoneIdentifier') or ''
+        return cls(
+            group['AutoScalingGroupName'],
+            tags_to_dict(group.get('Tags')),
+            [subnet_id for subnet_id in subnets.split(',') if subnet_id],
+            group.get('LaunchConfigurationName'),
+            launch_template.get('LaunchTemplateId'),
+            launch_template.get('Version'))
+
+
+class PatchTarget(object):
+    """
+    An ASG resolved for patching: the subnet and security group to launch the
+    intermediate instance in and the AMI to patch.
+    """
+    __slots__ = ('asg_name', 'subnet_id', 'image_id', 'security_group_id')
+
+    def __init__(self, asg_name, subnet_id, image_id, security_group_id):
+        self.asg_name = asg_name
+        self.subnet_id = subnet_id
+        self.image_id = image_id
+        self.security_group_id = security_group_id
@@ -0,0 +1,167 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import logging
+import threading
+import time
+from patching_eligibility import tags_to_dict
+
+LOGGER = logging.getLogger(__name__)
+
+# Account status changes and new accounts are picked up after
+# ACCOUNTS_TTL_SECONDS; the OU tree is walked again after TREE_TTL_SECONDS
+# and account tags are reloaded per account after TAGS_TTL_SECONDS.
+ACCOUNTS_TTL_SECONDS = 900
+TREE_TTL_SECONDS = 3600
+TAGS_TTL_SECONDS = 3600
+
+
+class AccountInventory(object):
+    """
+    # Class: AccountInventory
+    # Description: Organization accounts indexed by ID, status and OU (every
+    # OU on the account's path, by ID and by name), with account tags loaded
+    # on first use. The inventory lives for the lifetime of the Lambda
+    # execution environment and is refreshed in parts as they expire. When a
+    # refresh fails, e.g. because Organizations is throttling, the previous
+    # inventory keeps being served.
+    """
+
+    def __init__(self, organizations_client, clock=time.monotonic):
+        self.organizations_client = organizations_client
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.accounts = {}
+        self.ou_paths = {}
+        self.accounts_by_ou = {}
+        self.tags = {}
+        self.accounts_loaded_at = None
+        self.tree_loaded_at = None
+
+    def get_account_ids(self, status='ACTIVE', ous=None, tags=None):
+        """
+        Returns the IDs of the accounts with the given status, restricted to
+        accounts under any of ous (OU IDs or names) and carrying, for every
+        key of tags, one of the listed values.
+        """
+        self.refresh()
+        with self.lock:
+            account_ids = {account_id for account_id, account in self.accounts.items() if account['Status'] == status}
+            if ous:
+                account_ids &= set().union(*(self.accounts_by_ou.get(ou, set()) for ou in ous))
+        if tags:
+            account_ids = {account_id for account_id in account_ids
+                           if all(self.get_tags(account_id).get(key) in values for key, values in tags.items())}
+        return sorted(account_ids)
+
+    def get_ous(self, account_id):
+        """
+        Returns the IDs and names of the root and every OU containing the
+        account.
+        """
+        self.refresh()
+        with self.lock:
+            return self.ou_paths.get(account_id, [])
+
+    def get_tags(self, account_id):
+        with self.lock:
+            cached = self.tags.get(account_id)
+        if cached is not None and self.clock() - cached[1] < TAGS_TTL_SECONDS:
+            return cached[0]
+        try:
+            account_tags = []
+            paginator = self.organizations_client.get_paginator('list_tags_for_resource')
+            for page in paginator.paginate(ResourceId=account_id):
+                account_tags.extend(page['Tags'])
+            tag_dict = tags_to_dict(account_tags)
+        except Exception as exception:
+            if cached is None:
+                raise
+            LOGGER.warning('Using cached tags of %s: %s', account_id, exception)
+            return cached[0]
+        with self.lock:
+            self.tags[account_id] = (tag_dict, self.clock())
+        return tag_dict
+
+    def refresh(self):
+        now = self.clock()
+        if self.tree_loaded_at is None or now - self.tree_loaded_at >= TREE_TTL_SECONDS:
+            self.run_refresh(self.load_tree)
+        elif now - self.accounts_loaded_at >= ACCOUNTS_TTL_SECONDS:
+            self.run_refresh(self.load_accounts)
+
+    def run_refresh(self, loader):
+        try:
+            loader()
+        except Exception as exception:
+            if self.accounts_loaded_at is None:
+                raise
+            LOGGER.warning('Serving the cached account inventory: %s', exception)
+
+    def load_tree(self):
+        """
+        Walks the OU tree from every root, which finds every account with its
+        OU path in one call per OU.
+        """
+        accounts = {}
+        ou_paths = {}
+        accounts_by_ou = {}
+        roots = self.organizations_client.list_roots()['Roots']
+        pending = [(root['Id'], [root['Id']], [root['Name']]) for root in roots]
+        while pending:
+            parent_id, path_ids, path_names = pending.pop()
+            paginator = self.organizations_client.get_paginator('list_accounts_for_parent')
+            for page in paginator.paginate(ParentId=parent_id):
+                for account in page['Accounts']:
+                    accounts[account['Id']] = {'Id': account['Id'], 'Name': account['Name'], 'Status': account['Status']}
+                    ou_paths[account['Id']] = path_ids + path_names
+                    for ou in path_ids + path_names:
+                        accounts_by_ou.setdefault(ou, set()).add(account['Id'])
+            paginator = self.organizations_client.get_paginator('list_organizational_units_for_parent')
+            for page in paginator.paginate(ParentId=parent_id):
+                for ou in page['OrganizationalUnits']:
+                    pending.append((ou['Id'], path_ids + [ou['Id']], path_names + [ou['Name']]))
+        now = self.clock()
+        with self.lock:
+            self.accounts = accounts
+            self.ou_paths = ou_paths
+            self.accounts_by_ou = accounts_by_ou
+            self.accounts_loaded_at = now
+            self.tree_loaded_at = now
+        LOGGER.info('Loaded %s accounts in %s OUs', len(accounts), len(accounts_by_ou))
+
+    def load_accounts(self):
+        """
+        Refreshes account status from list_accounts. An account that is not
+        in the OU index yet triggers a walk of the OU tree.
+        """
+        accounts = {}
+        paginator = self.organizations_client.get_paginator('list_accounts')
+        for page in paginator.paginate():
+            for account in page['Accounts']:
+                accounts[account['Id']] = {'Id': account['Id'], 'Name': account['Name'], 'Status': account['Status']}
+        with self.lock:
+            new_accounts = set(accounts) - set(self.ou_paths)
+        if new_accounts:
+            LOGGER.info('Found %s new accounts', len(new_accounts))
+            self.load_tree()
+            return
+        with self.lock:
+            self.accounts = accounts
+            self.accounts_loaded_at = self.clock()
+
+
+_inventory = None
+_inventory_lock = threading.Lock()
+
+
+def get_inventory(organizations_client):
+    """
+    Returns the account inventory shared by every invocation of this
+    execution environment.
+    """
+    global _inventory
+    with _inventory_lock:
+        if _inventory is None:
+            _inventory = AccountInventory(organizations_client)
+        return _inventory
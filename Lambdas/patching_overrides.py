@@ -0,0 +1,194 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import hashlib
+import os
+import re
+import urllib.parse
+import urllib.request
+from patching_cache import TTLCache
+from patching_clients import get_client
+
+# Validated install override lists are copied to this bucket, under
+# OVERRIDE_LIST_PREFIX and the SHA-256 of their content. Without a bucket
+# the lists are passed on unchanged.
+OVERRIDE_LIST_BUCKET = os.environ.get("OVERRIDE_LIST_BUCKET", "")
+OVERRIDE_LIST_BUCKET_REGION = os.environ.get("OVERRIDE_LIST_BUCKET_REGION")
+OVERRIDE_LIST_PREFIX = 'install-override-lists/'
+OVERRIDE_LIST_CACHE_TTL_SECONDS = int(os.environ.get("OVERRIDE_LIST_CACHE_TTL_SECONDS", "300"))
+MAX_OVERRIDE_LIST_BYTES = 1024 * 1024
+FETCH_TIMEOUT_SECONDS = 10
+# Path-style (s3.<region>.amazonaws.com/<bucket>) and virtual-hosted
+# (<bucket>.s3.<region>.amazonaws.com) S3 hosts.
+S3_HOST = re.compile(r'^(?:(?P<bucket>.+)\.)?s3[.-](?:[a-z0-9-]+\.)?amazonaws\.com(?:\.cn)?$')
+# Lines of an install override list: 'patches:', then per patch a '-' line,
+# optionally followed by the first field, and one 'key: value' line per field.
+PATCH_LINE = re.compile(r'^(?P<indent> *)-(?: +(?P<field>.*))?$')
+FIELD_LINE = re.compile(r'^(?P<indent> *)(?P<key>[A-Za-z][A-Za-z0-9_]*):(?: +(?P<value>.*))?$')
+# Scalars YAML reads as the same text: single quoted, double quoted without
+# escapes, or plain without indicators, each with an optional comment.
+QUOTED_SCALAR = re.compile(r'''^(?:'(?P<single>(?:[^']|'')*)'|"(?P<double>[^"\\]*)")(?: +#.*)?$''')
+PLAIN_SCALAR = re.compile(r'''^(?P<plain>[^-?:,\[\]{}#&*!|>'"%@`\s](?:[^:#]|:(?! )|(?<! )#)*?)(?: +#.*)?$''')
+
+# Staged URL per source URL, so warm invocations do not download and hash
+# the same list again.
+STAGED_LISTS = TTLCache()
+
+
+class OverrideListError(Exception):
+    """
+    Raised when an install override list cannot be read or is malformed.
+    """
+
+
+def parse_s3_url(url):
+    """
+    Returns (bucket, key) of an s3:// URL or an https S3 URL, or None for
+    any other URL.
+    """
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme == 's3':
+        return parsed.netloc, urllib.parse.unquote(parsed.path.lstrip('/'))
+    if parsed.scheme != 'https':
+        return None
+    match = S3_HOST.match(parsed.hostname or '')
+    if match is None:
+        return None
+    path = urllib.parse.unquote(parsed.path.lstrip('/'))
+    if match.group('bucket'):
+        return match.group('bucket'), path
+    bucket, _, key = path.partition('/')
+    return bucket, key
+
+
+def is_staged(url, bucket=OVERRIDE_LIST_BUCKET):
+    location = parse_s3_url(url)
+    return location is not None and location[0] == bucket and location[1].startswith(OVERRIDE_LIST_PREFIX)
+
+
+def fetch_override_list(url):
+    location = parse_s3_url(url)
+    if location is not None:
+        body = get_client('s3').get_object(Bucket=location[0], Key=location[1])['Body']
+        content = body.read(MAX_OVERRIDE_LIST_BYTES + 1)
+    elif url.startswith('https://'):
+        with urllib.request.urlopen(url, timeout=FETCH_TIMEOUT_SECONDS) as response:
+            content = response.read(MAX_OVERRIDE_LIST_BYTES + 1)
+    else:
+        raise OverrideListError('Install override list must be an https or S3 URL: ' + url)
+    if len(content) > MAX_OVERRIDE_LIST_BYTES:
+        raise OverrideListError('Install override list is larger than ' + str(MAX_OVERRIDE_LIST_BYTES) + ' bytes: ' + url)
+    return content
+
+
+def parse_override_list(content):
+    """
+    Returns the patch IDs of an install override list. Only the block layout
+    of the override list documentation is accepted: a 'patches:' line and
+    one '-' entry per patch with 'key: value' fields, each with an id. The
+    values must be quoted or plain scalars, so the document reads the same
+    for the YAML parser of the patching document. Flow style, anchors, tags,
+    multi line values and escapes are rejected.
+    """
+    try:
+        text = content.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        raise OverrideListError('Install override list is not UTF-8 text')
+    if '\t' in text:
+        raise OverrideListError('Install override list is indented with tabs')
+    lines = [(number, line.rstrip()) for number, line in enumerate(text.splitlines(), 1)
+             if line.strip() and not line.lstrip().startswith('#')]
+    if not lines or lines[0][1] != 'patches:':
+        raise OverrideListError('Install override list has no patches')
+    patches = []
+    patch_indent = None
+    field_indent = None
+    for number, line in lines[1:]:
+        patch = PATCH_LINE.match(line)
+        if patch is not None:
+            if patch_indent is None:
+                patch_indent = len(patch.group('indent'))
+            if len(patch.group('indent')) != patch_indent:
+                raise OverrideListError('Line ' + str(number) + ' of the install override list is not aligned with the other patches')
+            patches.append({})
+            field_indent = None
+            if not patch.group('field'):
+                continue
+            line = ' ' * (len(line) - len(patch.group('field'))) + patch.group('field')
+        field = FIELD_LINE.match(line)
+        if field is None or not patches:
+            raise OverrideListError('Line ' + str(number) + ' of the install override list is not a patch field')
+        if field_indent is None:
+            field_indent = len(field.group('indent'))
+        if len(field.group('indent')) != field_indent or field_indent <= patch_indent:
+            raise OverrideListError('Line ' + str(number) + ' of the install override list is not aligned with its patch')
+        if field.group('key') in patches[-1]:
+            raise OverrideListError('Line ' + str(number) + ' of the install override list repeats ' + field.group('key'))
+        patches[-1][field.group('key')] = parse_scalar(field.group('value') or '', number)
+    if not patches:
+        raise OverrideListError('Install override list has no patches')
+    patch_ids = []
+    for index, patch in enumerate(patches):
+        if not patch.get('id', '').strip():
+            raise OverrideListError('Patch ' + str(index + 1) + ' of the install override list has no id')
+        patch_ids.append(patch['id'])
+    return patch_ids
+
+
+def parse_scalar(value, number):
+    if not value:
+        return ''
+    match = QUOTED_SCALAR.match(value)
+    if match is not None:
+        if match.group('single') is not None:
+            return match.group('single').replace("''", "'")
+        return match.group('double')
+    match = PLAIN_SCALAR.match(value)
+    if match is None:
+        raise OverrideListError('Line ' + str(number) + ' of the install override list has an unsupported value')
+    return match.group('plain')
+
+
+def object_exists(s3_client, bucket, key):
+    """
+    S3 answers a missing key with 403 instead of 404 to callers without
+    s3:ListBucket, so both count as missing and the list is written again.
+    """
+    try:
+        s3_client.head_object(Bucket=bucket, Key=key)
+        return True
+    except s3_client.exceptions.ClientError as exception:
+        if exception.response.get('Error', {}).get('Code') in ('403', '404', 'AccessDenied', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+
+
+def stage_override_list(url, bucket=OVERRIDE_LIST_BUCKET, region=OVERRIDE_LIST_BUCKET_REGION, dry_run=None):
+    """
+    Validates the install override list at url and returns the path-style
+    URL of a copy stored under its content hash in bucket. Every instance
+    of the run then downloads the list from one place, and identical lists
+    from any account or run are stored once. Returns url unchanged when it
+    is empty, already staged or no bucket is configured, and raises
+    OverrideListError when the list is malformed.
+    """
+    if not url or not bucket or is_staged(url, bucket):
+        return url
+    staged_url = STAGED_LISTS.get(url)
+    if staged_url is not None:
+        return staged_url
+    content = fetch_override_list(url)
+    patch_ids = parse_override_list(content)
+    key = OVERRIDE_LIST_PREFIX + hashlib.sha256(content).hexdigest() + '.yaml'
+    s3_client = get_client('s3', region)
+    staged_url = s3_client.meta.endpoint_url + '/' + bucket + '/' + key
+    if dry_run is not None:
+        dry_run.plan_change(Action='StageInstallOverrideList', Source=url, Url=staged_url, Patches=len(patch_ids))
+        dry_run.count_write('s3.put_object')
+        return staged_url
+    if not object_exists(s3_client, bucket, key):
+        s3_client.put_object(Bucket=bucket, Key=key, Body=content, ContentType='application/x-yaml',
+                             ACL='bucket-owner-full-control')
+    STAGED_LISTS.set(url, staged_url, OVERRIDE_LIST_CACHE_TTL_SECONDS)
+    print('Staged install override list ' + url + ' with ' + str(len(patch_ids)) + ' patches as ' + staged_url)
+    return staged_url
@@ -0,0 +1,77 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import math
+
+# Used when the invoking event does not carry the maintenance window length,
+# e.g. for emergency patching.
+DEFAULT_WINDOW_HOURS = 3
+DEFAULT_WINDOW_CUTOFF_HOURS = 1
+# Rough time for one batch of instances to run AWS-RunPatchBaseline,
+# including the reboot.
+INSTALL_MINUTES_PER_WAVE = 30
+SCAN_MINUTES_PER_WAVE = 5
+# Share of the targeted regions allowed to fail before no further region is
+# started.
+LOCATION_ERROR_RATE = 0.25
+
+DEFAULT_MAXIMUM_CONCURRENCY = '10%'
+DEFAULT_TARGET_LOCATION_MAX_CONCURRENCY = '5'
+DEFAULT_TARGET_LOCATION_MAX_ERRORS = '13'
+
+
+def count_targets(ec2_client, env):
+    """
+    Counts the running instances tagged for the environment's maintenance
+    window in the client's region.
+    """
+    paginator = ec2_client.get_paginator('describe_instances')
+    page_iterator = paginator.paginate(
+        Filters=[
+            {'Name': 'tag:maintenance_window', 'Values': [env + '_maintenance_window']},
+            {'Name': 'instance-state-name', 'Values': ['running']}
+        ],
+        PaginationConfig={'PageSize': 1000})
+    return sum(len(reservation['Instances']) for page in page_iterator for reservation in page['Reservations'])
+
+
+def default_plan(regions):
+    """
+    The fixed settings used when the fleet size is unknown.
+    """
+    return {
+        'Regions': list(regions),
+        'MaximumConcurrency': DEFAULT_MAXIMUM_CONCURRENCY,
+        'TargetLocationMaxConcurrency': DEFAULT_TARGET_LOCATION_MAX_CONCURRENCY,
+        'TargetLocationMaxErrors': DEFAULT_TARGET_LOCATION_MAX_ERRORS
+    }
+
+
+def plan_concurrency(fleet_sizes, window_hours=DEFAULT_WINDOW_HOURS, cutoff_hours=DEFAULT_WINDOW_CUTOFF_HOURS,
+                     minutes_per_wave=INSTALL_MINUTES_PER_WAVE):
+    """
+    Plans a standalone patching run from {region: instance count}.
+
+    The usable part of the window fits a number of waves. Each region patches
+    the smallest percentage of its instances per wave that still finishes
+    within the window, so a lower concurrency would overrun it. Regions are
+    patched in parallel only as far as needed to finish in time, so small
+    fleets are patched one region at a time. Regions without targeted
+    instances are left out.
+    """
+    regions = sorted(region for region, size in fleet_sizes.items() if size > 0)
+    available_minutes = max(minutes_per_wave, (window_hours - cutoff_hours) * 60)
+    waves = max(1, int(available_minutes // minutes_per_wave))
+    percent = min(100, int(math.ceil(100.0 / waves)))
+    region_minutes = 0
+    for region in regions:
+        per_wave = max(1, int(math.ceil(fleet_sizes[region] * percent / 100.0)))
+        region_minutes += int(math.ceil(fleet_sizes[region] / float(per_wave))) * minutes_per_wave
+    location_concurrency = min(len(regions), max(1, int(math.ceil(region_minutes / float(available_minutes)))))
+    location_errors = max(1, int(math.ceil(len(regions) * LOCATION_ERROR_RATE)))
+    return {
+        'Regions': regions,
+        'MaximumConcurrency': '{}%'.format(percent),
+        'TargetLocationMaxConcurrency': str(location_concurrency),
+        'TargetLocationMaxErrors': str(location_errors)
+    }
@@ -0,0 +1,179 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import logging
+import random
+import re
+import time
+from botocore.exceptions import ClientError
+from patching_concurrency import run_concurrently
+
+LOGGER = logging.getLogger(__name__)
+
+# CreateTags accepts at most 1000 resource IDs per request. Smaller chunks let
+# a page of instances be tagged in parallel and keep a failed request small.
+CREATE_TAGS_MAX_RESOURCES = 1000
+DEFAULT_CHUNK_SIZE = 250
+# Auto Scaling groups per create_or_update_tags call.
+CREATE_OR_UPDATE_TAGS_BATCH_SIZE = 10
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_MAX_ATTEMPTS = 6
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 20
+
+THROTTLING_ERROR_CODES = {
+    'RequestLimitExceeded',
+    'Throttling',
+    'ThrottlingException',
+    'TooManyRequestsException',
+}
+NOT_FOUND_ERROR_CODES = {'InvalidInstanceID.NotFound', 'InvalidID'}
+RESOURCE_ID_PATTERN = re.compile(r'\b[a-z]+-[0-9a-f]{8,17}\b')
+
+TAG_SUCCESS = 'SUCCESS'
+TAG_UNCHANGED = 'UNCHANGED'
+
+
+def is_throttling_error(exception):
+    return isinstance(exception, ClientError) and exception.response['Error']['Code'] in THROTTLING_ERROR_CODES
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE_SECONDS, cap=BACKOFF_MAX_SECONDS):
+    """
+    Full jitter exponential backoff: a random delay between zero and
+    base * 2^attempt, capped.
+    """
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def chunk_list(items, chunk_size):
+    for start in range(0, len(items), chunk_size):
+        yield items[start:start + chunk_size]
+
+
+def get_tag_changes(current_tags, desired_tags):
+    """
+    Returns the desired tags whose value differs from the current ones. Both
+    are {key: value} dicts; tags not in desired_tags are left alone.
+    """
+    return {key: value for key, value in desired_tags.items() if current_tags.get(key) != value}
+
+
+def group_tag_changes(resources):
+    """
+    Reconciles (resource_id, current_tags, desired_tags) triples. Returns
+    ({tag_items: [resource_id]}, [unchanged resource_id]) where tag_items is
+    the sorted tuple of (key, value) pairs to write, so resources needing the
+    same change share one write.
+    """
+    tag_groups = {}
+    unchanged = []
+    for resource_id, current_tags, desired_tags in resources:
+        changes = get_tag_changes(current_tags, desired_tags)
+        if changes:
+            tag_groups.setdefault(tuple(sorted(changes.items())), []).append(resource_id)
+        else:
+            unchanged.append(resource_id)
+    return tag_groups, unchanged
+
+
+def tag_list_from_items(tag_items):
+    return [{'Key': key, 'Value': value} for key, value in tag_items]
+
+
+def asg_tag_list(asg_names, tag_items):
+    """
+    Builds the create_or_update_tags Tags argument setting tag_items on every
+    named Auto Scaling group.
+    """
+    return [
+        {
+            'ResourceId': asg_name,
+            'ResourceType': 'auto-scaling-group',
+            'Key': key,
+            'Value': value,
+            'PropagateAtLaunch': False
+        }
+        for asg_name in asg_names for key, value in tag_items
+    ]
+
+
+def summarize_tag_results(results, max_failures=25):
+    """
+    Builds a CloudFormation friendly summary of a per-resource result map.
+    Custom resource response data is limited to 4 KB, so only the first
+    failures are listed; the full map is logged by the caller.
+    """
+    failed = {resource_id: status for resource_id, status in results.items() if status not in (TAG_SUCCESS, TAG_UNCHANGED)}
+    unchanged = sum(1 for status in results.values() if status == TAG_UNCHANGED)
+    listed = dict(sorted(failed.items())[:max_failures])
+    return {
+        'TaggedCount': str(len(results) - len(failed) - unchanged),
+        'UnchangedCount': str(unchanged),
+        'FailedCount': str(len(failed)),
+        'Failed': json.dumps(listed)
+    }
+
+
+class BulkTagger(object):
+    """
+    # Class: BulkTagger
+    # Description: Applies the same tags to many EC2 resources in API sized
+    # chunks, retrying throttled chunks and reporting the outcome per resource
+    """
+
+    def __init__(self, ec2_client, chunk_size=DEFAULT_CHUNK_SIZE, max_workers=DEFAULT_MAX_WORKERS,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.ec2_client = ec2_client
+        self.chunk_size = max(1, min(chunk_size, CREATE_TAGS_MAX_RESOURCES))
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+
+    def tag(self, resource_ids, tag_list):
+        """
+        Returns {resource_id: 'SUCCESS' or error code} for every resource ID.
+        """
+        results = {}
+        if not resource_ids:
+            return results
+        chunks = list(chunk_list(list(resource_ids), self.chunk_size))
+        outcomes = run_concurrently(lambda chunk: self.tag_chunk(chunk, tag_list), chunks, self.max_workers)
+        for chunk, chunk_results, exception in outcomes:
+            if exception is not None:
+                LOGGER.error('Tagging chunk failed: %s', exception)
+                chunk_results = dict.fromkeys(chunk, type(exception).__name__)
+            results.update(chunk_results)
+        return results
+
+    def tag_chunk(self, chunk, tag_list):
+        results = {}
+        pending = list(chunk)
+        attempt = 0
+        while pending:
+            try:
+                self.ec2_client.create_tags(DryRun=False, Resources=pending, Tags=tag_list)
+                results.update(dict.fromkeys(pending, TAG_SUCCESS))
+                return results
+            except ClientError as exception:
+                error_code = exception.response['Error']['Code']
+                if error_code in THROTTLING_ERROR_CODES and attempt + 1 < self.max_attempts:
+                    time.sleep(backoff_delay(attempt))
+                    attempt += 1
+                    continue
+                missing = self.get_missing_resources(exception, pending)
+                if error_code in NOT_FOUND_ERROR_CODES and missing:
+                    # CreateTags is all or nothing: drop the resources that no
+                    # longer exist and tag the rest of the chunk.
+                    results.update(dict.fromkeys(missing, error_code))
+                    pending = [resource_id for resource_id in pending if resource_id not in missing]
+                    continue
+                LOGGER.error('Failed tagging %s resources: %s', len(pending), exception)
+                results.update(dict.fromkeys(pending, error_code))
+                return results
+        return results
+
+    def get_missing_resources(self, exception, pending):
+        message = exception.response['Error'].get('Message', '')
+        pending_set = set(pending)
+        return {resource_id for resource_id in RESOURCE_ID_PATTERN.findall(message) if resource_id in pending_set}
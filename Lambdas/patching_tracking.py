@@ -0,0 +1,238 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import logging
+import time
+import uuid
+from datetime import datetime, timezone
+from patching_clients import get_client
+from patching_tagging import chunk_list
+
+LOGGER = logging.getLogger(__name__)
+
+# Automation executions started for one patching run carry this tag, so the
+# run can be found across accounts and regions.
+RUN_ID_TAG = 'PatchingRunId'
+# They also carry a tag whose key holds the run ID, as
+# describe_automation_executions filters on tag keys but not values.
+RUN_TAG_KEY_PREFIX = RUN_ID_TAG + ':'
+# An AutomationExecutionFilter accepts at most 10 values.
+DESCRIBE_EXECUTIONS_BATCH_SIZE = 10
+DEFAULT_MIN_POLL_INTERVAL = 15
+DEFAULT_MAX_POLL_INTERVAL = 120
+MAX_LISTED_STRAGGLERS = 10
+# Namespace of the patch baseline snapshot IDs derived from a run.
+SNAPSHOT_NAMESPACE = uuid.UUID('6f1c2a8e-3b7d-4e52-9a0f-5d8c4b21e7a3')
+
+RUN_RUNNING = 'RUNNING'
+RUN_SUCCEEDED = 'SUCCEEDED'
+RUN_FAILED = 'FAILED'
+RUN_TIMED_OUT = 'TIMED_OUT'
+
+EXECUTION_STATES = {
+    'Success': RUN_SUCCEEDED,
+    'CompletedWithSuccess': RUN_SUCCEEDED,
+    'TimedOut': RUN_TIMED_OUT,
+    'Failed': RUN_FAILED,
+    'Cancelled': RUN_FAILED,
+    'Rejected': RUN_FAILED,
+    'CompletedWithFailure': RUN_FAILED,
+    'ChangeCalendarOverrideRejected': RUN_FAILED,
+    'Exited': RUN_FAILED,
+}
+
+
+def new_run_id():
+    return str(uuid.uuid4())
+
+
+def get_run_scope(event, run_id):
+    """
+    The standalone and ASG tasks of one maintenance window are passed the
+    same window execution ID; other runs are scoped to their run ID.
+    """
+    return event.get('window_execution_id') or run_id
+
+
+def get_snapshot_id(run_scope, env):
+    """
+    Returns the patch baseline snapshot ID of an environment for a run.
+    Patch Manager snapshots the baseline of a patch group and operating
+    system the first time an instance patches with the ID, and every later
+    instance and bake of the run gets that snapshot. The ID is derived
+    rather than stored, so every invocation of the run finds it and no
+    later run reuses it.
+    """
+    return str(uuid.uuid5(SNAPSHOT_NAMESPACE, run_scope + '/' + env))
+
+
+def get_execution_state(automation_status):
+    """
+    Maps an AutomationExecutionStatus to RUNNING, SUCCEEDED, FAILED or
+    TIMED_OUT. Every non terminal status counts as RUNNING.
+    """
+    return EXECUTION_STATES.get(automation_status, RUN_RUNNING)
+
+
+def execution_tags(run_id, env, asg_name=None):
+    tags = [{'Key': RUN_ID_TAG, 'Value': run_id}, {'Key': RUN_TAG_KEY_PREFIX + run_id, 'Value': env},
+            {'Key': 'environment', 'Value': env}]
+    if asg_name is not None:
+        tags.append({'Key': 'AutoScalingGroup', 'Value': asg_name})
+    return tags
+
+
+def execution_record(execution_id, run_id, execution_region, account, regions, env, asg_name=None):
+    """
+    Describes one started execution so it can be polled later, from any
+    invocation, by passing the record back to ExecutionPoller.
+    """
+    record = {
+        'AutomationExecutionId': execution_id,
+        'RunId': run_id,
+        'ExecutionRegion': execution_region,
+        'Account': account,
+        'Regions': regions,
+        'Environment': env
+    }
+    if asg_name is not None:
+        record['AutoScalingGroup'] = asg_name
+    return record
+
+
+class ExecutionPoller(object):
+    """
+    # Class: ExecutionPoller
+    # Description: Polls the status of started Automation executions in
+    # batches, backing off while nothing changes
+    """
+
+    def __init__(self, min_interval=DEFAULT_MIN_POLL_INTERVAL, max_interval=DEFAULT_MAX_POLL_INTERVAL,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.clock = clock
+        self.sleep = sleep
+
+    def describe(self, records):
+        """
+        Returns {execution_id: AutomationExecutionMetadata} for the records,
+        with one describe_automation_executions call per batch of IDs.
+        """
+        executions = {}
+        records_by_region = {}
+        for record in records:
+            records_by_region.setdefault(record['ExecutionRegion'], []).append(record['AutomationExecutionId'])
+        for region, execution_ids in records_by_region.items():
+            paginator = get_client('ssm', region).get_paginator('describe_automation_executions')
+            for chunk in chunk_list(execution_ids, DESCRIBE_EXECUTIONS_BATCH_SIZE):
+                for page in paginator.paginate(Filters=[{'Key': 'ExecutionId', 'Values': chunk}]):
+                    for execution in page['AutomationExecutionMetadataList']:
+                        executions[execution['AutomationExecutionId']] = execution
+        return executions
+
+    def wait(self, records, deadline):
+        """
+        Polls until every execution has finished or the next poll would pass
+        deadline, and returns the last described executions. The interval
+        doubles up to max_interval while no execution changes status.
+        """
+        interval = self.min_interval
+        pending = list(records)
+        executions = {}
+        while True:
+            previous = {execution_id: execution['AutomationExecutionStatus'] for execution_id, execution in executions.items()}
+            executions.update(self.describe(pending))
+            pending = [record for record in pending if get_execution_state(
+                executions.get(record['AutomationExecutionId'], {}).get('AutomationExecutionStatus')) == RUN_RUNNING]
+            changed = not previous or any(executions[execution_id]['AutomationExecutionStatus'] != status for execution_id, status in previous.items())
+            interval = self.min_interval if changed else min(self.max_interval, interval * 2)
+            if not pending or self.clock() + interval >= deadline:
+                return executions
+            self.sleep(interval)
+
+
+def find_run_executions(ssm_client, run_id, started_after):
+    """
+    Returns the top level Automation executions started after started_after
+    (an ISO 8601 UTC string) that are tagged with run_id, filtered by
+    describe_automation_executions itself.
+    """
+    executions = []
+    paginator = ssm_client.get_paginator('describe_automation_executions')
+    for page in paginator.paginate(Filters=[{'Key': 'StartTimeAfter', 'Values': [started_after]},
+                                            {'Key': 'TagKey', 'Values': [RUN_TAG_KEY_PREFIX + run_id]}]):
+        executions.extend(execution for execution in page['AutomationExecutionMetadataList']
+                          if not execution.get('ParentAutomationExecutionId'))
+    return executions
+
+
+def summarize_account_executions(run_id, execution_region, executions_by_account, now=None):
+    """
+    Summarizes the executions find_run_executions returned per account, so
+    a run can be tracked by its tag without the records of the
+    asynchronously invoked task lambdas.
+    """
+    records = []
+    executions = {}
+    for account, account_executions in sorted(executions_by_account.items()):
+        for execution in account_executions:
+            execution_id = execution['AutomationExecutionId']
+            records.append({
+                'AutomationExecutionId': execution_id,
+                'RunId': run_id,
+                'ExecutionRegion': execution_region,
+                'Account': account,
+                'DocumentName': execution.get('DocumentName')
+            })
+            executions[execution_id] = execution
+    summary = summarize_run(records, executions, now)
+    summary['ExecutionCount'] = len(records)
+    return summary
+
+
+def track_executions(records, remaining_seconds, poller=None):
+    """
+    Polls the records for up to remaining_seconds and returns the run
+    summary. A RUNNING status means the caller should track the run again.
+    """
+    poller = poller or ExecutionPoller()
+    executions = poller.wait(records, poller.clock() + remaining_seconds)
+    return summarize_run(records, executions)
+
+
+def summarize_run(records, executions, now=None):
+    """
+    Aggregates polled executions into a run status with counts per state,
+    the latency of finished executions and the oldest still running ones.
+    """
+    now = now or datetime.now(timezone.utc)
+    counts = {RUN_RUNNING: 0, RUN_SUCCEEDED: 0, RUN_FAILED: 0, RUN_TIMED_OUT: 0}
+    durations = []
+    stragglers = []
+    for record in records:
+        execution = executions.get(record['AutomationExecutionId'], {})
+        state = get_execution_state(execution.get('AutomationExecutionStatus'))
+        counts[state] += 1
+        start_time = execution.get('ExecutionStartTime')
+        if state != RUN_RUNNING and start_time and execution.get('ExecutionEndTime'):
+            durations.append((execution['ExecutionEndTime'] - start_time).total_seconds())
+        elif state == RUN_RUNNING and start_time:
+            stragglers.append(dict(record, RunningSeconds=int((now - start_time).total_seconds())))
+    if counts[RUN_RUNNING]:
+        status = RUN_RUNNING
+    elif counts[RUN_FAILED]:
+        status = RUN_FAILED
+    elif counts[RUN_TIMED_OUT]:
+        status = RUN_TIMED_OUT
+    else:
+        status = RUN_SUCCEEDED
+    durations.sort()
+    stragglers.sort(key=lambda straggler: straggler['RunningSeconds'], reverse=True)
+    return {
+        'Status': status,
+        'Counts': counts,
+        'MedianSeconds': int(durations[len(durations) // 2]) if durations else None,
+        'MaxSeconds': int(durations[-1]) if durations else None,
+        'Stragglers': stragglers[:MAX_LISTED_STRAGGLERS]
+    }
@@ -0,0 +1,83 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import math
+from patching_tracking import RUN_FAILED, RUN_RUNNING, RUN_TIMED_OUT
+
+WAVES_BY_PERCENTAGE = 'percentage'
+WAVES_BY_OU = 'ou'
+WAVES_BY_TAG = 'tag'
+
+DEFAULT_WAVE_WAIT_SECONDS = 600
+DEFAULT_MAX_FAILURE_RATE = 0.1
+DEFAULT_MAX_WAVE_CHECKS = 6
+
+DECISION_PLAN = 'PLAN'
+DECISION_DISPATCH = 'DISPATCH'
+DECISION_WAIT = 'WAIT'
+DECISION_HALT = 'HALT'
+DECISION_DONE = 'DONE'
+
+# Count of the wave's accounts that could not be dispatched to or checked.
+ACCOUNTS_UNCHECKED = 'UNCHECKED'
+
+
+def plan_waves(account_ids, wave_config, get_ous=None, get_tags=None):
+    """
+    Partitions accounts into waves. wave_config is one of:
+      {'Strategy': 'percentage', 'Percentages': [5, 25, 100]} - cumulative
+          share of the accounts patched once each wave is done
+      {'Strategy': 'ou', 'OrganizationalUnits': [['ou-a'], ['ou-b', 'ou-c']]}
+      {'Strategy': 'tag', 'TagKey': 'patch_wave', 'TagValues': [['canary'], ['early']]}
+    OUs are given by ID or name and match every account below them. Accounts
+    not matched by an OU or tag wave form a last wave. Empty waves are
+    dropped. get_ous(account_id) returns the IDs and names of the OUs
+    containing the account and get_tags(account_id) its tags as a dict.
+    """
+    account_ids = sorted(account_ids)
+    strategy = wave_config.get('Strategy', WAVES_BY_PERCENTAGE)
+    if strategy == WAVES_BY_PERCENTAGE:
+        waves = []
+        start = 0
+        for percentage in wave_config.get('Percentages', [100]):
+            end = min(len(account_ids), int(math.ceil(len(account_ids) * float(percentage) / 100)))
+            waves.append(account_ids[start:end])
+            start = max(start, end)
+        waves.append(account_ids[start:])
+    elif strategy in (WAVES_BY_OU, WAVES_BY_TAG):
+        if strategy == WAVES_BY_OU:
+            wave_values = wave_config['OrganizationalUnits']
+            account_values = {account_id: get_ous(account_id) for account_id in account_ids}
+        else:
+            wave_values = wave_config['TagValues']
+            account_values = {account_id: [get_tags(account_id).get(wave_config['TagKey'])] for account_id in account_ids}
+        waves = [[] for values in wave_values] + [[]]
+        for account_id in account_ids:
+            wave_index = len(wave_values)
+            for index, values in enumerate(wave_values):
+                if any(value in values for value in account_values[account_id]):
+                    wave_index = index
+                    break
+            waves[wave_index].append(account_id)
+    else:
+        raise ValueError('Unknown wave strategy ' + str(strategy))
+    return [wave for wave in waves if wave]
+
+
+def evaluate_wave(counts, checks, max_failure_rate=DEFAULT_MAX_FAILURE_RATE, max_checks=DEFAULT_MAX_WAVE_CHECKS):
+    """
+    Decides from the execution state counts of a wave whether to halt the
+    rollout, keep waiting or move on. The failure rate counts failed and
+    timed out executions, and the accounts that could not be dispatched to
+    or checked, against every execution and unchecked account of the wave.
+    A wave moves on once nothing is running, or after max_checks checks so
+    stragglers do not hold up the rollout. A wave with no executions yet
+    waits, as its task lambdas may still be starting them.
+    """
+    total = sum(counts.values())
+    failed = counts.get(RUN_FAILED, 0) + counts.get(RUN_TIMED_OUT, 0) + counts.get(ACCOUNTS_UNCHECKED, 0)
+    if total and float(failed) / total > max_failure_rate:
+        return DECISION_HALT
+    if (total and not counts.get(RUN_RUNNING, 0)) or checks >= max_checks:
+        return DECISION_DISPATCH
+    return DECISION_WAIT
@@ -1,52 +1,390 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
+import base64
 import json
 import datetime
+import os
 import time
-import boto3
+from patching_clients import get_client
+from patching_metrics import invocation_metrics
+
+# describe_auto_scaling_groups takes at most this many names per call.
+DESCRIBE_ASGS_BATCH_SIZE = 50
+# Launch configuration names are at most this long.
+LAUNCH_CONFIGURATION_NAME_LIMIT = 255
+# Attributes of a described launch configuration that are not copied to the
+# patched one.
+LC_SKIPPED_KEYS = ('LaunchConfigurationName', 'LaunchConfigurationARN', 'CreatedTime', 'ImageId')
+# Prefix of the launch configurations this function creates, which it
+# deletes once their ASG has moved on.
+LC_PREFIX = 'LC ami-'
+# Instance refreshes running at once per account and region, and per
+# availability zone.
+MAX_CONCURRENT_REFRESHES = int(os.environ.get("MAX_CONCURRENT_REFRESHES", "3"))
+MAX_CONCURRENT_REFRESHES_PER_AZ = int(os.environ.get("MAX_CONCURRENT_REFRESHES_PER_AZ", "2"))
+# Tag claiming a refresh slot for its ASG: '<claimed at> [<refresh ID>]'.
+REFRESH_TAG = 'PatchingInstanceRefresh'
+# A claim without a refresh ID is dropped after this long, as the invocation
+# that made it stopped before starting the refresh.
+CLAIM_TIMEOUT_SECONDS = 300
+ACTIVE_REFRESH_STATUSES = ('Pending', 'InProgress', 'Cancelling', 'RollbackInProgress', 'Baking')
+# Used when the ASG has neither a default instance warmup nor a health check
+# grace period.
+DEFAULT_INSTANCE_WARMUP = 120
+REFRESH_POLL_SECONDS = 30
+REFRESH_DEADLINE_MARGIN_SECONDS = 30
 
 print('Loading function')
 
 
+def without_snapshots(block_device_mappings, image_devices):
+    """
+    Returns the block device mappings without the EBS snapshot IDs of the
+    devices in image_devices, so those volumes, the root volume included,
+    come from the snapshots of the new AMI instead of the old one.
+    """
+    mappings = []
+    for mapping in block_device_mappings:
+        if 'Ebs' in mapping and mapping.get('DeviceName') in image_devices:
+            mapping = dict(mapping, Ebs={key: value for key, value in mapping['Ebs'].items() if key != 'SnapshotId'})
+        mappings.append(mapping)
+    return mappings
+
+
+def get_image_devices(ec2_client, ami_id):
+    """
+    Returns the device names the AMI maps, its root device included.
+    """
+    image = ec2_client.describe_images(ImageIds=[ami_id])['Images'][0]
+    image_devices = [mapping['DeviceName'] for mapping in image.get('BlockDeviceMappings', [])]
+    if image.get('RootDeviceName'):
+        image_devices.append(image['RootDeviceName'])
+    return image_devices
+
+
+def new_template_version(ec2_client, spec, new_ami_id, created):
+    """
+    Returns the launch template spec to use instead of spec: a new version of
+    the template with ImageId changed and the snapshots of the devices the
+    new AMI maps dropped. ASGs on the same template version share the new
+    version. ASGs on $Latest keep their spec, as the new version becomes the
+    latest.
+    """
+    template = {key: spec[key] for key in ('LaunchTemplateId', 'LaunchTemplateName') if key in spec}
+    version = spec.get('Version', '$Default')
+    key = ('launch-template', json.dumps(template, sort_keys=True), version)
+    if key not in created:
+        source = ec2_client.describe_launch_template_versions(Versions=[version], **template)['LaunchTemplateVersions'][0]
+        template_data = {'ImageId': new_ami_id}
+        block_device_mappings = source.get('LaunchTemplateData', {}).get('BlockDeviceMappings')
+        if block_device_mappings:
+            template_data['BlockDeviceMappings'] = without_snapshots(block_device_mappings, get_image_devices(ec2_client, new_ami_id))
+        created[key] = ec2_client.create_launch_template_version(
+            SourceVersion=str(source['VersionNumber']),
+            LaunchTemplateData=template_data,
+            VersionDescription='Patched AMI ' + new_ami_id, **template)['LaunchTemplateVersion']
+    if version == '$Latest':
+        return None
+    return {'LaunchTemplateId': created[key]['LaunchTemplateId'], 'Version': str(created[key]['VersionNumber'])}
+
+
+def original_name(name):
+    """
+    Returns the name of the launch configuration a patched copy, named
+    'LC <AMI> <date>  <time> <original>', was first made from.
+    """
+    if name.startswith(LC_PREFIX):
+        return ' '.join(name.split(' ')[5:])
+    return name
+
+
+def new_launch_configuration(as_client, ec2_client, source_name, new_ami_id, created):
+    """
+    Returns the name of a copy of the launch configuration with new_ami_id,
+    shared by the ASGs using the same configuration. The copy is made from
+    the configuration, not an instance, so empty ASGs are updated too.
+    """
+    key = ('launch-configuration', source_name)
+    if key not in created:
+        config = as_client.describe_launch_configurations(LaunchConfigurationNames=[source_name])['LaunchConfigurations'][0]
+        arguments = {key: value for key, value in config.items() if key not in LC_SKIPPED_KEYS and value not in ('', [], None)}
+        if 'UserData' in arguments:
+            # Kept as bytes, as user data may be binary or gzipped; botocore
+            # encodes it again.
+            arguments['UserData'] = base64.b64decode(arguments['UserData'])
+        if 'BlockDeviceMappings' in arguments:
+            arguments['BlockDeviceMappings'] = without_snapshots(arguments['BlockDeviceMappings'], get_image_devices(ec2_client, new_ami_id))
+        timeStampString = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d  %H-%M-%S')
+        name = ('LC '+ new_ami_id + ' ' + timeStampString + ' ' + original_name(source_name)).strip()[:LAUNCH_CONFIGURATION_NAME_LIMIT]
+        as_client.create_launch_configuration(LaunchConfigurationName=name, ImageId=new_ami_id, **arguments)
+        created[key] = name
+    return created[key]
+
+
+def update_asg(as_client, ec2_client, group, new_ami_id, created):
+    """
+    Points the ASG at new_ami_id through its launch template, mixed instances
+    policy template or launch configuration, and returns what changed.
+    """
+    asg_name = group['AutoScalingGroupName']
+    mixed_spec = group.get('MixedInstancesPolicy', {}).get('LaunchTemplate', {}).get('LaunchTemplateSpecification')
+    if 'LaunchTemplate' in group or mixed_spec:
+        spec = new_template_version(ec2_client, group.get('LaunchTemplate') or mixed_spec, new_ami_id, created)
+        if spec is not None and 'LaunchTemplate' in group:
+            as_client.update_auto_scaling_group(AutoScalingGroupName=asg_name, LaunchTemplate=spec)
+        elif spec is not None:
+            as_client.update_auto_scaling_group(AutoScalingGroupName=asg_name,
+                MixedInstancesPolicy={'LaunchTemplate': {'LaunchTemplateSpecification': spec}})
+        return {'LaunchTemplate': spec or group.get('LaunchTemplate') or mixed_spec}
+    if 'LaunchConfigurationName' not in group:
+        raise Exception('No launch configuration or launch template')
+    name = new_launch_configuration(as_client, ec2_client, group['LaunchConfigurationName'], new_ami_id, created)
+    as_client.update_auto_scaling_group(AutoScalingGroupName=asg_name, LaunchConfigurationName=name)
+    return {'LaunchConfigurationName': name, 'ReplacedLaunchConfigurationName': group['LaunchConfigurationName']}
+
+
+def delete_launch_configurations(as_client, names):
+    """
+    Deletes the launch configurations this function created earlier that no
+    ASG uses any more, so they do not pile up.
+    """
+    for name in sorted(name for name in names if name.startswith(LC_PREFIX)):
+        try:
+            as_client.delete_launch_configuration(LaunchConfigurationName=name)
+        except Exception as exp:
+            print('Keeping launch configuration ' + name + ' ' + str(exp))
+
+
+class RefreshOrchestrator(object):
+    """
+    # Class: RefreshOrchestrator
+    # Description: Starts instance refreshes while fewer than max_refreshes
+    # run in the region and fewer than max_refreshes_per_az touch each of the
+    # ASG's availability zones. Every starting or running refresh is claimed
+    # with REFRESH_TAG on its ASG, so all invocations count the same slots
+    """
+
+    def __init__(self, as_client, max_refreshes=MAX_CONCURRENT_REFRESHES, max_refreshes_per_az=MAX_CONCURRENT_REFRESHES_PER_AZ):
+        self.as_client = as_client
+        self.max_refreshes = max_refreshes
+        self.max_refreshes_per_az = max_refreshes_per_az
+
+    def get_claims(self):
+        """
+        Returns {ASG name: (claimed at, refresh ID or None, AZs)} for the
+        refreshes starting or running, and releases the other claims.
+        """
+        claims = {}
+        paginator = self.as_client.get_paginator('describe_auto_scaling_groups')
+        for page in paginator.paginate(Filters=[{'Name': 'tag-key', 'Values': [REFRESH_TAG]}]):
+            for group in page['AutoScalingGroups']:
+                asg_name = group['AutoScalingGroupName']
+                value = [tag['Value'] for tag in group['Tags'] if tag['Key'] == REFRESH_TAG][0]
+                claimed_at, _, refresh_id = value.partition(' ')
+                try:
+                    claimed_at = float(claimed_at)
+                except ValueError:
+                    print('Releasing malformed ' + REFRESH_TAG + ' claim on ' + asg_name + ': ' + value)
+                    self.release(asg_name)
+                    continue
+                if self.is_active(asg_name, claimed_at, refresh_id or None):
+                    claims[asg_name] = (claimed_at, refresh_id or None, group['AvailabilityZones'])
+                else:
+                    self.release(asg_name)
+        return claims
+
+    def is_active(self, asg_name, claimed_at, refresh_id):
+        if refresh_id is None:
+            return time.time() - claimed_at < CLAIM_TIMEOUT_SECONDS
+        refreshes = self.as_client.describe_instance_refreshes(
+            AutoScalingGroupName=asg_name, InstanceRefreshIds=[refresh_id])['InstanceRefreshes']
+        return bool(refreshes) and refreshes[0]['Status'] in ACTIVE_REFRESH_STATUSES
+
+    def fits(self, group, claims):
+        others = [claim for asg_name, claim in claims.items() if asg_name != group['AutoScalingGroupName']]
+        if len(others) >= self.max_refreshes:
+            return False
+        return all(sum(zone in claim[2] for claim in others) < self.max_refreshes_per_az
+                   for zone in group['AvailabilityZones'])
+
+    def start(self, group, retain_healthy_percentage, claims):
+        """
+        Starts the group's refresh when it fits next to claims. Returns the
+        refresh ID, or None, and the claims now held. The slot is claimed
+        before the refresh starts and the claims are read again, so when
+        invocations race for the last slots the earliest claims win and the
+        others back off.
+        """
+        asg_name = group['AutoScalingGroupName']
+        if asg_name in claims and claims[asg_name][1] is not None:
+            return claims[asg_name][1], claims
+        if not self.fits(group, claims):
+            return None, claims
+        self.tag(asg_name, '%.3f' % time.time())
+        claims = self.get_claims()
+        claim = claims.get(asg_name)
+        if claim is None or not self.fits(group, {other: other_claim for other, other_claim in claims.items()
+                                                  if (other_claim[0], other) < (claim[0], asg_name)}):
+            self.release(asg_name)
+            claims.pop(asg_name, None)
+            return None, claims
+        refresh_id = self.as_client.start_instance_refresh(
+            AutoScalingGroupName=asg_name,
+            Strategy='Rolling',
+            Preferences={
+                'MinHealthyPercentage': int(retain_healthy_percentage),
+                'InstanceWarmup': get_instance_warmup(group)
+            })['InstanceRefreshId']
+        self.tag(asg_name, '%.3f %s' % (claim[0], refresh_id))
+        claims[asg_name] = (claim[0], refresh_id, group['AvailabilityZones'])
+        return refresh_id, claims
+
+    def tag(self, asg_name, value):
+        self.as_client.create_or_update_tags(Tags=[{
+            'ResourceId': asg_name, 'ResourceType': 'auto-scaling-group', 'Key': REFRESH_TAG, 'Value': value, 'PropagateAtLaunch': False}])
+
+    def release(self, asg_name):
+        self.as_client.delete_tags(Tags=[{'ResourceId': asg_name, 'ResourceType': 'auto-scaling-group', 'Key': REFRESH_TAG}])
+
+
+def get_instance_warmup(group):
+    """
+    New instances count as healthy after the ASG's own default warmup or,
+    without one, its health check grace period.
+    """
+    return group.get('DefaultInstanceWarmup') or group.get('HealthCheckGracePeriod') or DEFAULT_INSTANCE_WARMUP
+
+
+def describe_groups(as_client, asg_names):
+    for index in range(0, len(asg_names), DESCRIBE_ASGS_BATCH_SIZE):
+        chunk = asg_names[index:index + DESCRIBE_ASGS_BATCH_SIZE]
+        for group in as_client.describe_auto_scaling_groups(AutoScalingGroupNames=chunk)['AutoScalingGroups']:
+            yield group
+
+
+def start_refresh(as_client, asg_name, retain_healthy_percentage, context):
+    """
+    Starts the ASG's refresh as soon as a slot is free, polling until
+    shortly before the invocation times out. Raises when no slot freed up,
+    so the automation step retries. Returns the refresh ID, also when the
+    refresh was already started.
+    """
+    group = next(describe_groups(as_client, [asg_name]), None)
+    if group is None:
+        return {'Status': 'NOT_FOUND'}
+    orchestrator = RefreshOrchestrator(as_client)
+    deadline = None
+    if context is not None:
+        deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000.0 - REFRESH_DEADLINE_MARGIN_SECONDS
+    while True:
+        refresh_id, claims = orchestrator.start(group, retain_healthy_percentage, orchestrator.get_claims())
+        if refresh_id is not None:
+            return {'Status': 'REFRESHING', 'InstanceRefreshId': refresh_id}
+        print('Waiting for a refresh slot for ' + asg_name + ', ' + str(len(claims)) + ' refreshes running')
+        if deadline is None or time.monotonic() + REFRESH_POLL_SECONDS > deadline:
+            raise Exception('No instance refresh slot for ' + asg_name)
+        time.sleep(REFRESH_POLL_SECONDS)
+
+
+def report_refreshes(as_client, asg_names):
+    """
+    Reports the latest refresh of every ASG with the instances it replaced
+    per minute, and the rate over all of them for capacity planning.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    results = {asg_name: {'Status': 'NOT_FOUND'} for asg_name in asg_names}
+    replaced_total = 0
+    started_at = ended_at = None
+    for group in describe_groups(as_client, asg_names):
+        asg_name = group['AutoScalingGroupName']
+        refreshes = as_client.describe_instance_refreshes(AutoScalingGroupName=asg_name, MaxRecords=1)['InstanceRefreshes']
+        if not refreshes or 'StartTime' not in refreshes[0]:
+            results[asg_name] = {'Status': 'NOT_STARTED'}
+            continue
+        refresh = refreshes[0]
+        end = refresh.get('EndTime') or now
+        minutes = (end - refresh['StartTime']).total_seconds() / 60
+        replaced = group['DesiredCapacity'] * refresh.get('PercentageComplete', 0) / 100.0
+        results[asg_name] = {
+            'Status': refresh['Status'],
+            'InstanceRefreshId': refresh['InstanceRefreshId'],
+            'PercentageComplete': refresh.get('PercentageComplete', 0),
+            'Minutes': round(minutes, 1),
+            'InstancesPerMinute': round(replaced / minutes, 2) if minutes > 0 else 0
+        }
+        replaced_total += replaced
+        started_at = min(started_at or refresh['StartTime'], refresh['StartTime'])
+        ended_at = max(ended_at or end, end)
+    # Releases the claims of the refreshes that have ended.
+    RefreshOrchestrator(as_client).get_claims()
+    minutes = (ended_at - started_at).total_seconds() / 60 if started_at is not None else 0
+    return {
+        'AutoScalingGroups': results,
+        'InstancesReplaced': round(replaced_total),
+        'InstancesPerMinute': round(replaced_total / minutes, 2) if minutes > 0 else 0
+    }
+
+
+@invocation_metrics('UpdateASG')
 def lambda_handler(event, context):
+    """
+    Points every ASG in targetASG, a comma separated list of the ASGs that
+    share the baked AMI, at newAmiID. When refreshASGInstances is Yes it
+    starts the refreshes that fit in the concurrency limits right away; the
+    others are left WAITING for start_refresh. Returns per ASG what changed
+    and the refresh ID. An ASG that no longer exists is skipped; a failed
+    ASG does not stop the others, but fails the invocation at the end.
+
+    With action start_refresh it starts the refresh of the one ASG in
+    targetASG, waiting for a slot, and with action report_refreshes it
+    reports the refreshes of the ASGs in targetASG.
+    """
     print("Received event: " + json.dumps(event, indent=2))
 
-    target_asg = event['targetASG']
+    action = event.get('action', 'update')
+    target_asgs = [asg_name for asg_name in event['targetASG'].split(',') if asg_name]
+    as_client = get_client('autoscaling')
+    if action == 'start_refresh':
+        return start_refresh(as_client, target_asgs[0], event['retainHealthyPercentage'], context)
+    if action == 'report_refreshes':
+        return report_refreshes(as_client, target_asgs)
+
     new_ami_id = event['newAmiID']
     retain_healthy_percentage = event['retainHealthyPercentage']
     refresh_asg_instances = event['refreshASGInstances']
-    # get autoscaling client
-    client = boto3.client('autoscaling')
-
-    # get object for the ASG we're going to update, filter by name of target ASG
-    response = client.describe_auto_scaling_groups(AutoScalingGroupNames=[target_asg])
-
-    if not response['AutoScalingGroups']:
-        return 'No such ASG'
-
-    # get name of InstanceID in current ASG that we'll use to model new Launch Configuration after
-    sourceInstanceId = response.get('AutoScalingGroups')[0]['Instances'][0]['InstanceId']
-
-    # create LC using instance from target ASG as a template, only diff is the name of the new LC and new AMI
-    timeStamp = time.time()
-    timeStampString = datetime.datetime.fromtimestamp(timeStamp).strftime('%Y-%m-%d  %H-%M-%S')
-    newLaunchConfigName = 'LC '+ new_ami_id + ' ' + timeStampString
-    client.create_launch_configuration(
-        InstanceId = sourceInstanceId,
-        LaunchConfigurationName=newLaunchConfigName,
-        ImageId= new_ami_id )
-
-    # update ASG to use new LC
-    response = client.update_auto_scaling_group(AutoScalingGroupName = target_asg,LaunchConfigurationName = newLaunchConfigName)
-    
-    if refresh_asg_instances == 'Yes':
-        response = client.start_instance_refresh(
-            AutoScalingGroupName=target_asg,
-            Strategy='Rolling',
-            Preferences={
-                'MinHealthyPercentage': int(retain_healthy_percentage),
-                'InstanceWarmup': 120
-            })
-    
-    return 'Updated ASG `%s` with new launch configuration `%s` which includes AMI `%s`.' % (event['targetASG'], newLaunchConfigName, new_ami_id)
\ No newline at end of file
+    ec2_client = get_client('ec2')
+
+    results = {asg_name: {'Status': 'NOT_FOUND'} for asg_name in target_asgs}
+    updated = []
+    created = {}
+    for group in describe_groups(as_client, target_asgs):
+        asg_name = group['AutoScalingGroupName']
+        result = results[asg_name] = {'Status': 'FAILED'}
+        try:
+            result.update(update_asg(as_client, ec2_client, group, new_ami_id, created))
+            result['Status'] = 'UPDATED'
+            updated.append(group)
+        except Exception as exp:
+            result['Error'] = str(exp)
+    delete_launch_configurations(as_client, {result.pop('ReplacedLaunchConfigurationName') for result in results.values()
+                                             if 'ReplacedLaunchConfigurationName' in result})
+    if refresh_asg_instances == 'Yes' and updated:
+        orchestrator = RefreshOrchestrator(as_client)
+        claims = orchestrator.get_claims()
+        for group in updated:
+            result = results[group['AutoScalingGroupName']]
+            try:
+                refresh_id, claims = orchestrator.start(group, retain_healthy_percentage, claims)
+            except Exception as exp:
+                result.update(Status='FAILED', Error=str(exp))
+                continue
+            if refresh_id is None:
+                result['RefreshStatus'] = 'WAITING'
+            else:
+                result['InstanceRefreshId'] = refresh_id
+    print('Results ' + json.dumps(results))
+    failed = [asg_name for asg_name in target_asgs if results[asg_name]['Status'] == 'FAILED']
+    if failed:
+        raise Exception('Failed updating ASGs ' + ','.join(failed))
+    return {'NewAmiID': new_ami_id, 'AutoScalingGroups': results}
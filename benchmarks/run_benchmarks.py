@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Runs the patching Lambdas against the in-memory AWS stand-in and reports,
+# per handler, the wall time against the function's timeout, the API calls
+# per service and the peak memory allocated by the handler. Every handler
+# run starts from a freshly seeded world and cold module caches.
+#
+#   python3 benchmarks/run_benchmarks.py --scale large --latency-ms 20
+#   python3 benchmarks/run_benchmarks.py --scale small --only tagging --json results.json
+
+import argparse
+import collections
+import contextlib
+import datetime
+import importlib
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCHMARKS_DIR)
+sys.path[:0] = [os.path.join(REPO_ROOT, 'Lambdas'), os.path.join(REPO_ROOT, 'crhelper.zip', 'python')]
+
+from standin import DEFAULT_REGIONS, HOME_ACCOUNT, World, installed
+
+SCALES = {
+    'small': {'accounts': 10, 'regions': 2, 'instances': 1000, 'asgs': 50},
+    'medium': {'accounts': 200, 'regions': 4, 'instances': 10000, 'asgs': 500},
+    'large': {'accounts': 1000, 'regions': 4, 'instances': 50000, 'asgs': 3000},
+}
+# Timeouts from patching-stack.yml and patching-stackset.yml.
+TIMEOUTS = {
+    'emergency_patching': 300,
+    'maintenance_window_creation': 60,
+    'maintenance_window_tagging': 360,
+    'maintenance_window_task': 900,
+    'maintenance_window_asg_task': 900,
+    'patch_tag_monitoring': 60,
+    'update_asg': 300,
+}
+# SQS batch size used for the tag monitoring batch benchmark.
+TAG_MONITORING_BATCH_SIZE = 1000
+# CPU cost of creating boto3 clients, measured on a Lambda with 128 MB: a
+# session loading its data on first use, and every client after that.
+SESSION_SECONDS = 0.12
+CLIENT_SECONDS = 0.008
+
+
+class Context(object):
+    """
+    Lambda context whose remaining time counts down from the function's
+    timeout.
+    """
+
+    def __init__(self, function_name, timeout):
+        self.function_name = function_name
+        self.deadline = time.monotonic() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return int(max(0, self.deadline - time.monotonic()) * 1000)
+
+
+def set_environment(regions):
+    os.environ.setdefault('AWS_DEFAULT_REGION', regions[0])
+    os.environ.update({
+        'WORKLOAD_REGIONS': ','.join(regions),
+        'PATCHING_TEMPLATE_REGION': regions[0],
+        'EXECUTION_ROLE_NAME': 'AWS-SystemsManager-AutomationExecutionRole',
+        'ADMINISTRATION_ROLE_NAME': 'AWS-SystemsManager-AutomationAdministrationRole',
+        'DOCUMENT_NAME': 'PatchingAutomation',
+        'ASG_UPDATE_LAMBDA_NAME': 'UpdateASGFunction',
+        'ASG_EXECUTION_ROLE_NAME': 'ASGPatchingRole',
+        'ASG_DOCUMENT_NAME': 'ASGPatchingAutomation',
+        'PROFILE_ROLE_NAME': 'PatchingInstanceProfile',
+        'MW_TASK_LAMBDA_ARN': 'arn:aws:lambda:::function:MaintenanceWindowTaskFunction',
+        'MW_ASG_TASK_LAMBDA_ARN': 'arn:aws:lambda:::function:MaintenanceWindowASGTaskFunction',
+        'SERVICE_ROLE_ARN': 'arn:aws:iam:::role/MaintenanceWindowRole',
+        'TASK_LAMBDA_NAME': 'MaintenanceWindowTaskFunction',
+        'ASG_TASK_LAMBDA_NAME': 'MaintenanceWindowASGTaskFunction',
+        'CHILD_ACCOUNT_ROLE': 'PatchingChildAccountRole',
+    })
+
+
+def reset_caches():
+    """
+    Drops the state the Lambdas keep across warm invocations so every run
+    is measured cold.
+    """
+    import patching_clients
+    patching_clients.clear()
+    if 'patching_organizations' in sys.modules:
+        sys.modules['patching_organizations']._inventory = None
+    if 'patch_tag_monitoring' in sys.modules:
+        cache = sys.modules['patch_tag_monitoring'].MAINTENANCE_WINDOW_CACHE
+        cache.invalidate()
+        cache.generation_checked_at = None
+    for module_name in ('maintenance_window_tagging', 'maintenance_window_creation'):
+        if module_name in sys.modules:
+            sys.modules[module_name].helper.Data.clear()
+
+
+def home_instances(world, count):
+    instance_ids = []
+    for region in world.regions:
+        instance_ids.extend(world.state(HOME_ACCOUNT, region).instances)
+    return instance_ids[:count]
+
+
+def custom_resource_event(request_type, properties, old_properties=None):
+    event = {
+        'RequestType': request_type,
+        'ResourceProperties': properties,
+        'StackId': 'arn:aws:cloudformation:stack/patching',
+        'RequestId': 'benchmark',
+        'LogicalResourceId': 'Benchmark',
+    }
+    if old_properties is not None:
+        event['OldResourceProperties'] = old_properties
+    return event
+
+
+def task_event(operation='Install'):
+    return {
+        'env': 'Dev',
+        'include_asg': 'Yes',
+        'retain_healthy_percentage': '90',
+        'refresh_asg_instances': 'Yes',
+        'patching_operation': operation,
+        'operation_post_patching': 'RebootIfNeeded',
+        'run_patch_baseline_install_override_list': '',
+        'window_duration': 4,
+        'window_cutoff': 1,
+    }
+
+
+def tagging(module, request_type='Create', dry_run=False):
+    properties = {'Environment': 'Dev', 'IncludeASG': 'Yes'}
+    old_properties = {'Environment': 'Test', 'IncludeASG': 'Yes'} if request_type == 'Update' else None
+    event = custom_resource_event(request_type, properties, old_properties)
+
+    def run(world, context):
+        # The crhelper decorated function is called directly, which skips
+        # sending the response to CloudFormation.
+        if dry_run:
+            plan = module.lambda_handler(dict(event, dry_run=True), context)
+            return {'Changes': len(plan['Changes']), 'ApiCalls': plan['ApiCalls']['Total']}
+        module.instance_asg_tagging_main(event, context)
+        return dict(module.helper.Data)
+    return run
+
+
+def creation(module):
+    properties = {
+        'Environment': 'Prod', 'PatchingFrequency': '7', 'PatchingWindowWeekday': 'Sunday',
+        'PatchingWindowStartTime': '02', 'PatchingWindowDuration': '4', 'IncludeASG': 'Yes',
+        'RetainHealthyPercentage': '90', 'RefreshASGInstances': 'Yes', 'PatchingOperation': 'Install',
+        'OperationPostPatching': 'RebootIfNeeded'}
+
+    def run(world, context):
+        module.maintenance_main(custom_resource_event('Create', properties), context)
+        return dict(module.helper.Data)
+    return run
+
+
+def task(module, dry_run=False):
+    def run(world, context):
+        event = dict(task_event(), dry_run=True) if dry_run else task_event()
+        result = module.lambda_handler(event, context)
+        return {'Executions': len(result.get('Executions', [])), 'Plan': result.get('Plan')}
+    return run
+
+
+def asg_task(module):
+    def run(world, context):
+        result = module.lambda_handler(task_event(), context)
+        return {'Executions': len(result['Executions']),
+                'Regions': {region: region_result['Status'] for region, region_result in result['Regions'].items()}}
+    return run
+
+
+def asg_tracking(module):
+    from patching_tracking import execution_record
+
+    def run(world, context):
+        records = []
+        for region in world.regions:
+            state = world.state(HOME_ACCOUNT, region)
+            for name in list(state.groups)[:500]:
+                execution_id = world.add_execution(world.state(HOME_ACCOUNT, world.regions[0]), 'ASGPatchingAutomation', [])
+                records.append(execution_record(execution_id, 'run', world.regions[0], HOME_ACCOUNT, [region], 'Dev', name))
+        result = module.lambda_handler({'track_executions': records}, context)
+        return {'Status': result['Status'], 'Counts': result['Counts']}
+    return run
+
+
+def tag_monitoring(module, batch):
+    def run(world, context):
+        if not batch:
+            instance_id = home_instances(world, 1)[0]
+            event = {'detail': {'resourceType': 'AWS::EC2::Instance', 'resourceId': instance_id}}
+            return module.lambda_handler(event, context)
+        records = []
+        for index, instance_id in enumerate(home_instances(world, TAG_MONITORING_BATCH_SIZE)):
+            detail = {'resourceType': 'AWS::EC2::Instance', 'resourceId': instance_id}
+            records.append({'messageId': 'message-%d' % index, 'body': json.dumps({'detail': detail})})
+        result = module.lambda_handler({'Records': records}, context)
+        return {'Records': len(records), 'Failures': len(result['batchItemFailures'])}
+    return run
+
+
+def emergency(module, mode):
+    base_event = {
+        'env': 'Dev', 'include_asg': 'Yes', 'retain_healthy_percentage': '90', 'patching_operation': 'Install',
+        'operation_post_patching': 'RebootIfNeeded', 'run_patch_baseline_install_override_list': '',
+        'refresh_asg_instances': 'Yes', 'RunId': 'benchmark-run'}
+
+    def run(world, context):
+        if mode == 'cold_clients':
+            world.session_seconds = SESSION_SECONDS
+            world.client_seconds = CLIENT_SECONDS
+        if mode in ('all', 'cold_clients'):
+            result = module.lambda_handler(base_event, context)
+            return {'Dispatched': result['DispatchedCount'], 'Failed': result['FailedCount']}
+        if mode == 'plan':
+            waves = {'Strategy': 'tag', 'TagKey': 'patch_wave', 'TagValues': [['canary'], ['early']]}
+            result = module.lambda_handler(dict(base_event, Decision='PLAN', waves=waves), context)
+            return {'Waves': [len(wave) for wave in result['Waves']]}
+        # Wave check: the accounts of the wave have already started their
+        # executions, tagged with the run ID.
+        started_at = (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=1)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        wave = [account_id for account_id, account in world.accounts.items() if account['Status'] == 'ACTIVE']
+        for account_id in wave:
+            world.lambda_invoke(account_id, world.regions[0], 'MaintenanceWindowTaskFunction', json.dumps({'run_id': 'benchmark-run'}))
+        event = dict(base_event, Decision='WAIT', Waves=[wave], WaveIndex=0, WaveResults=[
+            {'Wave': 0, 'StartedAt': started_at, 'DispatchedCount': len(wave), 'FailedAccounts': [], 'Checks': 0}])
+        result = module.lambda_handler(event, context)
+        return {'Decision': result['Decision'], 'Counts': result['WaveResults'][0]['Counts']}
+    return run
+
+
+def update_asg(module):
+    def run(world, context):
+        # One bake's worth of ASGs, on launch templates and configurations.
+        names = list(world.state(HOME_ACCOUNT, world.regions[0]).groups)[:module.DESCRIBE_ASGS_BATCH_SIZE]
+        event = {'targetASG': ','.join(names), 'newAmiID': 'ami-0123456789abcdef0', 'retainHealthyPercentage': '90', 'refreshASGInstances': 'Yes'}
+        return module.lambda_handler(event, context)
+    return run
+
+
+# (benchmark name, handler module, builder of run(world, context))
+BENCHMARKS = [
+    ('maintenance_window_tagging:create', 'maintenance_window_tagging', lambda module: tagging(module)),
+    ('maintenance_window_tagging:rename', 'maintenance_window_tagging', lambda module: tagging(module, 'Update')),
+    ('maintenance_window_tagging:dry_run', 'maintenance_window_tagging', lambda module: tagging(module, dry_run=True)),
+    ('maintenance_window_creation:create', 'maintenance_window_creation', creation),
+    ('maintenance_window_task:install', 'maintenance_window_task', task),
+    ('maintenance_window_task:dry_run', 'maintenance_window_task', lambda module: task(module, dry_run=True)),
+    ('maintenance_window_asg_task:install', 'maintenance_window_asg_task', asg_task),
+    ('maintenance_window_asg_task:track', 'maintenance_window_asg_task', asg_tracking),
+    ('patch_tag_monitoring:single', 'patch_tag_monitoring', lambda module: tag_monitoring(module, batch=False)),
+    ('patch_tag_monitoring:batch', 'patch_tag_monitoring', lambda module: tag_monitoring(module, batch=True)),
+    ('emergency_patching:all_accounts', 'emergency_patching', lambda module: emergency(module, 'all')),
+    ('emergency_patching:cold_clients', 'emergency_patching', lambda module: emergency(module, 'cold_clients')),
+    ('emergency_patching:plan_waves', 'emergency_patching', lambda module: emergency(module, 'plan')),
+    ('emergency_patching:check_wave', 'emergency_patching', lambda module: emergency(module, 'check')),
+    ('update_asg', 'update_asg', update_asg),
+]
+
+
+@contextlib.contextmanager
+def quiet(verbose):
+    """
+    Silences the handlers' print and logging output, which would otherwise
+    dominate the measurement.
+    """
+    if verbose:
+        yield
+        return
+    logging.disable(logging.CRITICAL)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        try:
+            yield
+        finally:
+            logging.disable(logging.NOTSET)
+
+
+def run_once(name, module_name, build, world_args, trace_memory, verbose):
+    world = World(**world_args)
+    with installed(world), quiet(verbose):
+        module = importlib.import_module(module_name)
+        reset_caches()
+        run = build(module)
+        context = Context(module_name, TIMEOUTS[module_name])
+        # Setup calls made by the benchmark itself are not counted.
+        world.calls.clear()
+        world.throttles.clear()
+        if trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        error = None
+        try:
+            result = run(world, context)
+        except Exception as exception:
+            result = None
+            error = '%s: %s' % (type(exception).__name__, exception)
+        elapsed = time.perf_counter() - started
+        peak = None
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    return {
+        'Seconds': elapsed,
+        'PeakBytes': peak,
+        'Calls': world.calls,
+        'Throttles': world.throttles,
+        'Result': result,
+        'Error': error,
+    }
+
+
+def run_benchmark(name, module_name, build, world_args, measure_memory, verbose):
+    timed = run_once(name, module_name, build, world_args, False, verbose)
+    calls_by_service = collections.Counter()
+    for (service, operation), count in timed['Calls'].items():
+        calls_by_service[service] += count
+    result = {
+        'Benchmark': name,
+        'TimeoutSeconds': TIMEOUTS[module_name],
+        'Seconds': round(timed['Seconds'], 3),
+        'TimeoutShare': round(timed['Seconds'] / TIMEOUTS[module_name], 3),
+        'ApiCalls': sum(timed['Calls'].values()),
+        'ApiCallsByService': dict(calls_by_service),
+        'ApiCallsByOperation': {service + '.' + operation: count for (service, operation), count in sorted(timed['Calls'].items())},
+        'Throttled': sum(timed['Throttles'].values()),
+        'Result': timed['Result'],
+        'Error': timed['Error'],
+    }
+    if measure_memory:
+        # tracemalloc slows the handler down, so memory is measured in a
+        # second run on an identical world.
+        world_args = dict(world_args, latency=0.0)
+        result['PeakMiB'] = round(run_once(name, module_name, build, world_args, True, verbose)['PeakBytes'] / 1048576.0, 2)
+    return result
+
+
+def print_table(results):
+    header = '%-40s %8s %8s %6s %7s %7s %8s  %s' % ('benchmark', 'timeout', 'seconds', 'share', 'calls', 'thrott', 'peakMiB', 'calls by service')
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        services = ' '.join('%s=%d' % item for item in sorted(result['ApiCallsByService'].items()))
+        peak = '%.2f' % result['PeakMiB'] if result.get('PeakMiB') is not None else '-'
+        print('%-40s %8d %8.3f %5.0f%% %7d %7d %8s  %s' % (
+            result['Benchmark'], result['TimeoutSeconds'], result['Seconds'], result['TimeoutShare'] * 100,
+            result['ApiCalls'], result['Throttled'], peak, services))
+        if result['Error']:
+            print('    error: ' + result['Error'])
+        elif result['TimeoutShare'] >= 1:
+            print('    would time out')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the patching Lambdas against an in-memory AWS stand-in.')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--accounts', type=int, help='organization accounts (overrides --scale)')
+    parser.add_argument('--regions', type=int, help='workload regions (overrides --scale)')
+    parser.add_argument('--instances', type=int, help='instances in the benchmarked account (overrides --scale)')
+    parser.add_argument('--asgs', type=int, help='Auto Scaling groups in the benchmarked account (overrides --scale)')
+    parser.add_argument('--latency-ms', type=float, default=20.0, help='simulated latency of every API call')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of API calls answered with a throttling error')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', action='append', default=[], help='run the benchmarks whose name contains this text')
+    parser.add_argument('--no-memory', action='store_true', help='skip the peak memory run')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--verbose', action='store_true', help='show the handlers output')
+    args = parser.parse_args(argv)
+
+    scale = dict(SCALES[args.scale])
+    for key in ('accounts', 'regions', 'instances', 'asgs'):
+        if getattr(args, key) is not None:
+            scale[key] = getattr(args, key)
+    regions = DEFAULT_REGIONS[:scale['regions']]
+    world_args = {
+        'accounts': scale['accounts'],
+        'regions': regions,
+        'instances': scale['instances'],
+        'asgs': scale['asgs'],
+        'seed': args.seed,
+        'latency': args.latency_ms / 1000.0,
+        'throttle_rate': args.throttle_rate,
+    }
+    set_environment(regions)
+    print('Scale: %(accounts)d accounts, %(regions)d regions, %(instances)d instances, %(asgs)d ASGs' % scale)
+    results = []
+    for name, module_name, build in BENCHMARKS:
+        if args.only and not any(text in name for text in args.only):
+            continue
+        results.append(run_benchmark(name, module_name, build, world_args, not args.no_memory, args.verbose))
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump({'Scale': scale, 'LatencyMs': args.latency_ms, 'ThrottleRate': args.throttle_rate, 'Results': results},
+                      output, indent=2, default=str)
+    return 1 if any(result['Error'] for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
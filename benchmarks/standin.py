@@ -0,0 +1,843 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# In-memory stand-in for the AWS APIs the patching Lambdas call. A World
+# holds a synthetic organization and, for every account and region, the EC2,
+# Auto Scaling and Systems Manager resources the Lambdas read and change.
+# Clients follow the service page size limits, pagination tokens and error
+# codes closely enough to exercise the Lambdas' batching and retry paths.
+
+import base64
+import collections
+import contextlib
+import datetime
+import itertools
+import json
+import random
+import threading
+import time
+import uuid
+from botocore.exceptions import ClientError
+
+HOME_ACCOUNT = '100000000000'
+HOME_ACCOUNT_NUMBER = int(HOME_ACCOUNT)
+DEFAULT_REGIONS = ['us-east-1', 'eu-west-1', 'ap-southeast-2', 'us-west-2']
+ENVIRONMENTS = ['Dev', 'Test', 'Prod']
+# Environments that already have a maintenance window in the home account.
+WINDOW_ENVIRONMENTS = ['Dev', 'Test']
+
+# Parameter a paginator sets from PaginationConfig['PageSize'].
+PAGE_SIZE_PARAMETERS = {
+    'describe_instances': 'MaxResults',
+    'describe_auto_scaling_groups': 'MaxRecords',
+    'describe_automation_executions': 'MaxResults',
+    'list_accounts': 'MaxResults',
+    'list_accounts_for_parent': 'MaxResults',
+    'list_organizational_units_for_parent': 'MaxResults',
+}
+THROTTLING_ERROR_CODES = {
+    'ec2': 'RequestLimitExceeded',
+    'autoscaling': 'Throttling',
+}
+# Service IDs botocore uses in client event names where they differ from
+# the client name.
+SERVICE_IDS = {
+    'autoscaling': 'auto-scaling',
+}
+# botocore's standard retry mode makes up to this many attempts.
+MAX_ATTEMPTS = 3
+
+
+def error(code, message, operation):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+def paginate(items, key, kwargs, limit_parameter, default_limit, max_limit):
+    """
+    Returns one page of items as a response dict, using the NextToken and
+    page size argument of the operation.
+    """
+    limit = min(int(kwargs.get(limit_parameter) or default_limit), max_limit)
+    start = int(kwargs.get('NextToken') or 0)
+    response = {key: items[start:start + limit]}
+    if start + limit < len(items):
+        response['NextToken'] = str(start + limit)
+    return response
+
+
+def match_tag_filters(tags, filters, exclude=()):
+    """
+    Applies the tag:<key>, tag-key and tag-value filters to a boto3 Tags
+    list; other filter names are left to the caller.
+    """
+    tag_dict = {tag['Key']: tag['Value'] for tag in tags}
+    for flt in filters:
+        name = flt['Name']
+        if name in exclude:
+            continue
+        if name.startswith('tag:'):
+            if tag_dict.get(name[4:]) not in flt['Values']:
+                return False
+        elif name == 'tag-key':
+            if not any(key in tag_dict for key in flt['Values']):
+                return False
+        elif name == 'tag-value':
+            if not any(value in tag_dict.values() for value in flt['Values']):
+                return False
+    return True
+
+
+class RegionState(object):
+    """
+    # Class: RegionState
+    # Description: The resources of one account in one region
+    """
+
+    def __init__(self):
+        self.instances = collections.OrderedDict()
+        self.groups = collections.OrderedDict()
+        self.launch_configurations = {}
+        # Launch template ID to the data of its versions, version 1 first.
+        self.launch_templates = {}
+        # ASG name to its instance refreshes, latest first.
+        self.instance_refreshes = {}
+        self.subnets = {}
+        self.security_groups = {}
+        self.executions = collections.OrderedDict()
+        self.windows = collections.OrderedDict()
+        self.parameters = {}
+
+
+class World(object):
+    """
+    # Class: World
+    # Description: State behind the stand-in clients: an organization of
+    # accounts and the resources of every account and region. Only the home
+    # account, the one the child Lambdas run in, is seeded with a fleet. Every
+    # call is counted per service and operation and can be slowed down by a
+    # fixed latency or throttled at a given rate. Creating clients can be
+    # given a CPU cost: session_seconds the first time a session loads its
+    # data and client_seconds for every client.
+    """
+
+    def __init__(self, accounts=1, regions=None, instances=1000, asgs=50, seed=0, latency=0.0, throttle_rate=0.0):
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.regions = list(regions or DEFAULT_REGIONS[:1])
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.session_seconds = 0.0
+        self.client_seconds = 0.0
+        self.calls = collections.Counter()
+        self.throttles = collections.Counter()
+        self.states = {}
+        self.invocations = []
+        self.ids = itertools.count(1)
+        self.build_organization(accounts)
+        for index, region in enumerate(self.regions):
+            state = self.state(HOME_ACCOUNT, region)
+            self.seed_network(state)
+            self.seed_instances(state, self.share(instances, index))
+            self.seed_groups(state, self.share(asgs, index))
+            for env in WINDOW_ENVIRONMENTS:
+                self.add_window(state, env + '_maintenance_window')
+
+    def share(self, total, index):
+        return total // len(self.regions) + (1 if index < total % len(self.regions) else 0)
+
+    def next_id(self, prefix, width=17):
+        with self.lock:
+            return '%s-%0*x' % (prefix, width, next(self.ids))
+
+    def state(self, account, region):
+        with self.lock:
+            return self.states.setdefault((account, region), RegionState())
+
+    def build_organization(self, accounts):
+        """
+        Spreads the accounts over a two level OU tree, about 50 accounts per
+        OU, with a few suspended accounts and a patch_wave tag on each.
+        """
+        self.roots = [{'Id': 'r-root', 'Name': 'Root', 'Arn': 'arn:aws:organizations::root/r-root'}]
+        self.ous = collections.OrderedDict()
+        self.children = {'r-root': []}
+        self.accounts = collections.OrderedDict()
+        self.account_tags = {}
+        self.account_parents = collections.defaultdict(list)
+        top_level = ['Workloads', 'Sandbox', 'Security']
+        for name in top_level:
+            self.add_ou('r-root', name)
+        parents = []
+        for index in range(max(1, accounts // 50)):
+            parents.append(self.add_ou(self.children['r-root'][index % len(top_level)], 'Team%d' % index))
+        waves = ['canary', 'early', 'late', 'late']
+        for index in range(accounts):
+            account_id = HOME_ACCOUNT if index == 0 else '%012d' % (HOME_ACCOUNT_NUMBER + index)
+            status = 'SUSPENDED' if index and self.random.random() < 0.02 else 'ACTIVE'
+            self.accounts[account_id] = {
+                'Id': account_id,
+                'Arn': 'arn:aws:organizations::account/' + account_id,
+                'Email': account_id + '@example.com',
+                'Name': 'account-%d' % index,
+                'Status': status,
+                'JoinedMethod': 'CREATED',
+            }
+            self.account_tags[account_id] = [{'Key': 'patch_wave', 'Value': waves[index % len(waves)]}]
+            self.account_parents[parents[index % len(parents)]].append(account_id)
+
+    def add_ou(self, parent_id, name):
+        ou_id = 'ou-root-%08x' % (len(self.ous) + 1)
+        self.ous[ou_id] = {'Id': ou_id, 'Name': name, 'Arn': 'arn:aws:organizations::ou/' + ou_id}
+        self.children.setdefault(parent_id, []).append(ou_id)
+        self.children[ou_id] = []
+        return ou_id
+
+    def seed_network(self, state):
+        for vpc_index in range(3):
+            vpc_id = self.next_id('vpc')
+            for subnet_index in range(4):
+                subnet_id = self.next_id('subnet')
+                state.subnets[subnet_id] = {'SubnetId': subnet_id, 'VpcId': vpc_id, 'AvailabilityZone': 'abc'[subnet_index % 3]}
+            if vpc_index < 2:
+                group_id = self.next_id('sg')
+                state.security_groups[group_id] = {
+                    'GroupId': group_id,
+                    'GroupName': 'ASGPatchingSG',
+                    'VpcId': vpc_id,
+                    'IpPermissionsEgress': [{'IpProtocol': '-1', 'IpRanges': [{'CidrIp': '0.0.0.0/0'}]}] if vpc_index == 0 else [],
+                }
+
+    def seed_instances(self, state, count):
+        """
+        Instances carry a mix of environments, with some already tagged for
+        patching and some exempt (in an ASG, opted out, EKS or ECS nodes).
+        """
+        for index in range(count):
+            instance_id = self.next_id('i')
+            draw = self.random.random()
+            tags = []
+            if draw < 0.9:
+                env = ENVIRONMENTS[index % len(ENVIRONMENTS)]
+                tags.append({'Key': 'environment', 'Value': env})
+                if draw < 0.2:
+                    tags.extend([{'Key': 'Patch Group', 'Value': env},
+                                 {'Key': 'maintenance_window', 'Value': env + '_maintenance_window'}])
+            exemption = self.random.random()
+            if exemption < 0.05:
+                tags.append({'Key': 'aws:autoscaling:groupName', 'Value': 'asg-unmanaged'})
+            elif exemption < 0.07:
+                tags.append({'Key': 'install_patch', 'Value': 'no'})
+            elif exemption < 0.09:
+                tags.append({'Key': 'k8s.io/cluster-autoscaler/enabled', 'Value': 'true'})
+            tags.append({'Key': 'Name', 'Value': 'workload-%d' % index})
+            state.instances[instance_id] = {
+                'InstanceId': instance_id,
+                'ImageId': 'ami-%017x' % (index % 40),
+                'InstanceType': 't3.medium',
+                'State': {'Code': 16, 'Name': 'running'} if self.random.random() < 0.9 else {'Code': 80, 'Name': 'stopped'},
+                'SubnetId': self.random.choice(list(state.subnets)),
+                'Tags': tags,
+            }
+
+    def seed_groups(self, state, count):
+        """
+        Groups share launch configurations and templates in pools, as fleets
+        built from a few golden images do.
+        """
+        subnet_ids = list(state.subnets)
+        pool = max(1, count // 10)
+        for index in range(count):
+            group_subnet_ids = [subnet_ids[(index + offset) % len(subnet_ids)] for offset in range(2)]
+            name = 'asg-%05d' % index
+            env = ENVIRONMENTS[index % len(ENVIRONMENTS)]
+            tags = [{'Key': 'environment', 'Value': env}]
+            if self.random.random() < 0.6:
+                tags.append({'Key': 'maintenance_window', 'Value': env + '_maintenance_window'})
+            exemption = self.random.random()
+            if exemption < 0.03:
+                tags.append({'Key': 'install_patch', 'Value': 'no'})
+            elif exemption < 0.06:
+                tags.append({'Key': 'AmazonECSManaged', 'Value': 'true'})
+            group = {
+                'AutoScalingGroupName': name,
+                'AutoScalingGroupARN': 'arn:aws:autoscaling:group/' + name,
+                'MinSize': 1,
+                'MaxSize': 4,
+                'DesiredCapacity': 2,
+                'HealthCheckGracePeriod': 300,
+                'AvailabilityZones': sorted({state.subnets[subnet_id]['AvailabilityZone'] for subnet_id in group_subnet_ids}),
+                'VPCZoneIdentifier': ','.join(group_subnet_ids),
+                'Instances': [{'InstanceId': self.next_id('i'), 'LifecycleState': 'InService'} for _ in range(2)],
+                'Tags': [dict(tag, ResourceId=name, ResourceType='auto-scaling-group', PropagateAtLaunch=False) for tag in tags],
+            }
+            if index % 2:
+                lc_name = 'lc-%d' % (index % pool)
+                state.launch_configurations.setdefault(lc_name, {
+                    'LaunchConfigurationName': lc_name, 'ImageId': 'ami-%017x' % (index % pool), 'InstanceType': 't3.micro',
+                    'SecurityGroups': [], 'KernelId': '', 'RamdiskId': '', 'UserData': 'IyEvYmluL2Jhc2g='})
+                group['LaunchConfigurationName'] = lc_name
+            else:
+                template_id = 'lt-%017x' % (index % pool)
+                state.launch_templates.setdefault(template_id, [{'ImageId': 'ami-%017x' % (100 + index % pool)}])
+                group['LaunchTemplate'] = {'LaunchTemplateId': template_id, 'Version': '$Latest'}
+            state.groups[name] = group
+
+    def add_window(self, state, name):
+        window_id = self.next_id('mw')
+        state.windows[window_id] = {'WindowId': window_id, 'Name': name, 'Enabled': True, 'Tasks': []}
+        return window_id
+
+    def add_execution(self, state, document_name, tags, parameters=None, status='Success'):
+        execution_id = str(uuid.UUID(int=self.random.getrandbits(128)))
+        now = datetime.datetime.now(datetime.timezone.utc)
+        state.executions[execution_id] = {
+            'AutomationExecutionId': execution_id,
+            'DocumentName': document_name,
+            'AutomationExecutionStatus': status,
+            'ExecutionStartTime': now,
+            'ExecutionEndTime': now,
+            'Mode': 'Auto',
+            'Tags': list(tags or []),
+            'Parameters': parameters or {},
+        }
+        return execution_id
+
+    def spend(self, seconds):
+        # Busy waits, holding the GIL between switches like botocore's model
+        # loading does.
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            pass
+
+    def call(self, service, operation, account, region, kwargs, on_throttle=None):
+        """
+        Runs one API call the way botocore's standard retry mode would:
+        throttled attempts are retried up to MAX_ATTEMPTS times and every
+        attempt is counted. on_throttle is called with the error code of
+        every throttled attempt.
+        """
+        handler = getattr(self, service.replace('-', '_') + '_' + operation, None)
+        if handler is None:
+            raise NotImplementedError('The stand-in does not implement ' + service + '.' + operation)
+        for attempt in range(MAX_ATTEMPTS):
+            with self.lock:
+                self.calls[(service, operation)] += 1
+                throttled = self.throttle_rate and self.random.random() < self.throttle_rate
+                if throttled:
+                    self.throttles[(service, operation)] += 1
+            if self.latency:
+                time.sleep(self.latency)
+            if not throttled:
+                return dict(handler(account, region, **kwargs), ResponseMetadata={'RetryAttempts': attempt})
+            if on_throttle is not None:
+                on_throttle(THROTTLING_ERROR_CODES.get(service, 'ThrottlingException'))
+        exception = error(THROTTLING_ERROR_CODES.get(service, 'ThrottlingException'), 'Rate exceeded', operation)
+        exception.response['ResponseMetadata'] = {'RetryAttempts': MAX_ATTEMPTS - 1}
+        raise exception
+
+    # sts
+
+    def sts_get_caller_identity(self, account, region):
+        return {'Account': account, 'Arn': 'arn:aws:sts::' + account + ':assumed-role/lambda', 'UserId': 'AROA'}
+
+    def sts_assume_role(self, account, region, RoleArn, RoleSessionName, **kwargs):
+        role_account = RoleArn.split(':')[4]
+        return {'Credentials': {
+            'AccessKeyId': 'ASIA' + role_account,
+            'SecretAccessKey': 'secret',
+            'SessionToken': 'token',
+            'Expiration': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1),
+        }}
+
+    # organizations
+
+    def organizations_list_roots(self, account, region, **kwargs):
+        return {'Roots': list(self.roots)}
+
+    def organizations_list_accounts(self, account, region, **kwargs):
+        return paginate(list(self.accounts.values()), 'Accounts', kwargs, 'MaxResults', 20, 20)
+
+    def organizations_list_accounts_for_parent(self, account, region, ParentId, **kwargs):
+        accounts = [self.accounts[account_id] for account_id in self.account_parents.get(ParentId, [])]
+        return paginate(accounts, 'Accounts', kwargs, 'MaxResults', 20, 20)
+
+    def organizations_list_organizational_units_for_parent(self, account, region, ParentId, **kwargs):
+        ous = [self.ous[ou_id] for ou_id in self.children.get(ParentId, [])]
+        return paginate(ous, 'OrganizationalUnits', kwargs, 'MaxResults', 20, 20)
+
+    def organizations_list_tags_for_resource(self, account, region, ResourceId, **kwargs):
+        return {'Tags': list(self.account_tags.get(ResourceId, []))}
+
+    # lambda
+
+    def lambda_invoke(self, account, region, FunctionName, Payload=None, InvocationType=None, **kwargs):
+        """
+        Records the invocation and, as the child task Lambdas would, starts
+        an automation execution tagged with the payload's run ID.
+        """
+        with self.lock:
+            self.invocations.append((account, region, FunctionName))
+        tags = []
+        if Payload:
+            run_id = json.loads(Payload).get('run_id')
+            if run_id:
+                tags.append({'Key': 'PatchingRunId', 'Value': run_id})
+                tags.append({'Key': 'PatchingRunId:' + run_id, 'Value': 'Default'})
+        with self.lock:
+            self.add_execution(self.state(account, region), FunctionName, tags)
+        return {'StatusCode': 202}
+
+    # ec2
+
+    def ec2_describe_instances(self, account, region, Filters=None, InstanceIds=None, **kwargs):
+        state = self.state(account, region)
+        with self.lock:
+            if InstanceIds:
+                missing = [instance_id for instance_id in InstanceIds if instance_id not in state.instances]
+                if missing:
+                    raise error('InvalidInstanceID.NotFound', "The instance ID '%s' does not exist" % ', '.join(missing), 'DescribeInstances')
+                instances = [state.instances[instance_id] for instance_id in InstanceIds]
+            else:
+                instances = list(state.instances.values())
+        for flt in Filters or []:
+            if flt['Name'] == 'instance-state-name':
+                instances = [instance for instance in instances if instance['State']['Name'] in flt['Values']]
+            elif flt['Name'] == 'instance-id':
+                values = set(flt['Values'])
+                instances = [instance for instance in instances if instance['InstanceId'] in values]
+        instances = [instance for instance in instances if match_tag_filters(instance['Tags'], Filters or [])]
+        if InstanceIds:
+            page = {'Instances': instances}
+        else:
+            page = paginate(instances, 'Instances', kwargs, 'MaxResults', 1000, 1000)
+        response = {'Reservations': [{'ReservationId': 'r-' + instance['InstanceId'][2:], 'Instances': [self.copy_instance(instance)]}
+                                     for instance in page['Instances']]}
+        if 'NextToken' in page:
+            response['NextToken'] = page['NextToken']
+        return response
+
+    def copy_instance(self, instance):
+        return dict(instance, Tags=[dict(tag) for tag in instance['Tags']])
+
+    def ec2_create_tags(self, account, region, Resources, Tags, DryRun=False, **kwargs):
+        if len(Resources) > 1000:
+            raise error('InvalidParameterValue', 'Too many resources', 'CreateTags')
+        state = self.state(account, region)
+        with self.lock:
+            missing = [resource_id for resource_id in Resources if resource_id not in state.instances]
+            if missing:
+                raise error('InvalidInstanceID.NotFound', "The instance ID '%s' does not exist" % ', '.join(missing), 'CreateTags')
+            for resource_id in Resources:
+                tags = state.instances[resource_id]['Tags']
+                for new_tag in Tags:
+                    for tag in tags:
+                        if tag['Key'] == new_tag['Key']:
+                            tag['Value'] = new_tag['Value']
+                            break
+                    else:
+                        tags.append({'Key': new_tag['Key'], 'Value': new_tag['Value']})
+        return {}
+
+    def ec2_describe_images(self, account, region, ImageIds, **kwargs):
+        return {'Images': [{'ImageId': image_id, 'Name': 'image-' + image_id} for image_id in ImageIds]}
+
+    def ec2_describe_subnets(self, account, region, SubnetIds, **kwargs):
+        state = self.state(account, region)
+        missing = [subnet_id for subnet_id in SubnetIds if subnet_id not in state.subnets]
+        if missing:
+            raise error('InvalidSubnetID.NotFound', "The subnet ID '%s' does not exist" % ', '.join(missing), 'DescribeSubnets')
+        return {'Subnets': [dict(state.subnets[subnet_id]) for subnet_id in SubnetIds]}
+
+    def ec2_describe_security_groups(self, account, region, Filters=None, GroupIds=None, **kwargs):
+        state = self.state(account, region)
+        with self.lock:
+            groups = list(state.security_groups.values())
+        for flt in Filters or []:
+            key = {'group-name': 'GroupName', 'vpc-id': 'VpcId', 'group-id': 'GroupId'}.get(flt['Name'])
+            if key is not None:
+                groups = [group for group in groups if group[key] in flt['Values']]
+        if GroupIds:
+            groups = [group for group in groups if group['GroupId'] in GroupIds]
+        return {'SecurityGroups': [dict(group) for group in groups]}
+
+    def ec2_authorize_security_group_egress(self, account, region, GroupId, IpPermissions, **kwargs):
+        state = self.state(account, region)
+        with self.lock:
+            state.security_groups[GroupId]['IpPermissionsEgress'] = state.security_groups[GroupId]['IpPermissionsEgress'] + list(IpPermissions)
+        return {'Return': True}
+
+    def ec2_create_security_group(self, account, region, GroupName, VpcId, Description=None, **kwargs):
+        state = self.state(account, region)
+        group_id = self.next_id('sg')
+        with self.lock:
+            state.security_groups[group_id] = {
+                'GroupId': group_id, 'GroupName': GroupName, 'VpcId': VpcId,
+                'IpPermissionsEgress': [{'IpProtocol': '-1', 'IpRanges': [{'CidrIp': '0.0.0.0/0'}]}]}
+        return {'GroupId': group_id}
+
+    def ec2_describe_launch_template_versions(self, account, region, LaunchTemplateId, Versions=None, **kwargs):
+        state = self.state(account, region)
+        if LaunchTemplateId not in state.launch_templates:
+            raise error('InvalidLaunchTemplateId.NotFound', 'Launch template not found', 'DescribeLaunchTemplateVersions')
+        with self.lock:
+            versions = state.launch_templates[LaunchTemplateId]
+            numbers = [len(versions) if version == '$Latest' else 1 if version == '$Default' else int(version)
+                       for version in Versions or ['$Default']]
+            return {'LaunchTemplateVersions': [{
+                'LaunchTemplateId': LaunchTemplateId,
+                'VersionNumber': number,
+                'LaunchTemplateData': dict(versions[number - 1]),
+            } for number in numbers]}
+
+    def ec2_create_launch_template_version(self, account, region, LaunchTemplateId, SourceVersion, LaunchTemplateData, **kwargs):
+        state = self.state(account, region)
+        if LaunchTemplateId not in state.launch_templates:
+            raise error('InvalidLaunchTemplateId.NotFound', 'Launch template not found', 'CreateLaunchTemplateVersion')
+        with self.lock:
+            versions = state.launch_templates[LaunchTemplateId]
+            versions.append(dict(versions[int(SourceVersion) - 1], **LaunchTemplateData))
+            return {'LaunchTemplateVersion': {'LaunchTemplateId': LaunchTemplateId, 'VersionNumber': len(versions)}}
+
+    # autoscaling
+
+    def autoscaling_describe_auto_scaling_groups(self, account, region, AutoScalingGroupNames=None, Filters=None, **kwargs):
+        state = self.state(account, region)
+        with self.lock:
+            if AutoScalingGroupNames:
+                if len(AutoScalingGroupNames) > 1600:
+                    raise error('ValidationError', 'Too many names', 'DescribeAutoScalingGroups')
+                groups = [state.groups[name] for name in AutoScalingGroupNames if name in state.groups]
+            else:
+                groups = list(state.groups.values())
+        groups = [group for group in groups if match_tag_filters(group['Tags'], Filters or [])]
+        page = paginate(groups, 'AutoScalingGroups', kwargs, 'MaxRecords', 50, 100)
+        page['AutoScalingGroups'] = [dict(group, Tags=[dict(tag) for tag in group['Tags']]) for group in page['AutoScalingGroups']]
+        return page
+
+    def autoscaling_describe_launch_configurations(self, account, region, LaunchConfigurationNames=None, **kwargs):
+        state = self.state(account, region)
+        names = LaunchConfigurationNames or list(state.launch_configurations)
+        return {'LaunchConfigurations': [dict(state.launch_configurations[name]) for name in names if name in state.launch_configurations]}
+
+    def autoscaling_create_or_update_tags(self, account, region, Tags, **kwargs):
+        state = self.state(account, region)
+        with self.lock:
+            for new_tag in Tags:
+                group = state.groups.get(new_tag['ResourceId'])
+                if group is None:
+                    raise error('ValidationError', 'AutoScalingGroup name not found - ' + new_tag['ResourceId'], 'CreateOrUpdateTags')
+            for new_tag in Tags:
+                tags = state.groups[new_tag['ResourceId']]['Tags']
+                tags[:] = [tag for tag in tags if tag['Key'] != new_tag['Key']] + [dict(new_tag)]
+        return {}
+
+    def autoscaling_create_launch_configuration(self, account, region, LaunchConfigurationName, ImageId, InstanceId=None, **kwargs):
+        state = self.state(account, region)
+        with self.lock:
+            if LaunchConfigurationName in state.launch_configurations:
+                raise error('AlreadyExists', 'Launch Configuration by this name already exists', 'CreateLaunchConfiguration')
+            configuration = dict(kwargs, LaunchConfigurationName=LaunchConfigurationName, ImageId=ImageId)
+            # boto3 encodes UserData, given as text or bytes, on create and
+            # describe returns it encoded.
+            if 'UserData' in configuration:
+                user_data = configuration['UserData']
+                if isinstance(user_data, str):
+                    user_data = user_data.encode()
+                configuration['UserData'] = base64.b64encode(user_data).decode()
+            state.launch_configurations[LaunchConfigurationName] = configuration
+        return {}
+
+    def autoscaling_delete_launch_configuration(self, account, region, LaunchConfigurationName, **kwargs):
+        state = self.state(account, region)
+        with self.lock:
+            if any(group.get('LaunchConfigurationName') == LaunchConfigurationName for group in state.groups.values()):
+                raise error('ResourceInUse', 'Cannot delete launch configuration while it is attached', 'DeleteLaunchConfiguration')
+            state.launch_configurations.pop(LaunchConfigurationName, None)
+        return {}
+
+    def autoscaling_update_auto_scaling_group(self, account, region, AutoScalingGroupName, **kwargs):
+        state = self.state(account, region)
+        with self.lock:
+            group = state.groups.get(AutoScalingGroupName)
+            if group is None:
+                raise error('ValidationError', 'AutoScalingGroup name not found', 'UpdateAutoScalingGroup')
+            if 'LaunchConfigurationName' in kwargs:
+                group.pop('LaunchTemplate', None)
+            if 'LaunchTemplate' in kwargs:
+                group.pop('LaunchConfigurationName', None)
+            group.update(kwargs)
+        return {}
+
+    def autoscaling_start_instance_refresh(self, account, region, AutoScalingGroupName, **kwargs):
+        state = self.state(account, region)
+        with self.lock:
+            refreshes = state.instance_refreshes.setdefault(AutoScalingGroupName, [])
+            if refreshes and refreshes[0]['Status'] in ('Pending', 'InProgress'):
+                raise error('InstanceRefreshInProgress', 'An Instance Refresh is already in progress', 'StartInstanceRefresh')
+            refresh_id = str(uuid.UUID(int=self.random.getrandbits(128)))
+            refreshes.insert(0, {
+                'InstanceRefreshId': refresh_id, 'AutoScalingGroupName': AutoScalingGroupName, 'Status': 'InProgress',
+                'StartTime': datetime.datetime.now(datetime.timezone.utc), 'PercentageComplete': 0})
+        return {'InstanceRefreshId': refresh_id}
+
+    def autoscaling_describe_instance_refreshes(self, account, region, AutoScalingGroupName, InstanceRefreshIds=None, MaxRecords=50, **kwargs):
+        state = self.state(account, region)
+        with self.lock:
+            refreshes = [dict(refresh) for refresh in state.instance_refreshes.get(AutoScalingGroupName, [])
+                         if not InstanceRefreshIds or refresh['InstanceRefreshId'] in InstanceRefreshIds]
+        return {'InstanceRefreshes': refreshes[:MaxRecords]}
+
+    def autoscaling_delete_tags(self, account, region, Tags, **kwargs):
+        state = self.state(account, region)
+        with self.lock:
+            for old_tag in Tags:
+                group = state.groups.get(old_tag['ResourceId'])
+                if group is not None:
+                    group['Tags'][:] = [tag for tag in group['Tags'] if tag['Key'] != old_tag['Key']]
+        return {}
+
+    # ssm
+
+    def ssm_start_automation_execution(self, account, region, DocumentName, Parameters=None, Tags=None, **kwargs):
+        with self.lock:
+            execution_id = self.add_execution(self.state(account, region), DocumentName, Tags, Parameters)
+        return {'AutomationExecutionId': execution_id}
+
+    def ssm_describe_automation_executions(self, account, region, Filters=None, **kwargs):
+        state = self.state(account, region)
+        with self.lock:
+            executions = list(state.executions.values())
+        for flt in Filters or []:
+            if flt['Key'] == 'ExecutionId':
+                executions = [execution for execution in executions if execution['AutomationExecutionId'] in flt['Values']]
+            elif flt['Key'] == 'StartTimeAfter':
+                after = datetime.datetime.strptime(flt['Values'][0], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=datetime.timezone.utc)
+                executions = [execution for execution in executions if execution['ExecutionStartTime'] >= after]
+            elif flt['Key'] == 'TagKey':
+                executions = [execution for execution in executions
+                              if any(tag['Key'] in flt['Values'] for tag in execution['Tags'])]
+        page = paginate(executions, 'AutomationExecutionMetadataList', kwargs, 'MaxResults', 50, 50)
+        page['AutomationExecutionMetadataList'] = [
+            {key: value for key, value in execution.items() if key not in ('Tags', 'Parameters')}
+            for execution in page['AutomationExecutionMetadataList']]
+        return page
+
+    def ssm_list_tags_for_resource(self, account, region, ResourceType, ResourceId, **kwargs):
+        execution = self.state(account, region).executions.get(ResourceId)
+        if execution is None:
+            raise error('InvalidResourceId', 'Resource not found', 'ListTagsForResource')
+        return {'TagList': list(execution['Tags'])}
+
+    def ssm_add_tags_to_resource(self, account, region, ResourceType, ResourceId, Tags, **kwargs):
+        execution = self.state(account, region).executions[ResourceId]
+        with self.lock:
+            execution['Tags'] = execution['Tags'] + list(Tags)
+        return {}
+
+    def ssm_get_parameter(self, account, region, Name, **kwargs):
+        parameter = self.state(account, region).parameters.get(Name)
+        if parameter is None:
+            raise error('ParameterNotFound', 'Parameter not found', 'GetParameter')
+        return {'Parameter': dict(parameter)}
+
+    def ssm_put_parameter(self, account, region, Name, Value, Type='String', Overwrite=False, **kwargs):
+        state = self.state(account, region)
+        with self.lock:
+            if Name in state.parameters and not Overwrite:
+                raise error('ParameterAlreadyExists', 'Parameter exists', 'PutParameter')
+            version = state.parameters.get(Name, {}).get('Version', 0) + 1
+            state.parameters[Name] = {'Name': Name, 'Value': Value, 'Type': Type, 'Version': version}
+        return {'Version': version}
+
+    def ssm_describe_maintenance_windows(self, account, region, Filters=None, **kwargs):
+        state = self.state(account, region)
+        with self.lock:
+            windows = list(state.windows.values())
+        for flt in Filters or []:
+            if flt['Key'] == 'Name':
+                windows = [window for window in windows if window['Name'] in flt['Values']]
+        return {'WindowIdentities': [{key: value for key, value in window.items() if key != 'Tasks'} for window in windows]}
+
+    def ssm_create_maintenance_window(self, account, region, Name, **kwargs):
+        with self.lock:
+            return {'WindowId': self.add_window(self.state(account, region), Name)}
+
+    def ssm_register_task_with_maintenance_window(self, account, region, WindowId, TaskArn, **kwargs):
+        state = self.state(account, region)
+        task_id = str(uuid.UUID(int=self.random.getrandbits(128)))
+        with self.lock:
+            state.windows[WindowId]['Tasks'].append((task_id, TaskArn))
+        return {'WindowTaskId': task_id}
+
+    def ssm_delete_maintenance_window(self, account, region, WindowId, **kwargs):
+        with self.lock:
+            self.state(account, region).windows.pop(WindowId, None)
+        return {'WindowId': WindowId}
+
+
+class StandInExceptions(object):
+    """
+    Exposes client.exceptions.<Code> as ClientError subclasses that match
+    the errors the stand-in raises, like botocore's modeled exceptions.
+    """
+
+    def __init__(self):
+        self.classes = {}
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        if name not in self.classes:
+            self.classes[name] = type(name, (ClientError,), {})
+        return self.classes[name]
+
+
+class StandInEvents(object):
+    """
+    Emits the botocore client events API call instrumentation listens to.
+    Handlers registered for a prefix such as 'before-call' receive every
+    event below it, as with botocore's hierarchical emitter.
+    """
+
+    def __init__(self):
+        self.handlers = []
+
+    def register(self, event_name, handler, unique_id=None):
+        self.handlers.append((event_name, handler))
+
+    def emit(self, event_name, **kwargs):
+        for registered, handler in list(self.handlers):
+            if event_name == registered or event_name.startswith(registered + '.'):
+                handler(event_name=event_name, **kwargs)
+
+
+class StandInMeta(object):
+
+    def __init__(self, service, region_name):
+        self.service = service
+        self.region_name = region_name
+        self.events = StandInEvents()
+
+
+class StandInClient(object):
+    """
+    # Class: StandInClient
+    # Description: A boto3 client look-alike whose operations run against a
+    # World as one account in one region
+    """
+
+    def __init__(self, world, service, account, region_name):
+        self.world = world
+        self.service = service
+        self.account = account
+        self.meta = StandInMeta(service, region_name)
+        self.exceptions = StandInExceptions()
+
+    def __getattr__(self, operation):
+        if operation.startswith('__'):
+            raise AttributeError(operation)
+
+        # botocore names client events <event>.<service id>.<OperationName>.
+        suffix = '.' + SERVICE_IDS.get(self.service, self.service) + '.' + ''.join(
+            word.capitalize() for word in operation.split('_'))
+        events = self.meta.events
+
+        def on_throttle(code):
+            events.emit('needs-retry' + suffix, response=(None, {'Error': {'Code': code}}))
+
+        def call(**kwargs):
+            context = {}
+            events.emit('before-call' + suffix, params=kwargs, context=context)
+            try:
+                response = self.world.call(self.service, operation, self.account, self.meta.region_name, kwargs,
+                                           on_throttle)
+            except ClientError as exception:
+                code = exception.response['Error']['Code']
+                modeled = getattr(self.exceptions, code.replace('.', ''))(exception.response, exception.operation_name)
+                events.emit('after-call-error' + suffix, exception=modeled, context=context)
+                raise modeled
+            events.emit('after-call' + suffix, parsed=response, context=context)
+            return response
+        return call
+
+    def get_paginator(self, operation):
+        return StandInPaginator(self, operation)
+
+    def can_paginate(self, operation):
+        return True
+
+
+class StandInPaginator(object):
+
+    def __init__(self, client, operation):
+        self.client = client
+        self.operation = operation
+
+    def paginate(self, PaginationConfig=None, **kwargs):
+        if PaginationConfig and 'PageSize' in PaginationConfig and self.operation in PAGE_SIZE_PARAMETERS:
+            kwargs[PAGE_SIZE_PARAMETERS[self.operation]] = PaginationConfig['PageSize']
+        token = None
+        while True:
+            arguments = dict(kwargs)
+            if token:
+                arguments['NextToken'] = token
+            page = getattr(self.client, self.operation)(**arguments)
+            yield page
+            token = page.get('NextToken')
+            if not token:
+                return
+
+
+def session_class(world):
+    """
+    Returns a boto3.session.Session replacement whose clients use world. A
+    session built from assumed role credentials acts as the role's account.
+    """
+    def get_account(aws_access_key_id):
+        if aws_access_key_id and aws_access_key_id.startswith('ASIA'):
+            return aws_access_key_id[4:]
+        return HOME_ACCOUNT
+
+    class StandInSession(object):
+
+        def __init__(self, aws_access_key_id=None, **kwargs):
+            self.account = get_account(aws_access_key_id)
+            self.loaded = False
+
+        def load(self):
+            if not self.loaded:
+                world.spend(world.session_seconds)
+                self.loaded = True
+
+        def get_credentials(self):
+            self.load()
+            return None
+
+        def get_available_regions(self, service_name):
+            self.load()
+            return list(world.regions)
+
+        def client(self, service_name, region_name=None, aws_access_key_id=None, **kwargs):
+            self.load()
+            world.spend(world.client_seconds)
+            account = get_account(aws_access_key_id) if aws_access_key_id else self.account
+            return StandInClient(world, service_name, account, region_name or world.regions[0])
+
+    return StandInSession
+
+
+@contextlib.contextmanager
+def installed(world):
+    """
+    Routes every boto3 session and client created inside the block to world.
+    """
+    import boto3
+    import boto3.session
+    session = session_class(world)
+    original_session, original_client = boto3.session.Session, boto3.client
+    boto3.session.Session = session
+    boto3.client = lambda service_name, region_name=None, **kwargs: session().client(service_name, region_name)
+    try:
+        yield world
+    finally:
+        boto3.session.Session, boto3.client = original_session, original_client
@@ -0,0 +1,122 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+from botocore.exceptions import ClientError
+
+from patching_automation import (EXECUTION_FAILED, EXECUTION_NOT_STARTED, EXECUTION_STARTED,
+                                 LIMIT_EXCEEDED_ERROR_CODE, AutomationScheduler)
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class Ssm(object):
+    """
+    Starts executions that run for run_seconds, and answers with
+    start_errors, one per call, before starting anything.
+    """
+
+    def __init__(self, clock, run_seconds=60, start_errors=()):
+        self.clock = clock
+        self.run_seconds = run_seconds
+        self.start_errors = list(start_errors)
+        self.started = {}
+
+    def start_automation_execution(self, **kwargs):
+        if self.start_errors:
+            raise ClientError({'Error': {'Code': self.start_errors.pop(0)}}, 'StartAutomationExecution')
+        execution_id = 'exec-%d' % len(self.started)
+        self.started[execution_id] = self.clock.now
+        return {'AutomationExecutionId': execution_id}
+
+    def describe_automation_executions(self, Filters):
+        return {'AutomationExecutionMetadataList': [
+            {'AutomationExecutionId': execution_id,
+             'AutomationExecutionStatus': 'Success' if self.clock.now - self.started[execution_id] >= self.run_seconds else 'InProgress'}
+            for execution_id in Filters[0]['Values']]}
+
+    def running(self):
+        return sum(1 for started in self.started.values() if self.clock.now - started < self.run_seconds)
+
+
+def scheduler(ssm, clock, **kwargs):
+    return AutomationScheduler(ssm, clock=clock.time, sleep=clock.sleep, **kwargs)
+
+
+def test_every_job_starts_within_the_limit():
+    clock = Clock()
+    ssm = Ssm(clock)
+    automation_scheduler = scheduler(ssm, clock, max_running=10, deadline=870)
+    for index in range(5):
+        automation_scheduler.submit(index, DocumentName='Patch')
+    results = automation_scheduler.run()
+    assert all(result['Status'] == EXECUTION_STARTED for result in results.values())
+    assert clock.now == 0
+
+
+def test_queued_jobs_start_as_running_executions_finish():
+    clock = Clock()
+    ssm = Ssm(clock, run_seconds=60)
+    peak = []
+    start = ssm.start_automation_execution
+
+    def start_and_count(**kwargs):
+        response = start(**kwargs)
+        peak.append(ssm.running())
+        return response
+    ssm.start_automation_execution = start_and_count
+    automation_scheduler = scheduler(ssm, clock, max_running=2, deadline=870, poll_interval=15)
+    for index in range(5):
+        automation_scheduler.submit(index, DocumentName='Patch')
+    results = automation_scheduler.run()
+    assert all(result['Status'] == EXECUTION_STARTED for result in results.values())
+    assert max(peak) == 2
+    assert 120 <= clock.now < 870
+
+
+def test_quota_errors_are_retried_until_the_deadline():
+    clock = Clock()
+    ssm = Ssm(clock, start_errors=[LIMIT_EXCEEDED_ERROR_CODE] * 100000)
+    automation_scheduler = scheduler(ssm, clock, deadline=870)
+    automation_scheduler.submit('asg', DocumentName='Patch')
+    results = automation_scheduler.run()
+    assert results['asg'] == {'Status': EXECUTION_NOT_STARTED, 'Error': LIMIT_EXCEEDED_ERROR_CODE}
+    assert 800 < clock.now < 870
+
+
+def test_job_starts_once_the_quota_frees_up():
+    clock = Clock()
+    ssm = Ssm(clock, start_errors=[LIMIT_EXCEEDED_ERROR_CODE] * 20)
+    automation_scheduler = scheduler(ssm, clock, deadline=870)
+    automation_scheduler.submit('asg', DocumentName='Patch')
+    assert automation_scheduler.run()['asg']['Status'] == EXECUTION_STARTED
+
+
+def test_jobs_waiting_for_a_slot_at_the_deadline_are_not_started():
+    clock = Clock()
+    ssm = Ssm(clock, run_seconds=3600)
+    automation_scheduler = scheduler(ssm, clock, max_running=1, deadline=870)
+    automation_scheduler.submit('first', DocumentName='Patch')
+    automation_scheduler.submit('second', DocumentName='Patch')
+    results = automation_scheduler.run()
+    assert results['first']['Status'] == EXECUTION_STARTED
+    assert results['second']['Status'] == EXECUTION_NOT_STARTED
+    assert clock.now < 870
+
+
+def test_other_errors_fail_the_job_without_retrying():
+    clock = Clock()
+    ssm = Ssm(clock, start_errors=['InvalidDocument'])
+    automation_scheduler = scheduler(ssm, clock, deadline=870)
+    automation_scheduler.submit('asg', DocumentName='Patch')
+    assert automation_scheduler.run()['asg'] == {'Status': EXECUTION_FAILED, 'Error': 'InvalidDocument'}
+    assert clock.now == 0
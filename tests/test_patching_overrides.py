@@ -0,0 +1,49 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import pytest
+
+from patching_overrides import OverrideListError, parse_override_list, parse_s3_url
+
+
+@pytest.mark.parametrize('content, patch_ids', [
+    (b"patches:\n    -\n        id: '{KB4480965}'\n        title: '2019-01 Security Update'\n    -\n        id: 'KB4481031'\n",
+     ['{KB4480965}', 'KB4481031']),
+    (b"# Linux\npatches:\n  - id: kernel.x86_64   # kernel\n    title: \"Kernel\"\n  - id: openssl\n",
+     ['kernel.x86_64', 'openssl']),
+    (b"patches:\n- id: a\n- id: 'it''s'\n", ['a', "it's"]),
+    (b"\xef\xbb\xbfpatches:\n  - id: KB1\r\n", ['KB1']),
+])
+def test_documented_layouts_are_accepted(content, patch_ids):
+    assert parse_override_list(content) == patch_ids
+
+
+@pytest.mark.parametrize('content', [
+    b"",
+    b"patches:\n",
+    b"patches: [{id: a}]\n",
+    b"patches:\n  - title: no id\n",
+    b"patches:\n  - id: ''\n",
+    b"patches:\n  - id: &anchor a\n",
+    b"patches:\n  - id: |\n      a\n",
+    b"patches:\n  - id: a: b\n",
+    b"patches:\n  - id: \"a\\tb\"\n",
+    b"patches:\n  -id: a\n",
+    b"patches:\n  - id: a\n      title: b\n",
+    b"patches:\n  - id: a\n    id: b\n",
+    b"patches:\n\t- id: a\n",
+    b"\xff\xfe",
+])
+def test_other_documents_are_rejected(content):
+    with pytest.raises(OverrideListError):
+        parse_override_list(content)
+
+
+@pytest.mark.parametrize('url, location', [
+    ('s3://bucket/lists/a.yaml', ('bucket', 'lists/a.yaml')),
+    ('https://s3.eu-west-1.amazonaws.com/bucket/lists/a.yaml', ('bucket', 'lists/a.yaml')),
+    ('https://my.bucket.s3.us-west-2.amazonaws.com/a%20b.yaml', ('my.bucket', 'a b.yaml')),
+    ('https://example.com/a.yaml', None),
+])
+def test_s3_urls_are_parsed(url, location):
+    assert parse_s3_url(url) == location
@@ -0,0 +1,46 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import math
+
+from patching_planner import INSTALL_MINUTES_PER_WAVE, plan_concurrency
+
+
+def waves_needed(size, maximum_concurrency):
+    per_wave = max(1, int(math.ceil(size * int(maximum_concurrency.rstrip('%')) / 100.0)))
+    return int(math.ceil(size / float(per_wave)))
+
+
+def test_every_region_fits_the_window():
+    fleet_sizes = {'us-east-1': 5000, 'eu-west-1': 40, 'ap-south-1': 3}
+    plan = plan_concurrency(fleet_sizes, window_hours=6, cutoff_hours=1)
+    available_minutes = (6 - 1) * 60
+    for size in fleet_sizes.values():
+        assert waves_needed(size, plan['MaximumConcurrency']) * INSTALL_MINUTES_PER_WAVE <= available_minutes
+
+
+def test_longer_windows_patch_fewer_instances_at_once():
+    short = plan_concurrency({'us-east-1': 100}, window_hours=3, cutoff_hours=1)
+    long = plan_concurrency({'us-east-1': 100}, window_hours=6, cutoff_hours=1)
+    assert short['MaximumConcurrency'] == '25%'
+    assert long['MaximumConcurrency'] == '10%'
+
+
+def test_small_fleets_patch_one_region_at_a_time():
+    plan = plan_concurrency({'us-east-1': 2, 'eu-west-1': 2}, window_hours=6, cutoff_hours=1)
+    assert plan['TargetLocationMaxConcurrency'] == '1'
+
+
+def test_large_fleets_patch_regions_in_parallel():
+    plan = plan_concurrency({'us-east-1': 1000, 'eu-west-1': 1000}, window_hours=3, cutoff_hours=1)
+    assert plan['TargetLocationMaxConcurrency'] == '2'
+
+
+def test_regions_without_instances_are_skipped():
+    plan = plan_concurrency({'us-east-1': 10, 'eu-west-1': 0})
+    assert plan['Regions'] == ['us-east-1']
+
+
+def test_window_shorter_than_a_wave_patches_everything_at_once():
+    plan = plan_concurrency({'us-east-1': 10}, window_hours=1, cutoff_hours=1)
+    assert plan['MaximumConcurrency'] == '100%'
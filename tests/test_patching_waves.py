@@ -0,0 +1,59 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+from patching_tracking import RUN_FAILED, RUN_RUNNING, RUN_SUCCEEDED, RUN_TIMED_OUT
+from patching_waves import (ACCOUNTS_UNCHECKED, DECISION_DISPATCH, DECISION_HALT, DECISION_WAIT, evaluate_wave,
+                            plan_waves)
+
+
+def counts(running=0, succeeded=0, failed=0, timed_out=0, unchecked=0):
+    return {RUN_RUNNING: running, RUN_SUCCEEDED: succeeded, RUN_FAILED: failed, RUN_TIMED_OUT: timed_out,
+            ACCOUNTS_UNCHECKED: unchecked}
+
+
+def test_wave_waits_while_executions_run():
+    assert evaluate_wave(counts(running=3, succeeded=7), 1, 0.1, 6) == DECISION_WAIT
+
+
+def test_wave_moves_on_once_nothing_runs():
+    assert evaluate_wave(counts(succeeded=10), 1, 0.1, 6) == DECISION_DISPATCH
+
+
+def test_wave_halts_above_failure_rate():
+    assert evaluate_wave(counts(succeeded=8, failed=1, timed_out=1), 1, 0.1, 6) == DECISION_HALT
+
+
+def test_wave_tolerates_failures_up_to_rate():
+    assert evaluate_wave(counts(succeeded=9, failed=1), 1, 0.1, 6) == DECISION_DISPATCH
+
+
+def test_unchecked_accounts_count_as_failures():
+    assert evaluate_wave(counts(succeeded=3, unchecked=1), 1, 0.1, 6) == DECISION_HALT
+
+
+def test_wave_with_only_unchecked_accounts_halts():
+    assert evaluate_wave(counts(unchecked=2), 1, 0.1, 6) == DECISION_HALT
+
+
+def test_wave_without_executions_waits_until_max_checks():
+    assert evaluate_wave(counts(), 1, 0.1, 6) == DECISION_WAIT
+    assert evaluate_wave(counts(), 5, 0.1, 6) == DECISION_WAIT
+    assert evaluate_wave(counts(), 6, 0.1, 6) == DECISION_DISPATCH
+
+
+def test_stragglers_do_not_hold_up_the_rollout():
+    assert evaluate_wave(counts(running=1, succeeded=9), 6, 0.1, 6) == DECISION_DISPATCH
+
+
+def test_percentage_waves_are_cumulative():
+    accounts = ['%03d' % index for index in range(20)]
+    waves = plan_waves(accounts, {'Strategy': 'percentage', 'Percentages': [5, 25, 100]})
+    assert [len(wave) for wave in waves] == [1, 4, 15]
+    assert sorted(sum(waves, [])) == accounts
+
+
+def test_unmatched_accounts_form_a_last_wave():
+    tags = {'1': {'patch_wave': 'canary'}, '2': {}, '3': {'patch_wave': 'early'}}
+    waves = plan_waves(list(tags), {'Strategy': 'tag', 'TagKey': 'patch_wave', 'TagValues': [['canary'], ['early']]},
+                       get_tags=tags.get)
+    assert waves == [['1'], ['3'], ['2']]
@@ -0,0 +1,69 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import time
+
+from update_asg import CLAIM_TIMEOUT_SECONDS, REFRESH_TAG, RefreshOrchestrator, without_snapshots
+
+
+class AutoScaling(object):
+    """
+    Holds the REFRESH_TAG value and refresh status of each ASG.
+    """
+
+    def __init__(self, claims, refresh_statuses=None):
+        self.claims = dict(claims)
+        self.refresh_statuses = refresh_statuses or {}
+        self.released = []
+
+    def get_paginator(self, operation_name):
+        return self
+
+    def paginate(self, Filters):
+        return [{'AutoScalingGroups': [
+            {'AutoScalingGroupName': asg_name, 'AvailabilityZones': ['az-a'],
+             'Tags': [{'Key': REFRESH_TAG, 'Value': value}]}
+            for asg_name, value in self.claims.items()]}]
+
+    def describe_instance_refreshes(self, AutoScalingGroupName, InstanceRefreshIds):
+        status = self.refresh_statuses.get(InstanceRefreshIds[0])
+        return {'InstanceRefreshes': [{'Status': status}] if status else []}
+
+    def delete_tags(self, Tags):
+        for tag in Tags:
+            self.released.append(tag['ResourceId'])
+            self.claims.pop(tag['ResourceId'])
+
+
+def test_active_claims_are_kept():
+    now = time.time()
+    as_client = AutoScaling({'starting': '%.3f' % now, 'running': '%.3f refresh-1' % now},
+                            {'refresh-1': 'InProgress'})
+    claims = RefreshOrchestrator(as_client).get_claims()
+    assert set(claims) == {'starting', 'running'}
+    assert claims['running'][1] == 'refresh-1'
+    assert as_client.released == []
+
+
+def test_finished_and_expired_claims_are_released():
+    now = time.time()
+    as_client = AutoScaling({'finished': '%.3f refresh-1' % now, 'expired': '%.3f' % (now - CLAIM_TIMEOUT_SECONDS - 1)},
+                            {'refresh-1': 'Successful'})
+    assert RefreshOrchestrator(as_client).get_claims() == {}
+    assert sorted(as_client.released) == ['expired', 'finished']
+
+
+def test_malformed_claims_are_released():
+    as_client = AutoScaling({'malformed': 'yesterday refresh-1', 'empty': ''})
+    assert RefreshOrchestrator(as_client).get_claims() == {}
+    assert sorted(as_client.released) == ['empty', 'malformed']
+
+
+def test_snapshots_of_the_new_image_devices_are_dropped():
+    mappings = [{'DeviceName': '/dev/xvda', 'Ebs': {'SnapshotId': 'snap-root', 'VolumeSize': 30}},
+                {'DeviceName': '/dev/sdf', 'Ebs': {'SnapshotId': 'snap-data'}},
+                {'DeviceName': '/dev/sdb', 'VirtualName': 'ephemeral0'}]
+    assert without_snapshots(mappings, ['/dev/xvda']) == [
+        {'DeviceName': '/dev/xvda', 'Ebs': {'VolumeSize': 30}},
+        {'DeviceName': '/dev/sdf', 'Ebs': {'SnapshotId': 'snap-data'}},
+        {'DeviceName': '/dev/sdb', 'VirtualName': 'ephemeral0'}]